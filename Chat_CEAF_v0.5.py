@@ -12,38 +12,1191 @@ Este script implementa um chatbot de linha de comando que:
 """
 
 # Importações necessárias
-# Instala a biblioteca do Google Generative AI caso não esteja presente
-!pip install -q google-genai
+# A biblioteca do Google Generative AI (pip install google-genai) só é importada na primeira
+# pergunta que precisar do Gemini, para que as respostas fixas fiquem disponíveis imediatamente.
+import argparse
+import atexit
+import base64
+import bisect
+import contextlib
+import contextvars
+import csv
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
-from google.colab import userdata # Para buscar a API Key no ambiente Colab
-from google import genai
-from google.genai import types # Tipos específicos da API Gemini
+import queue
+import random
+import re
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import parse_qs, urlsplit
 
-# Configuração da API Key do Google
-# Busca a chave da API armazenada nos 'secrets' do Google Colab
-os.environ['GOOGLE_API_KEY'] = userdata.get('GOOGLE_API_KEY')
-
-# Inicialização do cliente Gemini
-# Cria uma instância do cliente da API Gemini
+# Cliente e sessão de chat do Gemini, criados sob demanda por `obter_cliente_gemini`
+# e `obter_sessao_chat` (veja a seção "Inicialização do Gemini").
 client = None
-# gemini_model_instance = None # Esta variável não é mais necessária para iniciar o chat dessa forma
 chat_session = None
 MODEL_ID = "gemini-2.0-flash" # Modelo Gemini a ser utilizado, conforme solicitado.
+# Versão do texto do prompt enviado ao Gemini. Deve ser incrementada sempre que
+# `obter_resposta_gemini` ou `buscar_informacao_online_com_gemini` mudarem o prompt,
+# para que o cache não devolva respostas geradas com o prompt antigo.
+VERSAO_PROMPT = "3"
+
+# --- Inicialização do Gemini (sob demanda) ---
+# Arquivo opcional contendo apenas a API Key, para quem não quer usar variáveis de ambiente
+ARQUIVO_CHAVE_API = os.environ.get("CEAF_ARQUIVO_CHAVE", os.path.join(os.path.expanduser("~"), ".config", "chat_ceaf", "google_api_key"))
+
+_trava_gemini = threading.Lock()
+_falha_inicializacao_gemini = None # Mensagem de erro, se a inicialização já falhou
+
+
+def carregar_chave_api():
+    """
+    Procura a API Key do Google, na ordem: variáveis de ambiente GOOGLE_API_KEY ou
+    GEMINI_API_KEY, arquivo `ARQUIVO_CHAVE_API` e, por último, os 'secrets' do Google Colab.
+
+    Returns:
+        str: A API Key, ou None se não for encontrada.
+    """
+    for variavel in ("GOOGLE_API_KEY", "GEMINI_API_KEY"):
+        if os.environ.get(variavel):
+            return os.environ[variavel].strip()
+    if os.path.isfile(ARQUIVO_CHAVE_API):
+        with open(ARQUIVO_CHAVE_API, encoding="utf-8") as arquivo:
+            chave = arquivo.read().strip()
+        if chave:
+            return chave
+    try:
+        from google.colab import userdata # Para buscar a API Key no ambiente Colab
+        return userdata.get('GOOGLE_API_KEY')
+    except Exception:
+        return None
+
+
+def obter_cliente_gemini():
+    """
+    Retorna o cliente da API Gemini, importando o SDK e criando o cliente na primeira chamada.
+    Se a inicialização falhar, o erro é exibido uma única vez e o chatbot segue apenas
+    com as respostas pré-definidas.
+
+    Returns:
+        O cliente `genai.Client`, ou None se não for possível inicializá-lo.
+    """
+    global client, _falha_inicializacao_gemini
+    if client is not None or _falha_inicializacao_gemini:
+        return client
+    with _trava_gemini:
+        if client is None and not _falha_inicializacao_gemini:
+            try:
+                from google import genai
+                chave = carregar_chave_api()
+                if not chave:
+                    raise RuntimeError("API Key não encontrada (defina GOOGLE_API_KEY ou crie o arquivo " + ARQUIVO_CHAVE_API + ")")
+                from google.genai import types
+                # O SDK também recebe o prazo, para que chamadas abandonadas não fiquem presas indefinidamente
+                client = genai.Client(api_key=chave, http_options=types.HttpOptions(timeout=int(PRAZO_MODELO_SEGUNDOS * 1000)))
+                print(f"🤖 Cliente Gemini inicializado com o modelo: {MODEL_ID}.")
+            except Exception as e:
+                _falha_inicializacao_gemini = str(e) or e.__class__.__name__
+                print(f"⚠️ Erro ao inicializar o modelo Gemini: {_falha_inicializacao_gemini}")
+                print("O chatbot poderá ter funcionalidades limitadas (apenas respostas pré-definidas).")
+    return client
+
+
+def obter_sessao_chat():
+    """
+    Retorna a sessão de chat global (usada no terminal), criando-a no primeiro uso.
+    A sessão é um `GerenciadorContexto`, que mantém o histórico dentro do orçamento de tokens.
+
+    Returns:
+        A sessão de chat do Gemini, ou None se o cliente não estiver disponível.
+    """
+    global chat_session
+    if chat_session is None:
+        sessao = criar_sessao_chat()
+        with _trava_gemini:
+            if chat_session is None:
+                chat_session = sessao
+    return chat_session
+
+# --- Backends de Modelo ---
+# "gemini" usa a API real; "simulado" usa um modelo local falso, para testes e benchmarks sem gastar cota.
+BACKEND_MODELO = os.environ.get("CEAF_BACKEND", "gemini")
+
+
+class RespostaModelo:
+    """
+    Resposta (ou trecho de resposta) de um backend, com a mesma interface usada das respostas
+    do SDK: `text` e `usage_metadata` (com `prompt_token_count` e `candidates_token_count`).
+    """
+
+    def __init__(self, text, prompt_token_count=None, candidates_token_count=None):
+        self.text = text
+        self.usage_metadata = None
+        if prompt_token_count is not None or candidates_token_count is not None:
+            self.usage_metadata = UsoTokens(prompt_token_count, candidates_token_count)
+
+
+class UsoTokens:
+    """Contagem de tokens de uma resposta (mesmos nomes de atributo do SDK)."""
+
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class BackendModelo:
+    """
+    Interface dos backends de modelo usados pelo `GerenciadorContexto`.
+
+    As mensagens são listas de (papel, texto), com papel 'user' ou 'model', terminando
+    na pergunta atual; `instrucoes` é a instrução de sistema (ou None).
+    """
+
+    nome = "base"
+
+    def gerar(self, mensagens, instrucoes=None):
+        """
+        Returns:
+            Objeto com `text` e `usage_metadata`.
+        """
+        raise NotImplementedError
+
+    def gerar_em_trechos(self, mensagens, instrucoes=None):
+        """
+        Yields:
+            Objetos com `text` (e `usage_metadata`, ao menos no último trecho).
+        """
+        raise NotImplementedError
+
+
+class BackendGemini(BackendModelo):
+    """Backend que chama a API do Google Gemini pelo SDK `google-genai`."""
+
+    nome = "gemini"
+
+    def __init__(self, cliente, modelo=MODEL_ID):
+        self.cliente = cliente
+        self.modelo = modelo
+
+    def _montar(self, mensagens, instrucoes):
+        from google.genai import types # Tipos específicos da API Gemini
+        contents = [types.Content(role=papel, parts=[types.Part.from_text(text=texto)]) for papel, texto in mensagens]
+        config = types.GenerateContentConfig(system_instruction=instrucoes) if instrucoes else None
+        return contents, config
+
+    def gerar(self, mensagens, instrucoes=None):
+        contents, config = self._montar(mensagens, instrucoes)
+        return self.cliente.models.generate_content(model=self.modelo, contents=contents, config=config)
+
+    def gerar_em_trechos(self, mensagens, instrucoes=None):
+        contents, config = self._montar(mensagens, instrucoes)
+        yield from self.cliente.models.generate_content_stream(model=self.modelo, contents=contents, config=config)
+
+
+class ErroBackendSimulado(Exception):
+    """
+    Erro do backend simulado. Tem os atributos `code` e `status`, como os erros da API
+    do SDK, para que o tratamento de erros possa ser exercitado sem a API real.
+    """
+
+    def __init__(self, code, status, mensagem):
+        super().__init__(f"{code} {status}. {mensagem}")
+        self.code = code
+        self.status = status
+
+
+class BackendSimulado(BackendModelo):
+    """
+    Modelo local falso, com latência, erros e limite de requisições configuráveis.
+
+    A latência segue uma distribuição log-normal com mediana `latencia_mediana_ms` e dispersão
+    `dispersao` (quanto maior, mais longa a cauda). No streaming, o primeiro trecho chega após
+    `fracao_primeiro_trecho` da latência e os demais são distribuídos no tempo restante.
+    """
+
+    nome = "simulado"
+
+    def __init__(self, latencia_mediana_ms=800.0, dispersao=0.5, taxa_erro=0.0, taxa_429=0.0,
+                 limite_por_minuto=0, trechos=8, fracao_primeiro_trecho=0.3, semente=None):
+        self.latencia_mediana_ms = latencia_mediana_ms
+        self.dispersao = dispersao
+        self.taxa_erro = taxa_erro
+        self.taxa_429 = taxa_429
+        self.limite_por_minuto = limite_por_minuto
+        self.trechos = max(1, trechos)
+        self.fracao_primeiro_trecho = fracao_primeiro_trecho
+        self.aleatorio = random.Random(semente)
+        self.chamadas_recentes = [] # Instantes das chamadas do último minuto (para o limite)
+        self.trava = threading.Lock()
+        self.contadores = Counter()
+
+    @classmethod
+    def do_ambiente(cls):
+        """Cria o backend simulado com as configurações das variáveis de ambiente CEAF_SIMULADO_*."""
+        return cls(
+            latencia_mediana_ms=float(os.environ.get("CEAF_SIMULADO_LATENCIA_MS", "800")),
+            dispersao=float(os.environ.get("CEAF_SIMULADO_DISPERSAO", "0.5")),
+            taxa_erro=float(os.environ.get("CEAF_SIMULADO_TAXA_ERRO", "0")),
+            taxa_429=float(os.environ.get("CEAF_SIMULADO_TAXA_429", "0")),
+            limite_por_minuto=int(os.environ.get("CEAF_SIMULADO_LIMITE_POR_MINUTO", "0")),
+            trechos=int(os.environ.get("CEAF_SIMULADO_TRECHOS", "8")),
+        )
+
+    def _iniciar_chamada(self):
+        # Decide, antes de "responder", se a chamada falha e quanto tempo ela leva
+        with self.trava:
+            self.contadores["chamadas"] += 1
+            agora = time.monotonic()
+            if self.limite_por_minuto:
+                self.chamadas_recentes = [t for t in self.chamadas_recentes if agora - t < 60]
+                if len(self.chamadas_recentes) >= self.limite_por_minuto:
+                    self.contadores["erros_429"] += 1
+                    raise ErroBackendSimulado(429, "RESOURCE_EXHAUSTED", "Limite de requisições por minuto atingido (simulado).")
+                self.chamadas_recentes.append(agora)
+            sorteio = self.aleatorio.random()
+            latencia = self.latencia_mediana_ms / 1000 * math.exp(self.aleatorio.gauss(0, self.dispersao))
+        if sorteio < self.taxa_429:
+            self.contadores["erros_429"] += 1
+            raise ErroBackendSimulado(429, "RESOURCE_EXHAUSTED", "Cota excedida (simulado).")
+        if sorteio < self.taxa_429 + self.taxa_erro:
+            time.sleep(latencia)
+            self.contadores["erros_503"] += 1
+            raise ErroBackendSimulado(503, "UNAVAILABLE", "Serviço indisponível (simulado).")
+        return latencia
+
+    def _texto_resposta(self, mensagens):
+        pergunta = mensagens[-1][1] if mensagens else ""
+        return (f"[resposta simulada] Sobre {pergunta[:80]!r}: procure a Assistência Farmacêutica de Tatuí "
+                f"com o LME, a receita em duas vias e seus documentos pessoais.")
+
+    def _uso(self, mensagens, instrucoes, texto):
+        prompt = sum(estimar_tokens(t) for _, t in mensagens) + (estimar_tokens(instrucoes) if instrucoes else 0)
+        return prompt, estimar_tokens(texto)
+
+    def gerar(self, mensagens, instrucoes=None):
+        latencia = self._iniciar_chamada()
+        time.sleep(latencia)
+        texto = self._texto_resposta(mensagens)
+        return RespostaModelo(texto, *self._uso(mensagens, instrucoes, texto))
+
+    def gerar_em_trechos(self, mensagens, instrucoes=None):
+        latencia = self._iniciar_chamada()
+        texto = self._texto_resposta(mensagens)
+        tamanho = -(-len(texto) // self.trechos)
+        partes = [texto[i:i + tamanho] for i in range(0, len(texto), tamanho)]
+        time.sleep(latencia * self.fracao_primeiro_trecho)
+        intervalo = latencia * (1 - self.fracao_primeiro_trecho) / max(1, len(partes) - 1)
+        for i, parte in enumerate(partes):
+            if i:
+                time.sleep(intervalo)
+            if i == len(partes) - 1:
+                yield RespostaModelo(parte, *self._uso(mensagens, instrucoes, texto))
+            else:
+                yield RespostaModelo(parte)
+
+
+_backend_simulado = None
+
+
+def obter_backend_modelo():
+    """
+    Retorna o backend de modelo configurado em `BACKEND_MODELO`.
+
+    Returns:
+        BackendModelo: O backend, ou None se o Gemini não puder ser inicializado.
+    """
+    global _backend_simulado
+    if BACKEND_MODELO == "simulado":
+        if _backend_simulado is None:
+            with _trava_gemini:
+                if _backend_simulado is None:
+                    _backend_simulado = BackendSimulado.do_ambiente()
+        return _backend_simulado
+    cliente = obter_cliente_gemini()
+    return BackendGemini(cliente) if cliente is not None else None
+
+
+def criar_sessao_chat():
+    """
+    Cria uma nova sessão de chat (com histórico próprio) usando o backend configurado.
+
+    Returns:
+        GerenciadorContexto: A sessão, ou None se nenhum backend estiver disponível.
+    """
+    backend = obter_backend_modelo()
+    return GerenciadorContexto(backend) if backend is not None else None
+
+
+# --- Resiliência das Chamadas ao Modelo ---
+# Prazo de cada tentativa (segundos), prazo total da pergunta somando as novas tentativas, e número de tentativas
+PRAZO_MODELO_SEGUNDOS = float(os.environ.get("CEAF_PRAZO_MODELO", "20"))
+PRAZO_TOTAL_MODELO_SEGUNDOS = float(os.environ.get("CEAF_PRAZO_TOTAL_MODELO", "40"))
+TENTATIVAS_MODELO = int(os.environ.get("CEAF_TENTATIVAS_MODELO", "3"))
+ESPERA_BASE_SEGUNDOS = 0.5 # Primeira espera antes de tentar de novo; dobra a cada tentativa
+# Disjuntor: após DISJUNTOR_FALHAS falhas seguidas, as chamadas falham na hora por DISJUNTOR_ESPERA segundos
+DISJUNTOR_FALHAS = int(os.environ.get("CEAF_DISJUNTOR_FALHAS", "5"))
+DISJUNTOR_ESPERA_SEGUNDOS = float(os.environ.get("CEAF_DISJUNTOR_ESPERA", "30"))
+# Requisição duplicada ("hedge"): se a chamada passar do percentil indicado das latências recentes,
+# uma segunda chamada igual é feita e vale a que responder primeiro. 0 desativa.
+PERCENTIL_DUPLICACAO = float(os.environ.get("CEAF_PERCENTIL_DUPLICACAO", "0"))
+# Códigos HTTP de falhas passageiras, que valem uma nova tentativa
+CODIGOS_RECUPERAVEIS = {408, 429, 500, 502, 503, 504}
+
+
+class ErroPrazoModelo(TimeoutError):
+    """A chamada ao modelo não terminou dentro do prazo."""
+
+
+class ErroCircuitoAberto(RuntimeError):
+    """O disjuntor está aberto: o modelo falhou seguidamente e as chamadas estão suspensas."""
+
+
+def codigo_http(erro):
+    """Código HTTP de um erro da API (atributo `code` ou `status_code`), ou None se não houver."""
+    codigo = getattr(erro, "code", None) or getattr(erro, "status_code", None)
+    return codigo if isinstance(codigo, int) else None
+
+
+def erro_de_transporte(erro):
+    """
+    Indica se `erro` é uma falha de rede do cliente HTTP usado pelo SDK do Gemini (httpx):
+    DNS, conexão recusada, prazo de leitura etc. Essas exceções não herdam de
+    `ConnectionError` nem de `TimeoutError` e não têm código HTTP.
+    """
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(erro, httpx.TransportError)
+
+
+def erro_recuperavel(erro):
+    """
+    Indica se vale a pena repetir uma chamada que falhou com `erro`: prazos esgotados, falhas
+    de conexão ou de rede e erros HTTP passageiros (408, 429 e 5xx). Erros do pedido
+    (ex.: 400) e erros desconhecidos não são repetidos.
+    """
+    if isinstance(erro, (ErroPrazoModelo, TimeoutError, ConnectionError)) or erro_de_transporte(erro):
+        return True
+    return codigo_http(erro) in CODIGOS_RECUPERAVEIS
+
+
+def erro_do_pedido(erro):
+    """
+    Indica se `erro` é um erro do próprio pedido (HTTP 4xx, exceto 408 e 429), e não do serviço.
+    Só esses erros deixam de contar como falha no disjuntor.
+    """
+    codigo = codigo_http(erro)
+    return codigo is not None and 400 <= codigo < 500 and codigo not in CODIGOS_RECUPERAVEIS
+
+
+class Disjuntor:
+    """
+    Disjuntor (circuit breaker) das chamadas ao modelo.
+
+    Fechado, deixa todas as chamadas passarem. Após `limite_falhas` falhas seguidas (qualquer
+    erro que não seja do pedido, veja `erro_do_pedido`), abre e recusa as chamadas na hora durante `espera` segundos. Depois disso deixa passar
+    uma única chamada de teste (meio aberto): se ela der certo, fecha; se falhar, abre de novo.
+    """
+
+    def __init__(self, limite_falhas=DISJUNTOR_FALHAS, espera=DISJUNTOR_ESPERA_SEGUNDOS):
+        self.limite_falhas = limite_falhas
+        self.espera = espera
+        self.falhas_seguidas = 0
+        self.aberto_em = None
+        self.teste_em_andamento = False
+        self.trava = threading.Lock()
+
+    @property
+    def estado(self):
+        if self.aberto_em is None:
+            return "fechado"
+        return "aberto" if time.monotonic() - self.aberto_em < self.espera else "meio_aberto"
+
+    def permitir(self):
+        """Retorna True se a chamada pode ser feita agora."""
+        with self.trava:
+            estado = self.estado
+            if estado == "fechado":
+                return True
+            if estado == "meio_aberto" and not self.teste_em_andamento:
+                self.teste_em_andamento = True
+                return True
+            return False
+
+    def liberar_teste(self):
+        """Desiste da chamada autorizada por `permitir` sem que ela tenha sido feita."""
+        with self.trava:
+            self.teste_em_andamento = False
+
+    def registrar_sucesso(self):
+        with self.trava:
+            self.falhas_seguidas = 0
+            self.aberto_em = None
+            self.teste_em_andamento = False
+
+    def registrar_falha(self):
+        with self.trava:
+            self.falhas_seguidas += 1
+            if self.teste_em_andamento or self.falhas_seguidas >= self.limite_falhas:
+                if self.aberto_em is None or self.teste_em_andamento:
+                    print(f"⚠️ Gemini indisponível após {self.falhas_seguidas} falhas seguidas; "
+                          f"chamadas suspensas por {self.espera:g} s.")
+                self.aberto_em = time.monotonic()
+            self.teste_em_andamento = False
+
+
+class ChamadorResiliente:
+    """
+    Executa as chamadas ao backend do modelo com prazo, novas tentativas e disjuntor.
+
+    - Cada tentativa roda em uma thread própria e é abandonada se passar de `prazo` segundos.
+    - Erros recuperáveis (`erro_recuperavel`) são repetidos até `tentativas` vezes, com espera
+      exponencial com variação aleatória, sem ultrapassar `prazo_total`. Chamadas do modo lote
+      (`PRIORIDADE_LOTE`) têm uma única tentativa aqui: o lote repete o item por conta própria.
+    - Com o `disjuntor` aberto, a chamada falha na hora com `ErroCircuitoAberto`.
+    - Se `percentil_duplicacao` for maior que zero, uma chamada que demora mais que esse
+      percentil das latências recentes é duplicada, e vale a primeira resposta.
+
+    Só o backend é chamado aqui, não a sessão, para que repetir ou duplicar uma chamada não
+    registre a pergunta duas vezes no histórico da conversa.
+    """
+
+    def __init__(self, prazo=PRAZO_MODELO_SEGUNDOS, prazo_total=PRAZO_TOTAL_MODELO_SEGUNDOS,
+                 tentativas=TENTATIVAS_MODELO, disjuntor=None, percentil_duplicacao=PERCENTIL_DUPLICACAO,
+                 max_threads=64):
+        self.prazo = prazo
+        self.prazo_total = prazo_total
+        self.tentativas = tentativas
+        self.disjuntor = disjuntor or Disjuntor()
+        self.percentil_duplicacao = percentil_duplicacao
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="modelo")
+        self.latencias = deque(maxlen=200) # Latências recentes das chamadas bem-sucedidas
+
+    def _atraso_duplicacao(self):
+        # Só duplica quando já há latências suficientes para estimar o percentil
+        if self.percentil_duplicacao <= 0 or len(self.latencias) < 20:
+            return None
+        ordenadas = sorted(self.latencias)
+        return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * self.percentil_duplicacao / 100))]
+
+    def _espera_nova_tentativa(self, tentativa):
+        return ESPERA_BASE_SEGUNDOS * 2 ** (tentativa - 1) * random.uniform(0.5, 1.5)
+
+    def executar(self, funcao, *args, tokens_estimados=0):
+        """
+        Chama `funcao(*args)` (ex.: `backend.gerar`) com prazo, novas tentativas e disjuntor.
+        Cada tentativa espera sua vez no `agendador_modelo`, com `tokens_estimados` de cota.
+
+        Raises:
+            ErroCircuitoAberto: Se o disjuntor estiver aberto.
+            ErroPrazoModelo: Se a última tentativa não terminou no prazo.
+            Exception: O erro da última tentativa, se não for recuperável ou as tentativas acabarem.
+        """
+        limite = time.monotonic() + self.prazo_total
+        tentativa = 0
+        while True:
+            limite = self._obter_vez(limite, tokens_estimados)
+            tentativa += 1
+            registrar_no_rastro(tentativas=1)
+            inicio = time.monotonic()
+            try:
+                resultado = self._tentar(funcao, args, min(self.prazo, limite - inicio), tokens_estimados)
+            except Exception as e:
+                recuperavel = erro_recuperavel(e)
+                metricas.incrementar("ceaf_modelo_chamadas_total", resultado=e.__class__.__name__)
+                self._registrar_erro_cota(e)
+                if erro_do_pedido(e):
+                    # Erro do pedido, não do serviço: libera o teste do disjuntor sem contar como falha
+                    self.disjuntor.liberar_teste()
+                else:
+                    self.disjuntor.registrar_falha()
+                espera = self._espera_nova_tentativa(tentativa)
+                if not recuperavel or tentativa >= self._tentativas() or time.monotonic() + espera >= limite:
+                    raise
+                time.sleep(espera)
+                continue
+            self.latencias.append(time.monotonic() - inicio)
+            self.disjuntor.registrar_sucesso()
+            metricas.incrementar("ceaf_modelo_chamadas_total", resultado="ok")
+            self._corrigir_cota(getattr(resultado, "usage_metadata", None), tokens_estimados)
+            return resultado
+
+    def _tentativas(self):
+        # O modo lote repete os itens por conta própria, respeitando seu limite por minuto
+        return 1 if prioridade_modelo.get() == PRIORIDADE_LOTE else self.tentativas
+
+    def _obter_vez(self, limite, tokens_estimados):
+        """
+        Verifica o disjuntor e espera a vez no `agendador_modelo`. Com o disjuntor aberto, falha
+        na hora, sem entrar na fila nem gastar cota.
+
+        Returns:
+            float: O prazo final da chamada. A espera do lote na fila não conta no prazo, já que
+            ele aceita esperar; a das chamadas interativas conta.
+
+        Raises:
+            ErroCircuitoAberto: Se o disjuntor estiver aberto.
+            ErroPrazoModelo: Se o prazo acabar antes da vez (a cota reservada é devolvida).
+        """
+        if not self.disjuntor.permitir():
+            metricas.incrementar("ceaf_modelo_chamadas_total", resultado="circuito_aberto")
+            raise ErroCircuitoAberto("Chamadas ao Gemini suspensas após falhas seguidas.")
+        inicio_espera = time.monotonic()
+        try:
+            agendador_modelo.reservar(tokens_estimados, limite)
+        except Exception:
+            self.disjuntor.liberar_teste()
+            raise
+        if prioridade_modelo.get() != PRIORIDADE_INTERATIVA:
+            limite += time.monotonic() - inicio_espera
+        if limite <= time.monotonic():
+            agendador_modelo.devolver(tokens_estimados)
+            self.disjuntor.liberar_teste()
+            raise ErroPrazoModelo("O prazo da chamada acabou antes da vez na fila do Gemini.")
+        return limite
+
+    @staticmethod
+    def _registrar_erro_cota(erro):
+        # Um 429 indica que a cota real acabou: todos esperam um pouco em vez de insistir
+        if codigo_http(erro) == 429:
+            agendador_modelo.pausar()
+
+    @staticmethod
+    def _corrigir_cota(uso, tokens_estimados):
+        total = (getattr(uso, "prompt_token_count", None) or 0) + (getattr(uso, "candidates_token_count", None) or 0)
+        if total and tokens_estimados:
+            agendador_modelo.ajustar_tokens(total - tokens_estimados)
 
-try:
-    # Tenta inicializar o cliente
-    # Use genai diretamente, como você importou no código completo
-    client = genai.Client() # Mantendo genai_google conforme seu código original
+    def _tentar(self, funcao, args, prazo, tokens_estimados=0):
+        from concurrent.futures import FIRST_COMPLETED, wait
+        limite = time.monotonic() + prazo
+        pendentes = {self.executor.submit(funcao, *args)}
+        atraso = self._atraso_duplicacao()
+        if atraso is not None and atraso < prazo:
+            concluidas, pendentes = wait(pendentes, timeout=atraso)
+            # A chamada duplicada só é feita se houver cota sobrando, sem passar ninguém na fila
+            if not concluidas and agendador_modelo.tentar_reservar(tokens_estimados):
+                metricas.incrementar("ceaf_modelo_duplicadas_total")
+                pendentes.add(self.executor.submit(funcao, *args))
+            elif concluidas:
+                pendentes = concluidas
+        primeiro_erro = None
+        while pendentes:
+            concluidas, pendentes = wait(pendentes, timeout=max(0.0, limite - time.monotonic()),
+                                         return_when=FIRST_COMPLETED)
+            if not concluidas:
+                break
+            for futuro in concluidas:
+                if futuro.exception() is None:
+                    return futuro.result()
+                primeiro_erro = primeiro_erro or futuro.exception()
+        if primeiro_erro is not None and not pendentes:
+            raise primeiro_erro
+        raise ErroPrazoModelo(f"O Gemini não respondeu em {prazo:.1f} s.")
 
-    # Cria a sessão de chat diretamente usando client.chats.create
-    # O objeto retornado por client.chats.create JÁ É a sessão de chat
-    chat_session = client.chats.create(model=MODEL_ID) # <-- CORREÇÃO AQUI: Atribui o resultado diretamente a chat_session
+    def executar_em_trechos(self, funcao_geradora, *args, tokens_estimados=0):
+        """
+        Versão em streaming de `executar`: repassa os trechos de `funcao_geradora(*args)`.
+
+        O prazo vale para a espera de cada trecho. Uma nova tentativa só é feita se a falha
+        ocorrer antes do primeiro trecho, para não repetir texto já entregue ao usuário.
+        """
+        limite = time.monotonic() + self.prazo_total
+        tentativa = 0
+        while True:
+            limite = self._obter_vez(limite, tokens_estimados)
+            tentativa += 1
+            registrar_no_rastro(tentativas=1)
+            entregou = False
+            uso = None
+            try:
+                for trecho in self._trechos_com_prazo(funcao_geradora, args):
+                    entregou = True
+                    uso = getattr(trecho, "usage_metadata", None) or uso
+                    yield trecho
+            except Exception as e:
+                recuperavel = erro_recuperavel(e)
+                metricas.incrementar("ceaf_modelo_chamadas_total", resultado=e.__class__.__name__)
+                self._registrar_erro_cota(e)
+                if erro_do_pedido(e):
+                    self.disjuntor.liberar_teste()
+                else:
+                    self.disjuntor.registrar_falha()
+                espera = self._espera_nova_tentativa(tentativa)
+                if entregou or not recuperavel or tentativa >= self._tentativas() or time.monotonic() + espera >= limite:
+                    raise
+                time.sleep(espera)
+                continue
+            self.disjuntor.registrar_sucesso()
+            metricas.incrementar("ceaf_modelo_chamadas_total", resultado="ok")
+            self._corrigir_cota(uso, tokens_estimados)
+            return
+
+    def _trechos_com_prazo(self, funcao_geradora, args):
+        # O gerador roda em outra thread e entrega os trechos por uma fila, para que a espera tenha prazo
+        fila = queue.Queue()
+        fim = object()
+
+        def produzir():
+            try:
+                for trecho in funcao_geradora(*args):
+                    fila.put((trecho, None))
+                fila.put((fim, None))
+            except Exception as e:
+                fila.put((None, e))
+
+        self.executor.submit(produzir)
+        while True:
+            try:
+                trecho, erro = fila.get(timeout=self.prazo)
+            except queue.Empty:
+                raise ErroPrazoModelo(f"O Gemini parou de responder por {self.prazo:.1f} s.") from None
+            if erro is not None:
+                raise erro
+            if trecho is fim:
+                return
+            yield trecho
+
+
+chamador_modelo = ChamadorResiliente()
+
+
+# --- Agendador das Chamadas ao Modelo (cotas, prioridades e agrupamento) ---
+# Cotas do Gemini por minuto (requisições e tokens); 0 desativa o respectivo limite
+LIMITE_REQUISICOES_POR_MINUTO = float(os.environ.get("CEAF_LIMITE_RPM", "0"))
+LIMITE_TOKENS_POR_MINUTO = float(os.environ.get("CEAF_LIMITE_TPM", "0"))
+RAJADA_SEGUNDOS = 10 # As cotas podem ser gastas de uma vez até o equivalente a este tempo
+PAUSA_APOS_429_SEGUNDOS = float(os.environ.get("CEAF_PAUSA_429", "2")) # Pausa geral quando a API responde 429
+# Arquivo SQLite onde o saldo das cotas é compartilhado entre os processos (servidor, lote, terminal)
+# que usam a mesma chave de API; vazio faz cada processo controlar sua própria cota
+ARQUIVO_COTAS = os.environ.get("CEAF_ARQUIVO_COTAS", "cotas_gemini.sqlite3")
+# Fração das cotas que o modo lote deixa livre para as conversas, inclusive as de outros processos
+RESERVA_INTERATIVA = float(os.environ.get("CEAF_RESERVA_INTERATIVA", "0.2"))
+TOKENS_RESPOSTA_ESTIMADOS = 400 # Estimativa da resposta, corrigida pelo uso real após a chamada
+PRIORIDADE_INTERATIVA = 0
+PRIORIDADE_LOTE = 1
+NOMES_PRIORIDADES = {PRIORIDADE_INTERATIVA: "interativa", PRIORIDADE_LOTE: "lote"}
+
+prioridade_modelo = contextvars.ContextVar("prioridade_modelo", default=PRIORIDADE_INTERATIVA)
+
+
+class BaldeTokens:
+    """
+    Limitador de taxa do tipo "balde de fichas": cada chamada consome fichas, que são
+    repostas continuamente a `taxa_por_segundo`, até a `capacidade` do balde.
+    """
+
+    def __init__(self, taxa_por_segundo, capacidade=None):
+        self.taxa_por_segundo = taxa_por_segundo
+        self.capacidade = capacidade if capacidade is not None else max(1.0, taxa_por_segundo)
+        self.fichas = self.capacidade
+        self.ultima_reposicao = self._agora()
+        self.trava = threading.Lock()
+
+    @staticmethod
+    def _agora():
+        return time.monotonic()
+
+    @contextlib.contextmanager
+    def _saldo(self):
+        # Dá acesso exclusivo ao saldo, já reposto até agora
+        with self.trava:
+            self._repor()
+            yield
+
+    def _repor(self):
+        agora = self._agora()
+        self.fichas = min(self.capacidade, self.fichas + max(0.0, agora - self.ultima_reposicao) * self.taxa_por_segundo)
+        self.ultima_reposicao = agora
+
+    def tempo_de_espera(self, quantidade=1):
+        """
+        Consome `quantidade` fichas e retorna quantos segundos o chamador deve esperar antes de
+        prosseguir (0 se havia fichas suficientes). O saldo pode ficar negativo: as próximas
+        chamadas esperam proporcionalmente, o que mantém a ordem de chegada.
+        """
+        with self._saldo():
+            self.fichas -= quantidade
+            if self.fichas >= 0 or self.taxa_por_segundo <= 0:
+                return 0.0
+            return -self.fichas / self.taxa_por_segundo
+
+    def disponivel_em(self, quantidade=1, reserva=0.0):
+        """
+        Retorna em quantos segundos haverá `quantidade` fichas (limitada à capacidade), sem
+        consumi-las. Com `reserva`, exige que essa quantidade de fichas continue sobrando.
+        """
+        with self._saldo():
+            falta = min(quantidade + reserva, self.capacidade) - self.fichas
+            if falta <= 0 or self.taxa_por_segundo <= 0:
+                return 0.0
+            return falta / self.taxa_por_segundo
+
+    def ajustar(self, quantidade):
+        """Devolve (quantidade positiva) ou cobra (negativa) fichas, como na correção de uma estimativa."""
+        with self._saldo():
+            self.fichas = min(self.capacidade, self.fichas + quantidade)
+
+    def pausar(self, segundos):
+        """Esvazia o balde para que nenhuma ficha fique disponível pelos próximos `segundos`."""
+        with self._saldo():
+            self.fichas = min(self.fichas, -segundos * self.taxa_por_segundo)
+
+    def consumir(self, quantidade=1):
+        """Consome fichas, bloqueando a thread até que estejam disponíveis."""
+        espera = self.tempo_de_espera(quantidade)
+        if espera > 0:
+            time.sleep(espera)
+
+
+class BaldeCompartilhado(BaldeTokens):
+    """
+    `BaldeTokens` cujo saldo fica em uma linha de um banco SQLite, para que todos os processos
+    que usam a mesma cota (o servidor e um lote rodando ao mesmo tempo, por exemplo) consumam
+    do mesmo balde. Cada operação lê e grava o saldo em uma transação exclusiva. Se o banco
+    falhar, o processo continua com o saldo local.
+    """
+
+    def __init__(self, arquivo, nome, taxa_por_segundo, capacidade=None):
+        super().__init__(taxa_por_segundo, capacidade)
+        self.arquivo = arquivo
+        self.nome = nome
+        self.conexao = None # Aberta no primeiro uso, como a do cache de respostas
+        self.erro_avisado = False
+
+    @staticmethod
+    def _agora():
+        return time.time() # O relógio monotônico não é comparável entre processos
+
+    def _abrir_conexao(self):
+        if self.arquivo:
+            arquivo, self.arquivo = self.arquivo, None
+            try:
+                self.conexao = sqlite3.connect(arquivo, timeout=5, isolation_level=None, check_same_thread=False)
+                self.conexao.execute("PRAGMA journal_mode=WAL")
+                self.conexao.execute(
+                    "CREATE TABLE IF NOT EXISTS baldes (nome TEXT PRIMARY KEY, fichas REAL NOT NULL, atualizado_em REAL NOT NULL)"
+                )
+            except sqlite3.Error as e:
+                self._registrar_erro(e)
+                self.conexao = None
+        return self.conexao
+
+    def _registrar_erro(self, erro):
+        if not self.erro_avisado:
+            self.erro_avisado = True
+            print(f"⚠️ Cota compartilhada indisponível ({erro}). Este processo controla sua própria cota.")
+
+    @contextlib.contextmanager
+    def _saldo(self):
+        with self.trava:
+            conexao = self.conexao or self._abrir_conexao()
+            em_transacao = False
+            if conexao is not None:
+                try:
+                    conexao.execute("BEGIN IMMEDIATE")
+                    em_transacao = True
+                    linha = conexao.execute("SELECT fichas, atualizado_em FROM baldes WHERE nome = ?", (self.nome,)).fetchone()
+                    if linha is not None:
+                        self.fichas, self.ultima_reposicao = linha
+                except sqlite3.Error as e:
+                    self._registrar_erro(e)
+            self._repor()
+            try:
+                yield
+            finally:
+                if em_transacao:
+                    try:
+                        conexao.execute("INSERT OR REPLACE INTO baldes (nome, fichas, atualizado_em) VALUES (?, ?, ?)",
+                                        (self.nome, self.fichas, self.ultima_reposicao))
+                        conexao.execute("COMMIT")
+                    except sqlite3.Error as e:
+                        self._registrar_erro(e)
+                        with contextlib.suppress(sqlite3.Error):
+                            conexao.execute("ROLLBACK")
+
+
+def estimar_tokens_requisicao(mensagens, instrucoes=None):
+    """Estimativa dos tokens de uma requisição ao modelo (entrada e resposta), para as cotas por minuto."""
+    return (estimar_tokens(instrucoes or "") + sum(estimar_tokens(texto) for _, texto in mensagens)
+            + TOKENS_RESPOSTA_ESTIMADOS)
+
+
+class AgendadorModelo:
+    """
+    Ponto único de passagem das chamadas ao modelo, para respeitar as cotas do Gemini.
+
+    Antes de cada chamada, `reservar` espera a vez em uma fila de prioridades (conversas
+    interativas à frente do modo lote; mesma prioridade, ordem de chegada) até que haja
+    cota de requisições e de tokens por minuto (um balde de fichas para cada). Quando a API
+    responde 429, `pausar` suspende as chamadas por alguns segundos em vez de deixar
+    todas falharem em sequência.
+
+    A fila é de cada processo, mas com `arquivo` os baldes são compartilhados
+    (`BaldeCompartilhado`): um `--lote` rodando ao lado do `--servidor` gasta da mesma cota,
+    e deixa sempre uma fração `reserva_interativa` dela livre para as conversas.
+    """
+
+    def __init__(self, limite_rpm=LIMITE_REQUISICOES_POR_MINUTO, limite_tpm=LIMITE_TOKENS_POR_MINUTO,
+                 arquivo=ARQUIVO_COTAS, reserva_interativa=RESERVA_INTERATIVA):
+        self.balde_requisicoes = self._criar_balde(arquivo, "requisicoes", limite_rpm)
+        self.balde_tokens = self._criar_balde(arquivo, "tokens", limite_tpm)
+        self.reserva_interativa = reserva_interativa
+        self.fila = [] # Heap de (prioridade, ordem de chegada)
+        self.sequencia = itertools.count()
+        self.condicao = threading.Condition()
+
+    @staticmethod
+    def _criar_balde(arquivo, nome, limite_por_minuto):
+        if limite_por_minuto <= 0:
+            return None
+        taxa = limite_por_minuto / 60
+        capacidade = max(1.0, taxa * RAJADA_SEGUNDOS)
+        if arquivo:
+            return BaldeCompartilhado(arquivo, nome, taxa, capacidade=capacidade)
+        return BaldeTokens(taxa, capacidade=capacidade)
+
+    def _espera_necessaria(self, tokens, prioridade=PRIORIDADE_INTERATIVA):
+        espera = 0.0
+        fracao = self.reserva_interativa if prioridade != PRIORIDADE_INTERATIVA else 0.0
+        if self.balde_requisicoes is not None:
+            espera = self.balde_requisicoes.disponivel_em(1, reserva=fracao * self.balde_requisicoes.capacidade)
+        if self.balde_tokens is not None:
+            espera = max(espera, self.balde_tokens.disponivel_em(tokens, reserva=fracao * self.balde_tokens.capacidade))
+        return espera
+
+    def _consumir(self, tokens):
+        if self.balde_requisicoes is not None:
+            self.balde_requisicoes.tempo_de_espera(1)
+        if self.balde_tokens is not None:
+            self.balde_tokens.tempo_de_espera(tokens)
+
+    def reservar(self, tokens, limite=None):
+        """
+        Espera a vez e a cota para uma chamada de cerca de `tokens` tokens. A prioridade vem de
+        `prioridade_modelo` (interativa, a menos que o chamador esteja no modo lote).
+
+        Args:
+            tokens (int): Estimativa de tokens da chamada (`estimar_tokens_requisicao`).
+            limite (float, optional): Instante (`time.monotonic`) até o qual uma chamada interativa
+                aceita esperar. Chamadas do lote esperam o quanto for preciso.
+
+        Raises:
+            ErroPrazoModelo: Se a vez de uma chamada interativa não chegar até `limite`.
+        """
+        prioridade = prioridade_modelo.get()
+        if self.balde_requisicoes is None and self.balde_tokens is None:
+            return
+        if prioridade != PRIORIDADE_INTERATIVA:
+            limite = None
+        inicio = time.monotonic()
+        with self.condicao:
+            pedido = (prioridade, next(self.sequencia))
+            heapq.heappush(self.fila, pedido)
+            try:
+                while True:
+                    espera = None
+                    if self.fila[0] == pedido:
+                        espera = self._espera_necessaria(tokens, prioridade)
+                        if espera <= 0:
+                            self._consumir(tokens)
+                            break
+                    if limite is not None:
+                        restante = limite - time.monotonic()
+                        if restante <= 0:
+                            metricas.incrementar("ceaf_agendador_desistencias_total")
+                            raise ErroPrazoModelo("Cota de chamadas ao Gemini esgotada; a vez não chegou a tempo.")
+                        espera = min(espera, restante) if espera is not None else restante
+                    self.condicao.wait(espera)
+            finally:
+                self.fila.remove(pedido)
+                heapq.heapify(self.fila)
+                self.condicao.notify_all()
+        metricas.observar("ceaf_agendador_espera_segundos", time.monotonic() - inicio,
+                          prioridade=NOMES_PRIORIDADES.get(prioridade, prioridade))
+
+    def tentar_reservar(self, tokens):
+        """Reserva cota apenas se ela estiver livre agora e ninguém estiver na fila (para chamadas opcionais)."""
+        with self.condicao:
+            if self.fila or self._espera_necessaria(tokens) > 0:
+                return False
+            self._consumir(tokens)
+            return True
+
+    def devolver(self, tokens):
+        """Devolve a cota reservada para uma chamada que acabou não sendo feita."""
+        if self.balde_requisicoes is not None:
+            self.balde_requisicoes.ajustar(1)
+        if self.balde_tokens is not None:
+            self.balde_tokens.ajustar(tokens)
+
+    def ajustar_tokens(self, diferenca):
+        """Corrige a cota de tokens com o uso real de uma chamada (`diferenca` = real - estimado)."""
+        if self.balde_tokens is not None and diferenca:
+            self.balde_tokens.ajustar(-diferenca)
+
+    def pausar(self, segundos=PAUSA_APOS_429_SEGUNDOS):
+        """Suspende novas chamadas por alguns segundos (após um 429 da API)."""
+        if self.balde_requisicoes is not None:
+            self.balde_requisicoes.pausar(segundos)
+            metricas.incrementar("ceaf_agendador_pausas_total")
+
+    def __len__(self):
+        return len(self.fila)
+
+
+class AgrupadorChamadas:
+    """
+    Agrupa chamadas idênticas em andamento ("single flight"): se a mesma pergunta normalizada
+    (a mesma chave do cache) já está sendo respondida pelo Gemini, quem chega depois espera
+    essa resposta em vez de fazer outra chamada.
+    """
+
+    class _Chamada:
+        def __init__(self):
+            self.concluida = threading.Event()
+            self.resultado = None
+            self.erro = None
+
+    def __init__(self):
+        self.chamadas = {}
+        self.trava = threading.Lock()
+
+    def iniciar(self, chave):
+        """
+        Returns:
+            tuple: (chamada, lider). Se `lider` for True, o chamador faz a chamada ao modelo e
+            depois chama `concluir`; caso contrário, deve esperar com `aguardar`.
+        """
+        with self.trava:
+            chamada = self.chamadas.get(chave)
+            if chamada is not None:
+                metricas.incrementar("ceaf_modelo_agrupadas_total")
+                return chamada, False
+            chamada = self.chamadas[chave] = self._Chamada()
+            return chamada, True
+
+    def concluir(self, chave, chamada, resultado=None, erro=None):
+        """Publica o resultado (ou o erro) da chamada para quem a está esperando."""
+        with self.trava:
+            if self.chamadas.get(chave) is chamada:
+                del self.chamadas[chave]
+        chamada.resultado = resultado
+        chamada.erro = erro
+        chamada.concluida.set()
+
+    @staticmethod
+    def aguardar(chamada, prazo=None):
+        """Espera o resultado da chamada de outro usuário, repassando o erro dela, se houver."""
+        if not chamada.concluida.wait(prazo):
+            raise ErroPrazoModelo("A chamada agrupada não terminou no prazo.")
+        if chamada.erro is not None:
+            raise chamada.erro
+        return chamada.resultado
+
+
+agendador_modelo = AgendadorModelo()
+agrupador_chamadas = AgrupadorChamadas()
+
+
+# --- Contexto da Conversa com o Gemini ---
+# Instruções de sistema: enviadas uma única vez por requisição, fora do histórico da conversa.
+PERSONA_ASSISTENTE = """Você é um assistente virtual especializado na Assistência Farmacêutica do Componente Especializado (Alto Custo) de Tatuí, São Paulo.
+Sua principal função é fornecer informações claras e precisas sobre documentação, medicamentos disponíveis, horários e processos relacionados a ESTE SERVIÇO EM TATUÍ.
+Seja cordial e prestativo.
+Se a pergunta for sobre um tema claramente fora do escopo da assistência farmacêutica de Tatuí (ex: política nacional, outros municípios),
+informe educadamente que você só pode ajudar com questões relacionadas ao serviço de Tatuí.
+Priorize informações oficiais.
+Forneça respostas úteis e concisas."""
+
+CONTEXTO_MAX_TOKENS = int(os.environ.get("CEAF_CONTEXTO_MAX_TOKENS", "2000")) # Orçamento do histórico enviado a cada pergunta
+# Como tratar as mensagens que saem da janela: "local" (resumo curto com as perguntas anteriores),
+# "modelo" (resumo gerado pelo Gemini, uma chamada extra) ou "" (apenas descarta)
+CONTEXTO_RESUMO = os.environ.get("CEAF_CONTEXTO_RESUMO", "local")
+RESUMO_MAX_TOKENS = int(os.environ.get("CEAF_RESUMO_MAX_TOKENS", "200"))
+REGISTRAR_TOKENS = bool(os.environ.get("CEAF_LOG_TOKENS")) # Imprime os tokens de cada pergunta/resposta
+
+
+def estimar_tokens(texto):
+    """
+    Estimativa rápida da quantidade de tokens de um texto (cerca de 4 caracteres por token),
+    usada para manter o histórico dentro do orçamento sem chamar a API de contagem.
+    """
+    return len(texto) // 4 + 1
+
+
+class GerenciadorContexto:
+    """
+    Sessão de chat com o Gemini de custo limitado por pergunta.
+
+    Substitui `client.chats.create`, que reenviava o histórico inteiro (com o prompt completo
+    de cada pergunta) para sempre. Aqui a persona vai como instrução de sistema, e o histórico
+    enviado fica dentro de `max_tokens`: as mensagens mais antigas saem da janela e, se
+    `modo_resumo` estiver ativo, são condensadas em um resumo curto anexado às instruções.
+    O resumo feito pelo modelo é gerado em uma thread à parte, depois que a resposta já foi
+    entregue; até ele ficar pronto, as perguntas seguintes vão com o resumo anterior.
+
+    Oferece os mesmos métodos usados da sessão do SDK (`send_message` e `send_message_stream`),
+    e envia as requisições pelo `backend` (Gemini ou simulado).
+    """
+
+    def __init__(self, backend, instrucoes=PERSONA_ASSISTENTE,
+                 max_tokens=CONTEXTO_MAX_TOKENS, modo_resumo=CONTEXTO_RESUMO):
+        self.backend = backend
+        self.instrucoes = instrucoes
+        self.max_tokens = max_tokens
+        self.modo_resumo = modo_resumo
+        self.historico = [] # Lista de (papel, texto), papel = 'user' ou 'model'
+        self.resumo = ""
+        self.removidas_pendentes = [] # Mensagens que saíram da janela e aguardam o resumo do modelo
+        self.resumindo = False
+        self.trava = threading.Lock()
+        self.tokens_por_turno = [] # Dicionários com as contagens de tokens de cada pergunta
+
+    def send_message(self, mensagem, referencias=""):
+        """
+        Envia uma mensagem com o histórico limitado e retorna a resposta do SDK (com `.text`).
+        `referencias` (trechos de referência recuperados para a pergunta) vai apenas nesta
+        requisição, junto com as instruções, e não entra no histórico.
+        """
+        mensagens, instrucoes = self._montar_requisicao(mensagem, referencias)
+        resposta = chamador_modelo.executar(self.backend.gerar, mensagens, instrucoes,
+                                            tokens_estimados=estimar_tokens_requisicao(mensagens, instrucoes))
+        self._registrar_turno(mensagem, resposta.text or "", getattr(resposta, "usage_metadata", None))
+        return resposta
+
+    def send_message_stream(self, mensagem, referencias=""):
+        """
+        Versão em streaming de `send_message`. A mensagem e a resposta completa entram no
+        histórico apenas quando o streaming termina.
+
+        Yields:
+            Os trechos da resposta do SDK (com `.text`).
+        """
+        mensagens, instrucoes = self._montar_requisicao(mensagem, referencias)
+        trechos = []
+        uso = None
+        for chunk in chamador_modelo.executar_em_trechos(self.backend.gerar_em_trechos, mensagens, instrucoes,
+                                                         tokens_estimados=estimar_tokens_requisicao(mensagens, instrucoes)):
+            uso = getattr(chunk, "usage_metadata", None) or uso
+            if chunk.text:
+                trechos.append(chunk.text)
+            yield chunk
+        self._registrar_turno(mensagem, "".join(trechos), uso)
+
+    def tem_contexto(self):
+        """Indica se a sessão já tem histórico ou resumo, que vão junto com cada nova pergunta."""
+        with self.trava:
+            return bool(self.historico or self.resumo)
+
+    def _montar_requisicao(self, mensagem, referencias=""):
+        with self.trava:
+            instrucoes = self.instrucoes
+            if self.resumo:
+                instrucoes += f"\n\nResumo da conversa anterior com este usuário: {self.resumo}"
+            if referencias:
+                instrucoes += f"\n\n{referencias}"
+            mensagens = self.historico + [("user", mensagem)]
+        return mensagens, instrucoes
+
+    def _registrar_turno(self, mensagem, resposta, uso):
+        with self.trava:
+            self.historico.append(("user", mensagem))
+            self.historico.append(("model", resposta))
+            removidas = self._aplicar_janela()
+            tokens = {
+                "prompt": getattr(uso, "prompt_token_count", None),
+                "resposta": getattr(uso, "candidates_token_count", None),
+                "historico_estimado": sum(estimar_tokens(texto) for _, texto in self.historico),
+            }
+            self.tokens_por_turno.append(tokens)
+            del self.tokens_por_turno[:-100]
+        if removidas:
+            self._atualizar_resumo(removidas)
+        if REGISTRAR_TOKENS:
+            print(f"[tokens] prompt={tokens['prompt']} resposta={tokens['resposta']} "
+                  f"histórico≈{tokens['historico_estimado']} mensagens={len(self.historico)}")
+
+    def _aplicar_janela(self):
+        # Remove pares (pergunta, resposta) do início até o histórico caber no orçamento
+        removidas = []
+        total = sum(estimar_tokens(texto) for _, texto in self.historico)
+        while total > self.max_tokens and len(self.historico) > 2:
+            for papel, texto in self.historico[:2]:
+                total -= estimar_tokens(texto)
+                removidas.append((papel, texto))
+            del self.historico[:2]
+        return removidas
+
+    def _atualizar_resumo(self, removidas):
+        if self.modo_resumo == "modelo":
+            # A chamada extra não pode atrasar a resposta (nem quem aguarda a mesma pergunta):
+            # uma thread por sessão resume as mensagens pendentes, em ordem
+            with self.trava:
+                self.removidas_pendentes.extend(removidas)
+                if self.resumindo:
+                    return
+                self.resumindo = True
+            contexto = contextvars.copy_context() # Mantém a prioridade (lote ou interativa) do turno
+            threading.Thread(target=contexto.run, args=(self._resumir_com_modelo,), name="resumo", daemon=True).start()
+            return
+        self._resumir_localmente(removidas)
+
+    def _resumir_com_modelo(self):
+        rastro_atual.set(None) # O turno que originou o resumo já foi encerrado
+        while True:
+            with self.trava:
+                removidas, self.removidas_pendentes = self.removidas_pendentes, []
+                if not removidas:
+                    self.resumindo = False
+                    return
+                resumo_anterior = self.resumo
+            try:
+                transcricao = "\n".join(f"{'Usuário' if papel == 'user' else 'Assistente'}: {texto}" for papel, texto in removidas)
+                pedido = (f"Resuma em até {RESUMO_MAX_TOKENS * 3} caracteres os fatos relevantes desta conversa "
+                          f"(o que o usuário já perguntou e precisa), para servir de contexto.\n\n"
+                          f"Resumo anterior: {resumo_anterior or '(nenhum)'}\n\n{transcricao}")
+                resposta = chamador_modelo.executar(self.backend.gerar, [("user", pedido)],
+                                                    tokens_estimados=estimar_tokens_requisicao([("user", pedido)]))
+                novo_resumo = (resposta.text or "").strip()
+            except Exception as e:
+                print(f"⚠️ Não foi possível resumir o histórico com o Gemini: {e}")
+                novo_resumo = ""
+            if novo_resumo:
+                with self.trava:
+                    self.resumo = novo_resumo
+            else:
+                self._resumir_localmente(removidas)
+
+    def _resumir_localmente(self, removidas):
+        if self.modo_resumo in ("local", "modelo"):
+            # Resumo local: apenas as perguntas anteriores do usuário, das mais recentes para as mais antigas
+            perguntas = [" ".join(texto.split())[:120] for papel, texto in removidas if papel == "user"]
+            anteriores = [p.strip() for p in self.resumo.removeprefix("O usuário já perguntou: ").split(" | ") if p.strip()]
+            itens = perguntas[::-1] + anteriores
+            resumo = ""
+            for item in itens:
+                candidato = f"{resumo} | {item}" if resumo else item
+                if estimar_tokens(candidato) > RESUMO_MAX_TOKENS:
+                    break
+                resumo = candidato
+            with self.trava:
+                self.resumo = f"O usuário já perguntou: {resumo}" if resumo else ""
 
-    print(f"🤖 Cliente Gemini inicializado com o modelo: {MODEL_ID} e sessão de chat criada.")
-except Exception as e:
-    print(f"⚠️ Erro ao inicializar o modelo Gemini ou criar sessão de chat: {e}")
-    print("O chatbot poderá ter funcionalidades limitadas (apenas respostas pré-definidas).")
-    chat_session = None # Garante que chat_session existe mesmo em caso de falha
 
 # --- Respostas Pré-definidas Específicas de Tatuí ---
 # Dicionário contendo respostas para perguntas frequentes e específicas
@@ -154,74 +1307,1665 @@ SITES_PRIORITARIOS_ESTADUAIS = [
     "https://www.saude.sp.gov.br/ses/perfil/gestor/assistencia-farmaceutica/links-dos-medicamentos-dos-protocolos-e-normas-tecnicas-estaduais/medicamento"
 ]
 
-# --- Funções do Chatbot ---
+# --- Correspondência Aproximada com as Respostas Fixas ---
+# Frases alternativas (sinônimos) para cada chave de `respostas_fixas_tatui`.
+# Permitem que formas comuns de perguntar ("renovacao", "quais documentos pra renovar")
+# recebam a resposta pré-definida sem precisar de uma chamada ao Gemini.
+SINONIMOS_RESPOSTAS_FIXAS = {
+    "Olá": ["oi", "ola", "bom dia", "boa tarde", "boa noite", "e ai"],
+    "Tenho dúvidas sobre a documentação.": [
+        "duvidas documentacao", "duvida sobre documentos", "documentacao",
+        "quais documentos preciso", "documentos necessarios",
+    ],
+    "Nova solicitação.": [
+        "nova solicitacao", "primeira solicitacao", "primeira vez", "primeiro pedido",
+        "dar entrada no pedido", "documentos para primeira vez", "como solicitar medicamento",
+        "como pedir medicamento de alto custo", "abrir processo",
+    ],
+    "Renovação.": [
+        "renovacao", "renovar", "documentos para renovar", "renovar pedido",
+        "renovar medicamento", "renovar processo", "renovacao do medicamento",
+    ],
+    "O que significa ser legalmente incapaz?": [
+        "legalmente incapaz", "incapaz", "incapacidade legal", "o que e incapaz",
+        "pessoa incapaz",
+    ],
+    "Qual o horário de funcionamento e contato da Assistência Farmacêutica?": [
+        "horario de funcionamento", "horario de atendimento", "horario da farmacia", "que horas abre", "que horas fecha",
+        "endereco da farmacia", "telefone da farmacia", "contato da farmacia", "onde fica a farmacia",
+        "onde fica a assistencia farmaceutica",
+    ],
+    "O medicamento que preciso está disponível no programa?": [
+        "lista de medicamentos", "quais medicamentos estao disponiveis", "quais remedios o programa oferece",
+        "o remedio esta na lista", "medicamento esta no programa",
+    ],
+    "Minha receita está correta?": [
+        "receita correta", "receita valida", "validade da receita",
+        "o que precisa ter na receita", "como deve ser a receita", "prescricao correta",
+    ],
+    "Como posso acompanhar meu pedido?": [
+        "acompanhar pedido", "acompanhar meu pedido", "status do pedido",
+        "andamento do pedido", "meu pedido saiu", "consultar protocolo",
+    ],
+}
+
+# Palavras muito frequentes que não ajudam a distinguir as perguntas.
+# Negações ("nao", "sem") ficam de fora de propósito, pois mudam o sentido da pergunta.
+PALAVRAS_IRRELEVANTES = {
+    "a", "o", "as", "os", "um", "uma", "de", "da", "do", "das", "dos", "e", "em", "na", "no",
+    "nas", "nos", "para", "pra", "pro", "por", "com", "que", "qual", "quais", "eu", "meu",
+    "minha", "me", "voce", "se", "sobre", "ao", "aos", "gostaria", "queria", "saber",
+    "favor", "por favor", "preciso", "precisa",
+}
 
-def obter_resposta_gemini(pergunta_usuario):
+# Confiança mínima (0 a 1) para servir uma resposta fixa a partir de uma frase aproximada.
+LIMIAR_CORRESPONDENCIA_APROXIMADA = float(os.environ.get("CEAF_LIMIAR_CORRESPONDENCIA", "0.55"))
+
+
+def normalizar_texto(texto, remover_irrelevantes=True):
     """
-    Envia a pergunta para o modelo Gemini através da sessão de chat e retorna a resposta.
+    Normaliza um texto para comparação: remove acentos, converte para minúsculas,
+    descarta pontuação e, opcionalmente, as palavras irrelevantes.
 
     Args:
-        pergunta_usuario (str): A pergunta feita pelo usuário.
+        texto (str): O texto original.
+        remover_irrelevantes (bool): Se True, remove as palavras de `PALAVRAS_IRRELEVANTES`.
 
     Returns:
-        str: A resposta gerada pelo modelo Gemini, ou uma mensagem de erro/aviso.
+        str: Os termos normalizados, separados por um espaço.
     """
-    if not chat_session:
-        return "Desculpe, a sessão de chat com o Gemini não está ativa. Funcionalidade limitada."
+    sem_acentos = unicodedata.normalize("NFKD", texto)
+    sem_acentos = "".join(c for c in sem_acentos if not unicodedata.combining(c))
+    termos = re.findall(r"[a-z0-9]+", sem_acentos.lower())
+    if remover_irrelevantes:
+        relevantes = [t for t in termos if t not in PALAVRAS_IRRELEVANTES]
+        # Se só sobraram palavras irrelevantes ("oi", "e ai"), mantém o texto original
+        termos = relevantes or termos
+    return " ".join(termos)
 
-    # Prompt contextualizando o Gemini para atuar como assistente da Assistência Farmacêutica de Tatuí.
-    # Este prompt é enviado junto com cada pergunta do usuário para manter o contexto da conversa.
-    # Para este exemplo, vamos manter um prompt mais direto na pergunta.
 
-    prompt_completo = f"""
-    Você é um assistente virtual especializado na Assistência Farmacêutica do Componente Especializado (Alto Custo) de Tatuí, São Paulo.
-    Sua principal função é fornecer informações claras e precisas sobre documentação, medicamentos disponíveis, horários e processos relacionados a ESTE SERVIÇO EM TATUÍ.
-    Seja cordial e prestativo.
-    Se a pergunta for sobre um tema claramente fora do escopo da assistência farmacêutica de Tatuí (ex: política nacional, outros municípios),
-    informe educadamente que você só pode ajudar com questões relacionadas ao serviço de Tatuí.
-    Priorize informações oficiais.
+def gerar_trigramas(texto_normalizado):
+    """
+    Gera o conjunto de trigramas de caracteres de cada termo de um texto já normalizado.
+    Os termos recebem espaços nas bordas para que início e fim de palavra pesem na comparação.
 
-    Pergunta do Usuário: "{pergunta_usuario}"
+    Args:
+        texto_normalizado (str): Texto retornado por `normalizar_texto`.
 
-    Por favor, forneça uma resposta útil e concisa.
+    Returns:
+        set: Conjunto de trigramas.
     """
-    try:
-        # Envia a mensagem para a sessão de chat ativa
-        response = chat_session.send_message(prompt_completo)
-        return response.text # Retorna o texto da resposta do Gemini
-    except Exception as e:
-        print(f"⚠️ Erro ao enviar mensagem para o Gemini ou obter resposta: {e}")
-        return "Ocorreu um erro ao tentar processar sua pergunta com o Gemini. Tente novamente."
+    trigramas = set()
+    for termo in texto_normalizado.split():
+        termo = f"  {termo} "
+        for i in range(len(termo) - 2):
+            trigramas.add(termo[i:i + 3])
+    return trigramas
 
-def buscar_informacao_online_com_gemini(termo_de_busca, sites_especificos=None):
-    """
-    Utiliza o Gemini para buscar ou gerar informações sobre um termo específico,
-    com foco opcional em sites prioritários.
 
-    Args:
-        termo_de_busca (str): O termo ou pergunta para a busca.
-        sites_especificos (list, optional): Lista de URLs para focar a busca (informativo para o prompt).
+class IndiceTrigramas:
+    """
+    Índice invertido de trigramas de caracteres para busca aproximada de frases.
 
-    Returns:
-        str: A resposta gerada pelo Gemini.
+    A pontuação é calculada termo a termo: cada termo é comparado ao termo mais parecido
+    do outro texto (coeficiente de Dice dos trigramas, o que tolera erros de digitação),
+    com peso maior para os termos mais raros entre os valores indexados. A pontuação final
+    (entre 0 e 1) combina quanto da consulta é coberto pela frase e quanto da frase é coberto
+    pela consulta, para que uma palavra em comum ("telefone") não baste quando o resto da
+    pergunta fala de outra coisa ("telefone do meu médico").
     """
-    print(f"\n🔍 Usando Gemini para buscar informações sobre: '{termo_de_busca}'")
 
-    # Constrói uma query mais elaborada para o Gemini, indicando o foco da busca.
-    query_para_gemini = f"Preciso de informações sobre: '{termo_de_busca}'."
-    if sites_especificos:
-        query_para_gemini += f" Por favor, foque sua resposta em informações que seriam encontradas ou relacionadas aos seguintes sites (contexto estadual de São Paulo): {', '.join(sites_especificos)}."
-    else:
-        # Se não houver sites específicos, pede para focar no contexto geral do saude.sp.gov.br
-        query_para_gemini += " Por favor, foque sua resposta em informações relevantes para o sistema de saúde de São Paulo, como as encontradas no site saude.sp.gov.br."
+    LIMIAR_TERMO = 0.5 # Semelhança mínima para que dois termos sejam considerados o mesmo
 
-    # Chama a função que interage com o Gemini
-    return obter_resposta_gemini(query_para_gemini)
+    def __init__(self):
+        self.termos_por_trigrama = defaultdict(set) # trigrama -> termos do vocabulário que o contêm
+        self.trigramas_termo = {}                   # termo do vocabulário -> seus trigramas
+        self.frases_por_termo = defaultdict(list)   # termo -> ids das frases que o contêm
+        self.valores_por_termo = defaultdict(set)   # termo -> valores cujas frases contêm o termo
+        self.termos = []                            # id da frase -> termos normalizados
+        self.valores = []                           # id da frase -> valor associado
+        self.valores_distintos = set()
+        self.exatos = {}                            # texto normalizado -> id da frase
+        self.pesos = {}                             # termo -> peso (recalculado após cada adição)
 
+    def adicionar(self, frase, valor):
+        """
+        Indexa uma frase associada a um valor (por exemplo, a chave da resposta fixa).
 
-def apresentar_boas_vindas_e_opcoes():
+        Args:
+            frase (str): A frase a ser indexada.
+            valor: O valor retornado quando a frase for a melhor correspondência.
+        """
+        normalizada = normalizar_texto(frase)
+        termos = normalizada.split()
+        if not termos:
+            return
+        id_frase = len(self.valores)
+        self.valores.append(valor)
+        self.valores_distintos.add(valor)
+        self.termos.append(termos)
+        self.exatos.setdefault(normalizada, id_frase)
+        for termo in set(termos):
+            if termo not in self.trigramas_termo:
+                self.trigramas_termo[termo] = gerar_trigramas(termo)
+                for trigrama in self.trigramas_termo[termo]:
+                    self.termos_por_trigrama[trigrama].add(termo)
+            self.frases_por_termo[termo].append(id_frase)
+            self.valores_por_termo[termo].add(valor)
+        self.pesos.clear()
+
+    def _peso(self, termo):
+        # Como o IDF do BM25: termos comuns a vários valores pesam pouco; termos desconhecidos, o máximo.
+        # Conta valores, e não frases, para que os sinônimos de uma mesma resposta não diluam seus termos.
+        peso = self.pesos.get(termo)
+        if peso is None:
+            valores = self.valores_por_termo.get(termo)
+            peso = math.log(1 + len(self.valores_distintos) / (1 + (len(valores) if valores else 0)))
+            if valores:
+                self.pesos[termo] = peso
+        return peso
+
+    def _semelhantes(self, termo):
+        """Termos do vocabulário parecidos com `termo`, com a semelhança de cada um (Dice dos trigramas)."""
+        if termo in self.trigramas_termo:
+            return {termo: 1.0, **self._comparar(termo, self.trigramas_termo[termo])}
+        return self._comparar(termo, gerar_trigramas(termo))
+
+    def _comparar(self, termo, trigramas):
+        comuns = Counter()
+        for trigrama in trigramas:
+            for outro in self.termos_por_trigrama.get(trigrama, ()):
+                comuns[outro] += 1
+        semelhantes = {}
+        for outro, quantidade in comuns.items():
+            semelhanca = 2.0 * quantidade / (len(trigramas) + len(self.trigramas_termo[outro]))
+            if semelhanca >= self.LIMIAR_TERMO and outro != termo:
+                semelhantes[outro] = semelhanca
+        return semelhantes
+
+    def buscar(self, consulta, limite=1):
+        """
+        Busca as frases mais parecidas com a consulta.
+
+        Args:
+            consulta (str): O texto digitado pelo usuário.
+            limite (int): Quantidade máxima de resultados.
+
+        Returns:
+            list: Lista de tuplas (valor, pontuação), da maior para a menor pontuação.
+        """
+        normalizada = normalizar_texto(consulta)
+        if normalizada in self.exatos:
+            return [(self.valores[self.exatos[normalizada]], 1.0)]
+        termos_consulta = list(dict.fromkeys(normalizada.split()))
+        if not termos_consulta:
+            return []
+        semelhantes = [self._semelhantes(termo) for termo in termos_consulta]
+        pesos_consulta = [self._peso(termo) for termo in termos_consulta]
+        total_consulta = sum(pesos_consulta)
+        candidatas = set()
+        for termos_parecidos in semelhantes:
+            for outro in termos_parecidos:
+                candidatas.update(self.frases_por_termo[outro])
+        melhores = {}
+        for id_frase in candidatas:
+            termos_frase = self.termos[id_frase]
+            cobertura_consulta = sum(
+                peso * max((parecidos.get(termo, 0.0) for termo in termos_frase), default=0.0)
+                for peso, parecidos in zip(pesos_consulta, semelhantes)
+            ) / total_consulta
+            pesos_frase = [self._peso(termo) for termo in termos_frase]
+            cobertura_frase = sum(
+                peso * max(parecidos.get(termo, 0.0) for parecidos in semelhantes)
+                for peso, termo in zip(pesos_frase, termos_frase)
+            ) / sum(pesos_frase)
+            if not cobertura_consulta or not cobertura_frase:
+                continue
+            pontuacao = 2 * cobertura_consulta * cobertura_frase / (cobertura_consulta + cobertura_frase)
+            valor = self.valores[id_frase]
+            if pontuacao > melhores.get(valor, 0.0):
+                melhores[valor] = pontuacao
+        return sorted(melhores.items(), key=lambda item: item[1], reverse=True)[:limite]
+
+
+def construir_indice_respostas_fixas():
     """
-    Apresenta a mensagem de boas-vindas e as opções principais do menu do chatbot.
+    Monta o índice aproximado com as chaves de `respostas_fixas_tatui` e seus sinônimos.
+    A chave 'sair' fica de fora: encerrar a conversa exige o comando exato.
+
+    Returns:
+        IndiceTrigramas: O índice pronto para consulta.
+    """
+    indice = IndiceTrigramas()
+    for chave in respostas_fixas_tatui:
+        if chave == "sair":
+            continue
+        indice.adicionar(chave, chave)
+        for sinonimo in SINONIMOS_RESPOSTAS_FIXAS.get(chave, []):
+            indice.adicionar(sinonimo, chave)
+    return indice
+
+
+class EstatisticasRotas:
+    """
+    Contabiliza por qual caminho cada entrada do usuário foi respondida
+    (resposta fixa exata, aproximada, opção do menu ou Gemini).
+    """
+
+    def __init__(self):
+        self.contagem = Counter()
+
+    def registrar(self, rota):
+        """Soma uma ocorrência à rota informada."""
+        self.contagem[rota] += 1
+        metricas.incrementar("ceaf_rotas_total", rota=rota)
+
+    def relatorio(self):
+        """
+        Returns:
+            str: Resumo com a taxa de acerto de cada rota e quantas chamadas ao Gemini foram evitadas.
+        """
+        total = sum(self.contagem.values())
+        if not total:
+            return "Nenhuma entrada processada."
+        linhas = [f"{rota}: {quantidade} ({quantidade / total:.1%})" for rota, quantidade in self.contagem.most_common()]
+        evitadas = self.contagem["fixa_aproximada"] + self.contagem["catalogo"]
+        linhas.append(f"Chamadas ao Gemini evitadas (correspondência aproximada e catálogo local): {evitadas}")
+        return "\n".join(linhas)
+
+
+class EstatisticasLatencia:
+    """
+    Guarda as últimas medições de tempo (em segundos) de cada etapa, como o tempo até
+    o primeiro trecho da resposta do Gemini e o tempo total da resposta.
+    """
+
+    def __init__(self, max_amostras=1000):
+        self.max_amostras = max_amostras
+        self.amostras = defaultdict(list)
+        self.trava = threading.Lock()
+
+    def registrar(self, etapa, segundos):
+        """Adiciona uma medição à etapa, descartando as mais antigas acima do limite."""
+        metricas.observar("ceaf_gemini_latencia_segundos", segundos, etapa=etapa)
+        with self.trava:
+            medicoes = self.amostras[etapa]
+            medicoes.append(segundos)
+            if len(medicoes) > self.max_amostras:
+                del medicoes[0]
+
+    def relatorio(self):
+        """
+        Returns:
+            str: Média, mediana e percentil 95 (em ms) de cada etapa medida.
+        """
+        with self.trava:
+            copia = {etapa: sorted(medicoes) for etapa, medicoes in self.amostras.items() if medicoes}
+        if not copia:
+            return "Nenhuma medição registrada."
+        linhas = []
+        for etapa, medicoes in copia.items():
+            media = sum(medicoes) / len(medicoes)
+            p50 = medicoes[len(medicoes) // 2]
+            p95 = medicoes[min(len(medicoes) - 1, int(len(medicoes) * 0.95))]
+            linhas.append(f"{etapa}: n={len(medicoes)} média={media * 1000:.0f} ms p50={p50 * 1000:.0f} ms p95={p95 * 1000:.0f} ms")
+        return "\n".join(linhas)
+
+
+# O índice é montado uma única vez, na inicialização do script.
+indice_respostas_fixas = construir_indice_respostas_fixas()
+estatisticas_rotas = EstatisticasRotas()
+estatisticas_latencia = EstatisticasLatencia()
+
+
+def buscar_resposta_fixa(texto):
+    """
+    Procura uma resposta pré-definida para o texto, primeiro pela chave exata e depois
+    pela correspondência aproximada (sem acentos, maiúsculas ou pontuação, com sinônimos).
+
+    Args:
+        texto (str): A entrada do usuário.
+
+    Returns:
+        tuple: (resposta, rota) se houver resposta fixa, ou (None, None) caso contrário.
+    """
+    if texto in respostas_fixas_tatui:
+        return respostas_fixas_tatui[texto], "fixa_exata"
+    resultados = indice_respostas_fixas.buscar(texto)
+    if resultados and resultados[0][1] >= LIMIAR_CORRESPONDENCIA_APROXIMADA:
+        return respostas_fixas_tatui[resultados[0][0]], "fixa_aproximada"
+    return None, None
+
+
+# --- Métricas e Rastreamento ---
+# Arquivo JSONL com um registro por turno (rota, tempo de cada etapa, modelo, tokens, erros); vazio desativa
+ARQUIVO_RASTROS = os.environ.get("CEAF_ARQUIVO_RASTROS", "")
+# Exportação periódica das métricas em JSON (arquivo e intervalo em segundos); vazio desativa
+ARQUIVO_METRICAS_JSON = os.environ.get("CEAF_METRICAS_JSON", "")
+INTERVALO_METRICAS_JSON = float(os.environ.get("CEAF_METRICAS_INTERVALO", "60"))
+# Fração dos turnos cujo despacho é medido com cProfile (0 desativa) e arquivo onde o perfil é salvo
+PERFIL_AMOSTRAGEM = float(os.environ.get("CEAF_PERFIL_AMOSTRAGEM", "0"))
+ARQUIVO_PERFIL = os.environ.get("CEAF_PERFIL_ARQUIVO", "perfil_despacho.pstats")
+
+LIMITES_HISTOGRAMA = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RegistroMetricas:
+    """
+    Contadores e histogramas em memória, com rótulos, exportáveis no formato texto do
+    Prometheus (`exportar_prometheus`) ou como dicionário para JSON (`instantaneo`).
+
+    Cada registro custa apenas algumas operações de dicionário sob uma trava, para que a
+    instrumentação do caminho principal tenha custo desprezível.
+    """
+
+    def __init__(self, limites=LIMITES_HISTOGRAMA):
+        self.limites = limites
+        self.contadores = defaultdict(float) # (nome, rótulos) -> valor
+        self.histogramas = {} # (nome, rótulos) -> [contagens por faixa, soma, total]
+        self.medidores = {} # nome -> função que retorna o valor atual
+        self.trava = threading.Lock()
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        """Soma `valor` ao contador `nome` com os rótulos informados."""
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.trava:
+            self.contadores[chave] += valor
+
+    def observar(self, nome, valor, **rotulos):
+        """Registra uma medição (em segundos, normalmente) no histograma `nome`."""
+        chave = (nome, tuple(sorted(rotulos.items())))
+        faixa = bisect.bisect_left(self.limites, valor)
+        with self.trava:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = [[0] * (len(self.limites) + 1), 0.0, 0]
+            histograma[0][faixa] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    def registrar_medidor(self, nome, funcao):
+        """Registra um valor instantâneo (ex.: conversas ativas), calculado no momento da exportação."""
+        self.medidores[nome] = funcao
+
+    @staticmethod
+    def _formatar_rotulos(rotulos, extra=()):
+        pares = list(rotulos) + list(extra)
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{nome}="{str(valor).replace(chr(34), chr(39))}"' for nome, valor in pares) + "}"
+
+    def exportar_prometheus(self):
+        """
+        Returns:
+            str: As métricas no formato de exposição em texto do Prometheus.
+        """
+        with self.trava:
+            contadores = sorted(self.contadores.items())
+            histogramas = sorted((chave, (list(h[0]), h[1], h[2])) for chave, h in self.histogramas.items())
+        linhas = []
+        tipos_escritos = set()
+        for (nome, rotulos), valor in contadores:
+            if nome not in tipos_escritos:
+                linhas.append(f"# TYPE {nome} counter")
+                tipos_escritos.add(nome)
+            linhas.append(f"{nome}{self._formatar_rotulos(rotulos)} {valor:g}")
+        for (nome, rotulos), (contagens, soma, total) in histogramas:
+            if nome not in tipos_escritos:
+                linhas.append(f"# TYPE {nome} histogram")
+                tipos_escritos.add(nome)
+            acumulado = 0
+            for limite, contagem in zip(self.limites + (float("inf"),), contagens):
+                acumulado += contagem
+                le = "+Inf" if limite == float("inf") else f"{limite:g}"
+                linhas.append(f"{nome}_bucket{self._formatar_rotulos(rotulos, [('le', le)])} {acumulado}")
+            linhas.append(f"{nome}_sum{self._formatar_rotulos(rotulos)} {soma:g}")
+            linhas.append(f"{nome}_count{self._formatar_rotulos(rotulos)} {total}")
+        for nome, funcao in sorted(self.medidores.items()):
+            linhas.append(f"# TYPE {nome} gauge")
+            linhas.append(f"{nome} {funcao():g}")
+        return "\n".join(linhas) + "\n"
+
+    def instantaneo(self):
+        """
+        Returns:
+            dict: Cópia das métricas (contadores, histogramas e medidores), serializável em JSON.
+        """
+        def nome_completo(nome, rotulos):
+            return nome + self._formatar_rotulos(rotulos)
+
+        with self.trava:
+            contadores = {nome_completo(*chave): valor for chave, valor in self.contadores.items()}
+            histogramas = {
+                nome_completo(*chave): {"contagens": list(h[0]), "soma": h[1], "total": h[2]}
+                for chave, h in self.histogramas.items()
+            }
+        return {
+            "instante": time.time(),
+            "limites_histograma": list(self.limites),
+            "contadores": contadores,
+            "histogramas": histogramas,
+            "medidores": {nome: funcao() for nome, funcao in self.medidores.items()},
+        }
+
+
+metricas = RegistroMetricas()
+metricas.registrar_medidor("ceaf_agendador_fila", lambda: len(agendador_modelo))
+rastro_atual = contextvars.ContextVar("rastro_atual", default=None) # RastroTurno do turno em andamento
+
+
+class GravadorRastros:
+    """
+    Grava os rastros em um arquivo JSONL a partir de uma thread própria: o turno apenas
+    enfileira o registro, sem esperar pelo disco (nem travar o loop de eventos do servidor).
+    Os registros pendentes são gravados ao encerrar o programa.
+    """
+
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.fila = queue.Queue()
+        self.thread = None
+        self.trava = threading.Lock()
+
+    def registrar(self, registro):
+        """Enfileira um registro (dicionário) para ser gravado como uma linha JSON."""
+        with self.trava:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._gravar_continuamente, name="rastros", daemon=True)
+                self.thread.start()
+                atexit.register(self.fila.join)
+        self.fila.put(registro)
+
+    def _gravar_continuamente(self):
+        while True:
+            registros = [self.fila.get()]
+            # Grava de uma vez o que se acumulou enquanto o arquivo estava sendo escrito
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    registros.append(self.fila.get_nowait())
+            try:
+                with open(self.arquivo, "a", encoding="utf-8") as arquivo:
+                    arquivo.writelines(json.dumps(registro, ensure_ascii=False) + "\n" for registro in registros)
+            except OSError as e:
+                print(f"⚠️ Não foi possível gravar os rastros em {self.arquivo}: {e}")
+            for _ in registros:
+                self.fila.task_done()
+
+
+gravador_rastros = GravadorRastros(ARQUIVO_RASTROS)
+
+
+class RastroTurno:
+    """
+    Rastro estruturado de um turno (uma mensagem do usuário): rota, tempo gasto em cada etapa
+    (classificação, modelo, exibição...), latência do modelo, tokens, tentativas e classe do erro.
+
+    Enquanto o turno está em andamento, o rastro fica em `rastro_atual`, de onde as funções
+    do Gemini preenchem os dados do modelo. Ao final, `finalizar` alimenta as `metricas` e,
+    se `ARQUIVO_RASTROS` estiver definido, envia o rastro ao `gravador_rastros`.
+    """
+
+    def __init__(self, canal):
+        self.canal = canal # 'terminal', 'servidor' ou 'lote'
+        self.inicio = time.perf_counter()
+        self.etapas = {}
+        self.rota = None
+        self.modelo_segundos = None
+        self.em_cache = None
+        self.tokens_prompt = None
+        self.tokens_resposta = None
+        self.tentativas = 0
+        self.erro = None
+
+    @contextlib.contextmanager
+    def etapa(self, nome):
+        """Mede o tempo do bloco `with` e o soma à etapa `nome`."""
+        inicio = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.etapas[nome] = self.etapas.get(nome, 0.0) + time.perf_counter() - inicio
+
+    def registrar_modelo(self, segundos=None, em_cache=None, tokens=None, erro=None, tentativas=None):
+        """Registra os dados da chamada ao modelo feita durante o turno."""
+        if segundos is not None:
+            self.modelo_segundos = (self.modelo_segundos or 0.0) + segundos
+        if tentativas is not None:
+            self.tentativas += tentativas
+        if em_cache is not None:
+            self.em_cache = em_cache
+        if tokens:
+            self.tokens_prompt = tokens.get("prompt")
+            self.tokens_resposta = tokens.get("resposta")
+        if erro is not None:
+            self.erro = erro.__class__.__name__
+
+    def finalizar(self, rota=None):
+        """Encerra o turno, registrando suas medições nas métricas (e no arquivo de rastros)."""
+        self.rota = rota or self.rota
+        total = time.perf_counter() - self.inicio
+        metricas.observar("ceaf_turno_segundos", total, canal=self.canal, rota=self.rota)
+        for etapa, segundos in self.etapas.items():
+            metricas.observar("ceaf_etapa_segundos", segundos, etapa=etapa)
+        if self.modelo_segundos is not None:
+            metricas.observar("ceaf_modelo_segundos", self.modelo_segundos, rota=self.rota)
+        if self.tentativas > 1:
+            metricas.incrementar("ceaf_modelo_retentativas_total", self.tentativas - 1)
+        if self.erro:
+            metricas.incrementar("ceaf_erros_total", classe=self.erro)
+        if self.tokens_prompt:
+            metricas.incrementar("ceaf_tokens_total", self.tokens_prompt, tipo="prompt")
+        if self.tokens_resposta:
+            metricas.incrementar("ceaf_tokens_total", self.tokens_resposta, tipo="resposta")
+        if ARQUIVO_RASTROS:
+            registro = {
+                "instante": time.time(), "canal": self.canal, "rota": self.rota,
+                "total_ms": round(total * 1000, 3),
+                "etapas_ms": {etapa: round(segundos * 1000, 3) for etapa, segundos in self.etapas.items()},
+                "modelo_ms": round(self.modelo_segundos * 1000, 1) if self.modelo_segundos is not None else None,
+                "em_cache": self.em_cache, "tokens_prompt": self.tokens_prompt, "tokens_resposta": self.tokens_resposta,
+                "tentativas": self.tentativas, "erro": self.erro,
+            }
+            gravador_rastros.registrar(registro)
+
+
+def registrar_no_rastro(**dados):
+    """Repassa dados da chamada ao modelo ao rastro do turno em andamento, se houver."""
+    rastro = rastro_atual.get()
+    if rastro is not None:
+        rastro.registrar_modelo(**dados)
+
+
+class PerfilAmostrado:
+    """
+    Perfil (cProfile) de uma amostra dos despachos de mensagens. Apenas uma fração `fracao`
+    das chamadas é medida, para que o custo do perfil não distorça o atendimento; os
+    resultados são acumulados e salvos em `arquivo` (formato pstats).
+    """
+
+    def __init__(self, fracao=PERFIL_AMOSTRAGEM, arquivo=ARQUIVO_PERFIL):
+        self.fracao = fracao
+        self.arquivo = arquivo
+        self.estatisticas = None
+        self.amostras = 0
+        self.trava = threading.Lock()
+        self.ativo = threading.Lock() # Mantido enquanto um despacho está sendo medido
+
+    def medir(self, funcao, *args, **kwargs):
+        """
+        Executa `funcao`, medindo-a com o cProfile se ela cair na amostra.
+
+        Só um despacho é medido por vez (no Python 3.12+ o cProfile não admite dois perfis
+        ativos); enquanto houver um em andamento, os demais rodam sem perfil. Erros do
+        próprio perfil nunca substituem o resultado de `funcao`.
+        """
+        if self.fracao <= 0 or random.random() >= self.fracao:
+            return funcao(*args, **kwargs)
+        if not self.ativo.acquire(blocking=False):
+            return funcao(*args, **kwargs)
+        try:
+            import cProfile
+            perfil = cProfile.Profile()
+            perfil.enable()
+        except Exception as e: # Outra ferramenta de perfil já está ativa, por exemplo
+            self.ativo.release()
+            print(f"⚠️ Perfil do despacho ignorado: {e}")
+            return funcao(*args, **kwargs)
+        try:
+            return funcao(*args, **kwargs)
+        finally:
+            perfil.disable()
+            self.ativo.release()
+            self._acumular(perfil)
+
+    def _acumular(self, perfil):
+        import pstats
+        try:
+            with self.trava:
+                if self.estatisticas is None:
+                    self.estatisticas = pstats.Stats(perfil)
+                else:
+                    self.estatisticas.add(perfil)
+                self.amostras += 1
+        except Exception as e: # Um perfil vazio ou incompleto não deve derrubar o atendimento
+            print(f"⚠️ Amostra de perfil descartada: {e}")
+
+    def salvar(self):
+        """Grava o perfil acumulado em `arquivo`, se houver amostras."""
+        with self.trava:
+            if self.estatisticas is not None:
+                self.estatisticas.dump_stats(self.arquivo)
+                print(f"🔬 Perfil de {self.amostras} despachos salvo em {self.arquivo} (veja com: python -m pstats {self.arquivo})")
+
+
+perfil_despacho = PerfilAmostrado()
+if PERFIL_AMOSTRAGEM > 0:
+    atexit.register(perfil_despacho.salvar)
+
+
+def gravar_metricas_json(arquivo=ARQUIVO_METRICAS_JSON):
+    """Grava um instantâneo das métricas em JSON, substituindo o arquivo de forma atômica."""
+    temporario = f"{arquivo}.tmp"
+    with open(temporario, "w", encoding="utf-8") as saida:
+        json.dump(metricas.instantaneo(), saida, ensure_ascii=False)
+    os.replace(temporario, arquivo)
+
+
+def iniciar_exportacao_metricas_json(arquivo=ARQUIVO_METRICAS_JSON, intervalo=INTERVALO_METRICAS_JSON):
+    """
+    Inicia uma thread que grava as métricas em JSON a cada `intervalo` segundos
+    (e uma última vez ao encerrar o programa).
+    """
+    def exportar_periodicamente():
+        while True:
+            time.sleep(intervalo)
+            try:
+                gravar_metricas_json(arquivo)
+            except OSError as e:
+                print(f"⚠️ Não foi possível gravar as métricas em {arquivo}: {e}")
+
+    threading.Thread(target=exportar_periodicamente, name="metricas-json", daemon=True).start()
+    atexit.register(gravar_metricas_json, arquivo)
+
+
+# --- Cache de Respostas do Gemini ---
+# Configurações do cache (podem ser alteradas por variáveis de ambiente).
+CACHE_ARQUIVO = os.environ.get("CEAF_CACHE_ARQUIVO", "cache_respostas_gemini.sqlite3") # Vazio desativa o cache em disco
+CACHE_TTL_SEGUNDOS = float(os.environ.get("CEAF_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_MEMORIA = int(os.environ.get("CEAF_CACHE_MAX_MEMORIA", "512"))
+CACHE_MAX_DISCO = int(os.environ.get("CEAF_CACHE_MAX_DISCO", "20000"))
+
+
+class CacheRespostasGemini:
+    """
+    Cache de duas camadas para as respostas do Gemini.
+
+    - Memória: dicionário ordenado com política LRU, limitado a `max_memoria` entradas.
+    - Disco: tabela SQLite que sobrevive a reinícios, limitada a `max_disco` entradas
+      (as menos acessadas recentemente são removidas primeiro).
+
+    Cada entrada expira após `ttl_segundos`. A chave combina a pergunta normalizada,
+    o `MODEL_ID` e a `VERSAO_PROMPT`, de modo que trocar o modelo ou o prompt invalida o cache.
+    """
+
+    def __init__(self, arquivo=CACHE_ARQUIVO, ttl_segundos=CACHE_TTL_SEGUNDOS,
+                 max_memoria=CACHE_MAX_MEMORIA, max_disco=CACHE_MAX_DISCO):
+        self.ttl_segundos = ttl_segundos
+        self.max_memoria = max_memoria
+        self.max_disco = max_disco
+        self.memoria = OrderedDict() # chave -> (resposta, expira_em)
+        self.trava = threading.Lock()
+        self.contadores = Counter()
+        self.tempo_consultas = 0.0
+        self.arquivo = arquivo
+        self.conexao = None # Aberta na primeira consulta ou gravação, para que importar o módulo não crie o arquivo
+        self.erro_disco_avisado = False
+
+    def _abrir_conexao(self):
+        """Abre (uma única vez) a conexão com o cache em disco. Deve ser chamada com a trava adquirida."""
+        if not self.arquivo:
+            return None
+        arquivo, self.arquivo = self.arquivo, None # Só tenta uma vez, mesmo que falhe
+        try:
+            self.conexao = sqlite3.connect(arquivo, check_same_thread=False)
+            # WAL evita um fsync completo a cada gravação, mantendo as consultas rápidas
+            self.conexao.execute("PRAGMA journal_mode=WAL")
+            self.conexao.execute("PRAGMA synchronous=NORMAL")
+            self.conexao.execute(
+                "CREATE TABLE IF NOT EXISTS respostas ("
+                "chave TEXT PRIMARY KEY, resposta TEXT NOT NULL, "
+                "expira_em REAL NOT NULL, acessado_em REAL NOT NULL)"
+            )
+            self.conexao.execute("CREATE INDEX IF NOT EXISTS idx_acessado ON respostas (acessado_em)")
+            self.conexao.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache em disco indisponível ({e}). Usando apenas o cache em memória.")
+            self.conexao = None
+        return self.conexao
+
+    @staticmethod
+    def gerar_chave(pergunta, tipo="pergunta"):
+        """
+        Gera a chave do cache para uma pergunta.
+
+        Args:
+            pergunta (str): O texto enviado ao Gemini.
+            tipo (str): Identifica a função de origem, para separar perguntas livres de buscas.
+
+        Returns:
+            str: Hash SHA-256 da pergunta normalizada, do modelo, da versão do prompt e das páginas de referência.
+        """
+        base = json.dumps([MODEL_ID, VERSAO_PROMPT, base_conhecimento.assinatura(), tipo, normalizar_texto(pergunta)])
+        return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+    def obter(self, chave):
+        """
+        Busca uma resposta no cache, primeiro na memória e depois no disco.
+
+        Returns:
+            str: A resposta armazenada, ou None se não existir ou estiver expirada.
+        """
+        inicio = time.perf_counter()
+        agora = time.time()
+        with self.trava:
+            try:
+                entrada = self.memoria.get(chave)
+                if entrada is not None:
+                    resposta, expira_em = entrada
+                    if expira_em > agora:
+                        self.memoria.move_to_end(chave)
+                        self.contadores["acertos_memoria"] += 1
+                        return resposta
+                    del self.memoria[chave]
+                if self.conexao is not None or self._abrir_conexao() is not None:
+                    try:
+                        linha = self.conexao.execute(
+                            "SELECT resposta, expira_em FROM respostas WHERE chave = ?", (chave,)
+                        ).fetchone()
+                    except sqlite3.Error as e:
+                        self._registrar_erro_disco(e)
+                        linha = None
+                    if linha is not None:
+                        resposta, expira_em = linha
+                        if expira_em > agora:
+                            self._executar_no_disco(("UPDATE respostas SET acessado_em = ? WHERE chave = ?", (agora, chave)))
+                            self._guardar_em_memoria(chave, resposta, expira_em)
+                            self.contadores["acertos_disco"] += 1
+                            return resposta
+                        self._executar_no_disco(("DELETE FROM respostas WHERE chave = ?", (chave,)))
+                self.contadores["faltas"] += 1
+                return None
+            finally:
+                self.tempo_consultas += time.perf_counter() - inicio
+
+    def guardar(self, chave, resposta):
+        """Armazena uma resposta nas duas camadas do cache."""
+        agora = time.time()
+        expira_em = agora + self.ttl_segundos
+        with self.trava:
+            self._guardar_em_memoria(chave, resposta, expira_em)
+            if self.conexao is not None or self._abrir_conexao() is not None:
+                self._executar_no_disco(
+                    ("INSERT OR REPLACE INTO respostas (chave, resposta, expira_em, acessado_em) VALUES (?, ?, ?, ?)",
+                     (chave, resposta, expira_em, agora)),
+                    # Remove as entradas menos acessadas quando o limite do disco é ultrapassado
+                    ("DELETE FROM respostas WHERE chave IN ("
+                     "SELECT chave FROM respostas ORDER BY acessado_em DESC LIMIT -1 OFFSET ?)",
+                     (self.max_disco,)),
+                )
+            self.contadores["gravacoes"] += 1
+
+    def _executar_no_disco(self, *comandos):
+        """
+        Executa os comandos (pares SQL, parâmetros) em uma transação. Um erro do SQLite é
+        registrado e a operação fica só na memória. Deve ser chamada com a trava adquirida.
+        """
+        try:
+            for sql, parametros in comandos:
+                self.conexao.execute(sql, parametros)
+            self.conexao.commit()
+        except sqlite3.Error as e:
+            self._registrar_erro_disco(e)
+
+    def _registrar_erro_disco(self, erro):
+        # Um erro do SQLite (ex.: "database is locked", com o modo lote e o terminal usando o mesmo
+        # arquivo) não pode derrubar a conversa nem descartar uma resposta válida do modelo
+        self.contadores["erros_disco"] += 1
+        with contextlib.suppress(sqlite3.Error):
+            self.conexao.rollback()
+        if not self.erro_disco_avisado:
+            self.erro_disco_avisado = True
+            print(f"⚠️ Erro no cache em disco ({erro}). As respostas afetadas ficam apenas no cache em memória.")
+
+    def _guardar_em_memoria(self, chave, resposta, expira_em):
+        self.memoria[chave] = (resposta, expira_em)
+        self.memoria.move_to_end(chave)
+        while len(self.memoria) > self.max_memoria:
+            self.memoria.popitem(last=False)
+            self.contadores["remocoes_memoria"] += 1
+
+    def registrar_latencia_modelo(self, segundos):
+        """Acumula o tempo gasto nas chamadas ao Gemini que não foram atendidas pelo cache."""
+        with self.trava:
+            self.contadores["chamadas_modelo"] += 1
+            self.contadores["tempo_modelo_ms"] += int(segundos * 1000)
+
+    def relatorio(self):
+        """
+        Returns:
+            str: Resumo de acertos, faltas e latências do cache.
+        """
+        c = self.contadores
+        consultas = c["acertos_memoria"] + c["acertos_disco"] + c["faltas"]
+        if not consultas:
+            return "Cache ainda não consultado."
+        acertos = c["acertos_memoria"] + c["acertos_disco"]
+        linhas = [
+            f"Acertos: {acertos}/{consultas} ({acertos / consultas:.1%}) "
+            f"[memória: {c['acertos_memoria']}, disco: {c['acertos_disco']}]",
+            f"Faltas: {c['faltas']} | Gravações: {c['gravacoes']} | Remoções da memória: {c['remocoes_memoria']}",
+            f"Latência média de consulta ao cache: {self.tempo_consultas / consultas * 1e6:.0f} µs",
+        ]
+        if c["chamadas_modelo"]:
+            linhas.append(f"Latência média do Gemini: {c['tempo_modelo_ms'] / c['chamadas_modelo']:.0f} ms")
+        return "\n".join(linhas)
+
+
+cache_respostas = CacheRespostasGemini()
+for _evento in ("acertos_memoria", "acertos_disco", "faltas", "gravacoes"):
+    metricas.registrar_medidor(f"ceaf_cache_{_evento}", lambda evento=_evento: cache_respostas.contadores[evento])
+
+
+# --- Catálogo Local de Medicamentos (opção 3 do menu) ---
+# Cópias locais (CSV ou HTML) das listas estaduais ficam neste diretório. O nome do arquivo
+# (sem extensão) identifica a lista de origem; os nomes conhecidos estão em `LISTAS_ESTADUAIS`.
+CATALOGO_DIRETORIO = os.environ.get("CEAF_DIRETORIO_LISTAS", "listas_estaduais")
+CATALOGO_INTERVALO_VERIFICACAO = float(os.environ.get("CEAF_CATALOGO_INTERVALO", "5")) # Segundos entre verificações dos arquivos
+LIMIAR_CATALOGO_APROXIMADO = float(os.environ.get("CEAF_LIMIAR_CATALOGO", "0.7"))
+TAMANHO_MINIMO_PREFIXO_CATALOGO = 3 # Prefixos mais curtos ("a", "me") casariam com boa parte do catálogo
+MAX_ITENS_RESPOSTA_CATALOGO = 12
+
+LISTAS_ESTADUAIS = {
+    "glaucoma": ("Medicamentos para Tratamento de Glaucoma (PCDT do Ministério da Saúde)", SITES_PRIORITARIOS_ESTADUAIS[0]),
+    "relacao_estadual": ("Relação Estadual de Medicamentos do Componente Especializado (PCDT do Ministério da Saúde)", SITES_PRIORITARIOS_ESTADUAIS[1]),
+    "protocolos_estaduais": ("Medicamentos dos Protocolos e Normas Técnicas Estaduais (Secretaria de Saúde de SP)", SITES_PRIORITARIOS_ESTADUAIS[2]),
+}
+
+# Nomes de coluna aceitos (já normalizados) para cada campo do catálogo
+COLUNAS_CATALOGO = {
+    "principio_ativo": ("principio ativo", "medicamento", "farmaco", "denominacao generica", "nome"),
+    "apresentacao": ("apresentacao", "forma farmaceutica", "concentracao", "apresentacoes"),
+    "protocolo": ("pcdt", "protocolo", "protocolo clinico", "norma tecnica", "doenca", "indicacao", "cid", "cid 10"),
+}
+
+
+class MedicamentoCatalogo:
+    """
+    Uma linha de uma lista estadual: princípio ativo, apresentação, protocolo (PCDT) e lista de origem.
+    """
+
+    __slots__ = ("principio_ativo", "apresentacao", "protocolo", "lista")
+
+    def __init__(self, principio_ativo, apresentacao="", protocolo="", lista=""):
+        self.principio_ativo = principio_ativo
+        self.apresentacao = apresentacao
+        self.protocolo = protocolo
+        self.lista = lista
+
+
+class _LeitorTabelasHTML(HTMLParser):
+    """Extrai as linhas (listas de células) de todas as tabelas de uma página HTML."""
+
+    def __init__(self):
+        super().__init__()
+        self.linhas = []
+        self._linha = None
+        self._celula = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            self._linha = []
+        elif tag in ("td", "th") and self._linha is not None:
+            self._celula = []
+
+    def handle_endtag(self, tag):
+        if tag in ("td", "th") and self._celula is not None:
+            self._linha.append(" ".join("".join(self._celula).split()))
+            self._celula = None
+        elif tag == "tr" and self._linha is not None:
+            if any(self._linha):
+                self.linhas.append(self._linha)
+            self._linha = None
+
+    def handle_data(self, data):
+        if self._celula is not None:
+            self._celula.append(data)
+
+
+def _ler_texto_arquivo(caminho):
+    # As listas oficiais costumam vir em UTF-8 ou em Latin-1 (exportações de planilha)
+    with open(caminho, "rb") as arquivo:
+        conteudo = arquivo.read()
+    try:
+        return conteudo.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return conteudo.decode("latin-1")
+
+
+def ler_linhas_lista(caminho):
+    """
+    Lê as linhas de uma cópia local de lista estadual (CSV ou HTML).
+
+    Args:
+        caminho (str): Caminho do arquivo.
+
+    Returns:
+        list: Lista de linhas, cada uma uma lista de células (str).
+    """
+    texto = _ler_texto_arquivo(caminho)
+    if caminho.lower().endswith((".html", ".htm")):
+        leitor = _LeitorTabelasHTML()
+        leitor.feed(texto)
+        return leitor.linhas
+    try:
+        dialeto = csv.Sniffer().sniff(texto[:4096], delimiters=";,\t")
+    except csv.Error:
+        dialeto = csv.excel
+    return [linha for linha in csv.reader(texto.splitlines(), dialeto) if any(c.strip() for c in linha)]
+
+
+def extrair_medicamentos(linhas, lista):
+    """
+    Converte as linhas de uma lista em itens do catálogo, identificando as colunas pelo cabeçalho.
+    Sem cabeçalho reconhecido, assume a ordem: princípio ativo, apresentação, protocolo.
+
+    Args:
+        linhas (list): Linhas retornadas por `ler_linhas_lista`.
+        lista (str): Identificador da lista de origem.
+
+    Returns:
+        list: Itens `MedicamentoCatalogo`.
+    """
+    if not linhas:
+        return []
+    posicoes = {}
+    cabecalho = [normalizar_texto(celula, remover_irrelevantes=False) for celula in linhas[0]]
+    for campo, nomes in COLUNAS_CATALOGO.items():
+        for i, nome_coluna in enumerate(cabecalho):
+            if i not in posicoes.values() and any(nome_coluna.startswith(nome) for nome in nomes):
+                posicoes[campo] = i
+                break
+    if "principio_ativo" in posicoes:
+        linhas = linhas[1:]
+    else:
+        posicoes = {"principio_ativo": 0, "apresentacao": 1, "protocolo": 2}
+
+    def celula(linha, campo):
+        i = posicoes.get(campo)
+        return linha[i].strip() if i is not None and i < len(linha) else ""
+
+    itens = []
+    for linha in linhas:
+        principio_ativo = celula(linha, "principio_ativo")
+        if principio_ativo:
+            itens.append(MedicamentoCatalogo(principio_ativo, celula(linha, "apresentacao"), celula(linha, "protocolo"), lista))
+    return itens
+
+
+class CatalogoMedicamentos:
+    """
+    Catálogo em memória dos medicamentos das listas estaduais, montado a partir das cópias
+    locais em `diretorio`, com busca por prefixo e aproximada, sem acentos.
+
+    Os arquivos são carregados na primeira busca (ou em `iniciar`); depois disso, uma thread
+    verifica o diretório a cada `intervalo_verificacao` segundos. Só os arquivos novos ou
+    alterados são lidos de novo, e os índices são remontados a partir dos itens já carregados
+    dos demais arquivos e publicados de uma vez em `indices`. Assim `buscar` só lê os índices
+    publicados, sem acessar o disco (e sem travar o loop de eventos do servidor).
+    """
+
+    def __init__(self, diretorio=CATALOGO_DIRETORIO, intervalo_verificacao=CATALOGO_INTERVALO_VERIFICACAO):
+        self.diretorio = diretorio
+        self.intervalo_verificacao = intervalo_verificacao
+        self.arquivos = {} # caminho -> ((mtime_ns, tamanho), itens)
+        # (por_nome, nomes_ordenados, indice_aproximado, por_termo): princípio ativo normalizado -> lista
+        # de MedicamentoCatalogo, os princípios ativos em ordem (busca por prefixo), o índice de trigramas
+        # e cada palavra dos princípios ativos -> princípios ativos que a contêm
+        self.indices = ({}, [], IndiceTrigramas(), {})
+        self.ultima_verificacao = float("-inf")
+        self.trava = threading.Lock()
+        self.verificador = None # Thread que relê os arquivos alterados
+
+    def iniciar(self):
+        """Carrega o catálogo, se ainda não foi carregado, e inicia a thread de verificação dos arquivos."""
+        with self.trava:
+            if self.verificador is not None:
+                return
+            self.verificador = threading.Thread(target=self._verificar_periodicamente, name="catalogo", daemon=True)
+        self.atualizar(forcar=True)
+        self.verificador.start()
+
+    def _verificar_periodicamente(self):
+        while True:
+            time.sleep(self.intervalo_verificacao)
+            try:
+                self.atualizar()
+            except Exception as e: # A thread não pode morrer por causa de um arquivo problemático
+                print(f"⚠️ Não foi possível atualizar o catálogo de medicamentos: {e}")
+
+    def atualizar(self, forcar=False):
+        """
+        Relê os arquivos novos ou alterados do diretório e remonta os índices se algo mudou.
+
+        Args:
+            forcar (bool): Ignora o intervalo mínimo entre verificações.
+
+        Returns:
+            bool: True se o catálogo foi alterado.
+        """
+        agora = time.monotonic()
+        if not forcar and agora - self.ultima_verificacao < self.intervalo_verificacao:
+            return False
+        with self.trava:
+            self.ultima_verificacao = agora
+            encontrados = {}
+            if os.path.isdir(self.diretorio):
+                for entrada in os.scandir(self.diretorio):
+                    if entrada.is_file() and entrada.name.lower().endswith((".csv", ".html", ".htm")):
+                        info = entrada.stat()
+                        encontrados[entrada.path] = (info.st_mtime_ns, info.st_size)
+            alterado = set(self.arquivos) != set(encontrados)
+            for caminho in set(self.arquivos) - set(encontrados):
+                del self.arquivos[caminho]
+            for caminho, assinatura in encontrados.items():
+                anterior = self.arquivos.get(caminho)
+                if anterior is not None and anterior[0] == assinatura:
+                    continue
+                lista = os.path.splitext(os.path.basename(caminho))[0]
+                try:
+                    itens = extrair_medicamentos(ler_linhas_lista(caminho), lista)
+                except (OSError, csv.Error) as e:
+                    print(f"⚠️ Não foi possível ler a lista '{caminho}': {e}")
+                    itens = []
+                self.arquivos[caminho] = (assinatura, itens)
+                alterado = True
+            if alterado:
+                self._reconstruir_indices()
+            return alterado
+
+    def _reconstruir_indices(self):
+        por_nome = defaultdict(list)
+        for _, itens in self.arquivos.values():
+            for item in itens:
+                por_nome[normalizar_texto(item.principio_ativo, remover_irrelevantes=False)].append(item)
+        indice = IndiceTrigramas()
+        por_termo = defaultdict(list)
+        for nome in por_nome:
+            indice.adicionar(nome, nome)
+            for termo in set(nome.split()):
+                por_termo[termo].append(nome)
+        self.indices = (dict(por_nome), sorted(por_nome), indice, dict(por_termo))
+
+    def buscar(self, termo):
+        """
+        Procura um medicamento pelo princípio ativo: nome exato, depois prefixo com pelo menos
+        `TAMANHO_MINIMO_PREFIXO_CATALOGO` letras (ex.: "adalim" encontra "adalimumabe"), busca
+        aproximada e, por fim, palavra por palavra (ex.: "adalimumabe 40mg" ou "zoledronico",
+        para "ácido zoledrônico").
+
+        Args:
+            termo (str): O nome digitado pelo usuário.
+
+        Returns:
+            list: Itens `MedicamentoCatalogo` encontrados (vazia se não houver correspondência).
+        """
+        if self.verificador is None:
+            self.iniciar()
+        por_nome, nomes, indice_aproximado, por_termo = self.indices
+        nome = normalizar_texto(termo, remover_irrelevantes=False)
+        if not nome or not por_nome:
+            return []
+        if nome in por_nome:
+            return list(por_nome[nome])
+        if len(nome) >= TAMANHO_MINIMO_PREFIXO_CATALOGO:
+            inicio = bisect.bisect_left(nomes, nome)
+            itens = []
+            for candidato in nomes[inicio:]:
+                if not candidato.startswith(nome):
+                    break
+                itens.extend(por_nome[candidato])
+            if itens:
+                return itens
+        resultados = indice_aproximado.buscar(nome)
+        if resultados and resultados[0][1] >= LIMIAR_CATALOGO_APROXIMADO:
+            return list(por_nome[resultados[0][0]])
+        return self._buscar_por_termos(nome, por_nome, por_termo)
+
+    @staticmethod
+    def _buscar_por_termos(nome, por_nome, por_termo):
+        # Cada palavra da consulta casa com as palavras dos princípios ativos por igualdade ou, se
+        # nenhuma for igual, por prefixo; vencem os princípios ativos com mais palavras encontradas
+        contagem = Counter()
+        for termo in set(nome.split()):
+            if len(termo) < TAMANHO_MINIMO_PREFIXO_CATALOGO:
+                continue
+            encontrados = por_termo.get(termo)
+            if encontrados is None:
+                encontrados = {candidato for palavra, nomes in por_termo.items() if palavra.startswith(termo)
+                               for candidato in nomes}
+            contagem.update(set(encontrados))
+        if not contagem:
+            return []
+        maior = max(contagem.values())
+        return [item for candidato in sorted(contagem) if contagem[candidato] == maior for item in por_nome[candidato]]
+
+    def __len__(self):
+        return sum(len(itens) for _, itens in self.arquivos.values())
+
+
+def formatar_resposta_catalogo(termo, itens):
+    """
+    Monta a resposta da opção 3 a partir dos itens encontrados no catálogo local.
+
+    Args:
+        termo (str): O nome digitado pelo usuário.
+        itens (list): Itens `MedicamentoCatalogo` encontrados.
+
+    Returns:
+        str: Texto da resposta.
+    """
+    linhas = [f"Encontrei '{termo}' nas listas estaduais do Componente Especializado:"]
+    listas_usadas = []
+    for item in itens[:MAX_ITENS_RESPOSTA_CATALOGO]:
+        detalhes = " - ".join(parte for parte in (item.apresentacao, item.protocolo) if parte)
+        descricao_lista = LISTAS_ESTADUAIS.get(item.lista, (item.lista, None))[0]
+        linhas.append(f"* **{item.principio_ativo}**" + (f": {detalhes}" if detalhes else "") + f" [{descricao_lista}]")
+        if item.lista not in listas_usadas:
+            listas_usadas.append(item.lista)
+    if len(itens) > MAX_ITENS_RESPOSTA_CATALOGO:
+        linhas.append(f"* ... e mais {len(itens) - MAX_ITENS_RESPOSTA_CATALOGO} apresentações.")
+    links = [LISTAS_ESTADUAIS[lista][1] for lista in listas_usadas if lista in LISTAS_ESTADUAIS]
+    if links:
+        linhas.append("\nConsulte a lista completa em: " + " | ".join(links))
+    linhas.append("\nAtenção: confirme a disponibilidade na Assistência Farmacêutica de Tatuí antes de dar entrada no pedido.")
+    return "\n".join(linhas)
+
+
+catalogo_medicamentos = CatalogoMedicamentos()
+
+
+# --- Recuperação de Trechos de Referência (BM25) ---
+# Cópias locais (HTML, TXT ou MD) das páginas estaduais sobre o Componente Especializado; o texto delas,
+# junto com as respostas fixas, forma a base de trechos enviados ao Gemini como referência.
+PAGINAS_DIRETORIO = os.environ.get("CEAF_DIRETORIO_PAGINAS", "paginas_estaduais")
+RECUPERACAO_TRECHOS = int(os.environ.get("CEAF_RECUPERACAO_TRECHOS", "3")) # Máximo de trechos por pergunta (0 desativa)
+RECUPERACAO_MAX_TOKENS = int(os.environ.get("CEAF_RECUPERACAO_MAX_TOKENS", "600")) # Orçamento dos trechos no prompt
+TOKENS_POR_TRECHO = 150 # Tamanho aproximado de cada trecho ao dividir os textos
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class _ExtratorTextoHTML(HTMLParser):
+    """Extrai o texto visível de uma página HTML, um bloco (parágrafo, item, célula...) por linha."""
+
+    BLOCOS = {"p", "div", "li", "tr", "br", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "table"}
+
+    def __init__(self):
+        super().__init__()
+        self.partes = []
+        self._ignorar = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "nav", "header", "footer"):
+            self._ignorar += 1
+        elif tag in self.BLOCOS:
+            self.partes.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "nav", "header", "footer") and self._ignorar:
+            self._ignorar -= 1
+        elif tag in self.BLOCOS:
+            self.partes.append("\n")
+
+    def handle_data(self, data):
+        if not self._ignorar:
+            self.partes.append(data)
+
+    def texto(self):
+        return "\n".join(" ".join(linha.split()) for linha in "".join(self.partes).splitlines() if linha.strip())
+
+
+def radical(termo):
+    """Reduz um termo normalizado aos seus 6 primeiros caracteres ("renovacao" e "renovar" -> "renova")."""
+    return termo[:6]
+
+
+def termos_busca(texto):
+    """Termos usados pelo índice BM25: sem acentos, sem palavras irrelevantes e reduzidos ao radical."""
+    return [radical(termo) for termo in normalizar_texto(texto).split()]
+
+
+def dividir_em_trechos(texto, max_tokens=TOKENS_POR_TRECHO):
+    """
+    Divide um texto em trechos de até `max_tokens` (estimados), sem quebrar parágrafos,
+    a não ser que um parágrafo sozinho passe do limite (aí ele é quebrado por frases).
+
+    Returns:
+        list: Os trechos, na ordem do texto.
+    """
+    unidades = []
+    for paragrafo in re.split(r"\n\s*\n|\n(?=[*•\-] )", texto):
+        paragrafo = " ".join(paragrafo.split())
+        if not paragrafo:
+            continue
+        if estimar_tokens(paragrafo) <= max_tokens:
+            unidades.append(paragrafo)
+        else:
+            unidades.extend(re.split(r"(?<=[.!?;])\s+", paragrafo))
+    trechos = []
+    atual = ""
+    for unidade in unidades:
+        candidato = f"{atual}\n{unidade}" if atual else unidade
+        if atual and estimar_tokens(candidato) > max_tokens:
+            trechos.append(atual)
+            atual = unidade
+        else:
+            atual = candidato
+    if atual:
+        trechos.append(atual)
+    return trechos
+
+
+class IndiceBM25:
+    """
+    Índice invertido em memória com pontuação BM25, para recuperar os trechos de referência
+    mais relevantes para uma pergunta.
+
+    Cada trecho é guardado com sua fonte (a pergunta frequente ou a página de origem). A fonte
+    também é indexada, para que o assunto do trecho conte mesmo que o texto não o repita.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.trechos = [] # Lista de (fonte, texto)
+        self.tamanhos = []
+        self.postagens = defaultdict(list) # termo -> [(id do trecho, frequência)]
+        self.tamanho_medio = 0.0
+
+    def adicionar(self, fonte, texto):
+        termos = termos_busca(f"{fonte} {texto}")
+        id_trecho = len(self.trechos)
+        self.trechos.append((fonte, texto))
+        self.tamanhos.append(len(termos))
+        for termo, frequencia in Counter(termos).items():
+            self.postagens[termo].append((id_trecho, frequencia))
+        self.tamanho_medio = sum(self.tamanhos) / len(self.tamanhos)
+
+    def buscar(self, consulta, limite=RECUPERACAO_TRECHOS):
+        """
+        Returns:
+            list: Tuplas (fonte, texto, pontuação) dos trechos mais relevantes, da maior para a menor pontuação.
+        """
+        pontuacoes = defaultdict(float)
+        total = len(self.trechos)
+        for termo in set(termos_busca(consulta)):
+            postagens = self.postagens.get(termo)
+            if not postagens:
+                continue
+            idf = math.log(1 + (total - len(postagens) + 0.5) / (len(postagens) + 0.5))
+            for id_trecho, frequencia in postagens:
+                normalizacao = self.k1 * (1 - self.b + self.b * self.tamanhos[id_trecho] / self.tamanho_medio)
+                pontuacoes[id_trecho] += idf * frequencia * (self.k1 + 1) / (frequencia + normalizacao)
+        melhores = sorted(pontuacoes.items(), key=lambda item: item[1], reverse=True)[:limite]
+        return [(*self.trechos[id_trecho], pontuacao) for id_trecho, pontuacao in melhores]
+
+    def __len__(self):
+        return len(self.trechos)
+
+
+class BaseConhecimento:
+    """
+    Trechos de referência para as perguntas livres: as respostas fixas e as cópias locais das
+    páginas estaduais (`PAGINAS_DIRETORIO`), divididos em trechos e indexados com BM25.
+
+    O índice é montado na primeira consulta (ou por `carregar`, no início dos modos servidor e lote).
+    """
+
+    def __init__(self, diretorio=PAGINAS_DIRETORIO):
+        self.diretorio = diretorio
+        self.indice = None
+        self._assinatura = ""
+        self.trava = threading.Lock()
+
+    def carregar(self):
+        with self.trava:
+            if self.indice is not None:
+                return
+            indice = IndiceBM25()
+            respostas_vistas = set() # Chaves que são só outro nome para uma resposta já indexada ficam de fora
+            for pergunta, resposta in respostas_fixas_tatui.items():
+                if pergunta == "sair" or resposta in respostas_vistas:
+                    continue
+                respostas_vistas.add(resposta)
+                for trecho in dividir_em_trechos(resposta):
+                    indice.adicionar(pergunta, trecho)
+            arquivos = []
+            if os.path.isdir(self.diretorio):
+                for nome in sorted(os.listdir(self.diretorio)):
+                    caminho = os.path.join(self.diretorio, nome)
+                    extensao = os.path.splitext(nome)[1].lower()
+                    if extensao not in (".html", ".htm", ".txt", ".md"):
+                        continue
+                    try:
+                        texto = _ler_texto_arquivo(caminho)
+                        estado = os.stat(caminho)
+                    except OSError as e:
+                        print(f"⚠️ Não foi possível ler a página {caminho}: {e}")
+                        continue
+                    if extensao in (".html", ".htm"):
+                        extrator = _ExtratorTextoHTML()
+                        extrator.feed(texto)
+                        texto = extrator.texto().replace("\n", "\n\n")
+                    for trecho in dividir_em_trechos(texto):
+                        indice.adicionar(os.path.splitext(nome)[0].replace("_", " "), trecho)
+                    arquivos.append((nome, estado.st_size, estado.st_mtime_ns))
+            # Muda quando as páginas locais mudam, para que o cache não sirva respostas baseadas em textos antigos
+            self._assinatura = hashlib.sha256(json.dumps(arquivos).encode("utf-8")).hexdigest()[:12] if arquivos else ""
+            self.indice = indice
+
+    def assinatura(self):
+        self.carregar()
+        return self._assinatura
+
+    def buscar(self, pergunta, limite=RECUPERACAO_TRECHOS, max_tokens=RECUPERACAO_MAX_TOKENS):
+        """
+        Seleciona os trechos mais relevantes para a pergunta, do mais ao menos relevante,
+        enquanto couberem no orçamento de `max_tokens`.
+
+        Returns:
+            list: Tuplas (fonte, texto).
+        """
+        if limite <= 0:
+            return []
+        self.carregar()
+        selecionados = []
+        usados = 0
+        resultados = self.indice.buscar(pergunta, limite)
+        for fonte, texto, pontuacao in resultados:
+            # Trechos muito menos relevantes que o melhor só gastariam tokens
+            if pontuacao < resultados[0][2] * 0.3:
+                break
+            custo = estimar_tokens(texto)
+            if usados + custo > max_tokens:
+                continue
+            selecionados.append((fonte, texto))
+            usados += custo
+        return selecionados
+
+
+def montar_contexto_recuperado(pergunta_usuario):
+    """
+    Monta o bloco de trechos de referência para uma pergunta, enviado ao Gemini junto com as
+    instruções de sistema (apenas nesta requisição, fora do histórico da conversa).
+
+    Returns:
+        str: O bloco de referência, ou "" se nenhum trecho for relevante.
+    """
+    inicio = time.perf_counter()
+    trechos = base_conhecimento.buscar(pergunta_usuario)
+    metricas.observar("ceaf_recuperacao_segundos", time.perf_counter() - inicio)
+    if not trechos:
+        return ""
+    metricas.incrementar("ceaf_recuperacao_trechos_total", len(trechos))
+    referencias = "\n\n".join(f"[{numero}] ({fonte})\n{texto}" for numero, (fonte, texto) in enumerate(trechos, 1))
+    return ("Trechos de referência da Assistência Farmacêutica de Tatuí. Use-os para responder quando forem "
+            "relevantes e prefira-os ao conhecimento geral; ignore os que não tiverem relação com a pergunta.\n\n"
+            + referencias)
+
+
+base_conhecimento = BaseConhecimento()
+
+
+# --- Funções do Chatbot ---
+MENSAGEM_SESSAO_INATIVA = "Desculpe, a sessão de chat com o Gemini não está ativa. Funcionalidade limitada."
+MENSAGEM_ERRO_GEMINI = "Ocorreu um erro ao tentar processar sua pergunta com o Gemini. Tente novamente."
+CHAVE_CONTATO = "Qual o horário de funcionamento e contato da Assistência Farmacêutica?"
+# Confiança mínima para usar uma resposta fixa como alternativa quando o Gemini está indisponível
+LIMIAR_RESPOSTA_ALTERNATIVA = float(os.environ.get("CEAF_LIMIAR_ALTERNATIVA", "0.35"))
+# Mostra as respostas do Gemini no terminal à medida que são geradas ("0" desativa)
+STREAMING_ATIVO = os.environ.get("CEAF_STREAMING", "1") != "0"
+
+
+def resposta_alternativa(pergunta_usuario, erro):
+    """
+    Resposta imediata para quando o Gemini falha ou está suspenso pelo disjuntor: a resposta
+    fixa mais parecida com a pergunta (com um limiar menor que o da rota aproximada) ou,
+    se nenhuma for parecida o bastante, o contato da Assistência Farmacêutica.
+
+    Args:
+        pergunta_usuario (str): A pergunta feita pelo usuário.
+        erro (Exception): O erro da chamada ao Gemini.
+
+    Returns:
+        str: O aviso de indisponibilidade seguido da resposta alternativa.
+    """
+    motivo = "está temporariamente indisponível" if isinstance(erro, ErroCircuitoAberto) else "não conseguiu responder agora"
+    for chave, pontuacao in indice_respostas_fixas.buscar(pergunta_usuario, limite=3):
+        if chave != "sair" and pontuacao >= LIMIAR_RESPOSTA_ALTERNATIVA:
+            metricas.incrementar("ceaf_respostas_alternativas_total", tipo="fixa")
+            return (f"⚠️ O assistente com o Gemini {motivo}. Esta é a informação mais próxima da sua pergunta:\n\n"
+                    f"{respostas_fixas_tatui[chave]}")
+    metricas.incrementar("ceaf_respostas_alternativas_total", tipo="contato")
+    return (f"⚠️ O assistente com o Gemini {motivo}. Tente novamente em alguns minutos ou fale com a "
+            f"Assistência Farmacêutica:\n\n{respostas_fixas_tatui[CHAVE_CONTATO]}")
+
+def resposta_compartilhavel(sessao_chat):
+    """
+    Indica se a resposta desta sessão pode vir do cache, ir para ele ou ser aproveitada por
+    outra conversa com a mesma pergunta (`agrupador_chamadas`). Só quando a sessão ainda não
+    tem histórico nem resumo: uma resposta gerada com o contexto de um usuário (medicamentos,
+    condições já citadas) não pode ser entregue a outro, e uma pergunta de continuação
+    ("e para renovar?") precisa do contexto da própria conversa.
+    """
+    tem_contexto = getattr(sessao_chat, "tem_contexto", None)
+    return tem_contexto is not None and not tem_contexto()
+
+def obter_resposta_gemini(pergunta_usuario, tipo_cache="pergunta", sessao_chat=None, propagar_erros=False,
+                          consulta_referencias=None):
+    """
+    Envia a pergunta para o modelo Gemini através da sessão de chat e retorna a resposta.
+    Respostas já obtidas para a mesma pergunta (normalizada) são servidas pelo `cache_respostas`,
+    desde que a sessão ainda não tenha contexto próprio (veja `resposta_compartilhavel`).
+
+    Args:
+        pergunta_usuario (str): A pergunta feita pelo usuário.
+        tipo_cache (str): Separa no cache as perguntas livres das buscas de medicamentos.
+        sessao_chat (optional): Sessão de chat da conversa. Se omitida, usa a sessão global (`obter_sessao_chat`).
+        propagar_erros (bool): Se True, erros da API são repassados ao chamador (para que ele
+            possa tentar de novo) em vez de virarem uma mensagem de erro.
+        consulta_referencias (str, optional): Texto usado para recuperar os trechos de referência
+            (`montar_contexto_recuperado`). Se omitido, usa a própria pergunta.
+
+    Returns:
+        str: A resposta gerada pelo modelo Gemini, ou uma mensagem de erro/aviso.
+    """
+    sessao_chat = sessao_chat or obter_sessao_chat()
+    if not sessao_chat:
+        if propagar_erros:
+            # No modo lote, o item deve ficar como falha (para ser tentado de novo), não como respondido
+            raise RuntimeError(MENSAGEM_SESSAO_INATIVA)
+        return MENSAGEM_SESSAO_INATIVA
+
+    prompt_completo = montar_prompt_gemini(pergunta_usuario)
+    compartilhavel = resposta_compartilhavel(sessao_chat)
+    chave_cache = chamada = None
+    lider = True
+    if compartilhavel:
+        # Perguntas repetidas são respondidas pelo cache, sem nova chamada ao Gemini
+        chave_cache = cache_respostas.gerar_chave(pergunta_usuario, tipo_cache)
+        resposta_em_cache = cache_respostas.obter(chave_cache)
+        if resposta_em_cache is not None:
+            registrar_no_rastro(em_cache=True)
+            return resposta_em_cache
+        # Se a mesma pergunta já está sendo respondida para outro usuário, aproveita essa chamada
+        chamada, lider = agrupador_chamadas.iniciar(chave_cache)
+    inicio = time.perf_counter()
+    try:
+        if not lider:
+            resposta = agrupador_chamadas.aguardar(chamada, chamador_modelo.prazo_total)
+            registrar_no_rastro(em_cache=True)
+            return resposta
+        # Envia a mensagem para a sessão de chat ativa
+        referencias = montar_contexto_recuperado(consulta_referencias or pergunta_usuario)
+        response = sessao_chat.send_message(prompt_completo, referencias=referencias)
+        duracao = time.perf_counter() - inicio
+        estatisticas_latencia.registrar("gemini_total", duracao)
+        cache_respostas.registrar_latencia_modelo(duracao)
+        registrar_no_rastro(segundos=duracao, em_cache=False, tokens=ultimo_uso_tokens(sessao_chat))
+        if compartilhavel:
+            if response.text:
+                cache_respostas.guardar(chave_cache, response.text)
+            agrupador_chamadas.concluir(chave_cache, chamada, resultado=response.text)
+        return response.text # Retorna o texto da resposta do Gemini
+    except Exception as e:
+        if compartilhavel and lider:
+            agrupador_chamadas.concluir(chave_cache, chamada, erro=e)
+        registrar_no_rastro(segundos=time.perf_counter() - inicio, erro=e)
+        if propagar_erros:
+            raise
+        if not isinstance(e, ErroCircuitoAberto):
+            print(f"⚠️ Erro ao enviar mensagem para o Gemini ou obter resposta: {e}")
+        return resposta_alternativa(pergunta_usuario, e)
+
+def obter_resposta_gemini_em_trechos(pergunta_usuario, tipo_cache="pergunta", sessao_chat=None, consulta_referencias=None):
+    """
+    Versão em streaming de `obter_resposta_gemini`: entrega a resposta em trechos, à medida
+    que o Gemini os gera, usando `send_message_stream` da sessão de chat.
+
+    O texto completo é montado ao final para ser guardado no cache (se `resposta_compartilhavel`
+    permitir). O tempo até o primeiro trecho e o tempo total são registrados separadamente
+    em `estatisticas_latencia`.
+
+    Args:
+        pergunta_usuario (str): A pergunta feita pelo usuário.
+        tipo_cache (str): Separa no cache as perguntas livres das buscas de medicamentos.
+        sessao_chat (optional): Sessão de chat da conversa. Se omitida, usa a sessão global (`obter_sessao_chat`).
+        consulta_referencias (str, optional): Texto usado para recuperar os trechos de referência.
+
+    Yields:
+        str: Trechos da resposta (ou a resposta inteira, se vier do cache ou for uma mensagem de erro).
+    """
+    sessao_chat = sessao_chat or obter_sessao_chat()
+    if not sessao_chat:
+        yield MENSAGEM_SESSAO_INATIVA
+        return
+
+    compartilhavel = resposta_compartilhavel(sessao_chat)
+    chave_cache = chamada = None
+    lider = True
+    if compartilhavel:
+        chave_cache = cache_respostas.gerar_chave(pergunta_usuario, tipo_cache)
+        resposta_em_cache = cache_respostas.obter(chave_cache)
+        if resposta_em_cache is not None:
+            registrar_no_rastro(em_cache=True)
+            yield resposta_em_cache
+            return
+        # Quem chega enquanto a mesma pergunta está em andamento recebe a resposta inteira ao final dela
+        chamada, lider = agrupador_chamadas.iniciar(chave_cache)
+    if not lider:
+        try:
+            resposta = agrupador_chamadas.aguardar(chamada, chamador_modelo.prazo_total)
+        except Exception as e:
+            registrar_no_rastro(erro=e)
+            yield resposta_alternativa(pergunta_usuario, e)
+            return
+        registrar_no_rastro(em_cache=True)
+        yield resposta
+        return
+
+    trechos = []
+    resposta_completa = None
+    erro = None
+    inicio = time.perf_counter()
+    try:
+        referencias = montar_contexto_recuperado(consulta_referencias or pergunta_usuario)
+        for chunk in sessao_chat.send_message_stream(montar_prompt_gemini(pergunta_usuario), referencias=referencias):
+            if not chunk.text:
+                continue
+            if not trechos:
+                estatisticas_latencia.registrar("gemini_primeiro_trecho", time.perf_counter() - inicio)
+            trechos.append(chunk.text)
+            yield chunk.text
+        resposta_completa = "".join(trechos)
+    except Exception as e:
+        erro = e
+    finally:
+        # Também se o consumidor abandonar o gerador no meio: quem está esperando não pode ficar preso
+        if resposta_completa is None and erro is None:
+            erro_interrupcao = RuntimeError("A resposta em streaming foi interrompida.")
+        else:
+            erro_interrupcao = erro
+        if compartilhavel:
+            agrupador_chamadas.concluir(chave_cache, chamada, resultado=resposta_completa, erro=erro_interrupcao)
+    if erro is not None:
+        registrar_no_rastro(segundos=time.perf_counter() - inicio, erro=erro)
+        if not isinstance(erro, ErroCircuitoAberto):
+            print(f"⚠️ Erro ao receber a resposta do Gemini em streaming: {erro}")
+        # Uma resposta interrompida no meio não vai para o cache
+        yield "\n\n" + MENSAGEM_ERRO_GEMINI if trechos else resposta_alternativa(pergunta_usuario, erro)
+        return
+    duracao = time.perf_counter() - inicio
+    estatisticas_latencia.registrar("gemini_total", duracao)
+    cache_respostas.registrar_latencia_modelo(duracao)
+    registrar_no_rastro(segundos=duracao, em_cache=False, tokens=ultimo_uso_tokens(sessao_chat))
+    if compartilhavel and resposta_completa:
+        cache_respostas.guardar(chave_cache, resposta_completa)
+
+def ultimo_uso_tokens(sessao_chat):
+    """Retorna as contagens de tokens da última pergunta da sessão (dicionário vazio se indisponível)."""
+    turnos = getattr(sessao_chat, "tokens_por_turno", None)
+    return turnos[-1] if turnos else {}
+
+def montar_prompt_gemini(pergunta_usuario):
+    """
+    Monta a mensagem do usuário enviada ao Gemini.
+    A persona (`PERSONA_ASSISTENTE`) vai como instrução de sistema pelo `GerenciadorContexto`,
+    e por isso não é repetida em cada mensagem nem acumulada no histórico.
+
+    Args:
+        pergunta_usuario (str): A pergunta feita pelo usuário.
+
+    Returns:
+        str: A mensagem a ser enviada.
+    """
+    return f'Pergunta do Usuário: "{pergunta_usuario}"'
+
+def buscar_informacao_online_com_gemini(termo_de_busca, sites_especificos=None, sessao_chat=None, propagar_erros=False):
+    """
+    Utiliza o Gemini para buscar ou gerar informações sobre um termo específico,
+    com foco opcional em sites prioritários.
+
+    Args:
+        termo_de_busca (str): O termo ou pergunta para a busca.
+        sites_especificos (list, optional): Lista de URLs para focar a busca (informativo para o prompt).
+        sessao_chat (optional): Sessão de chat da conversa. Se omitida, usa a sessão global (`obter_sessao_chat`).
+        propagar_erros (bool): Repassa os erros da API ao chamador (veja `obter_resposta_gemini`).
+
+    Returns:
+        str: A resposta gerada pelo Gemini.
+    """
+    # Chama a função que interage com o Gemini (o cache de respostas também vale para as buscas)
+    query_para_gemini = montar_consulta_busca(termo_de_busca, sites_especificos)
+    return obter_resposta_gemini(query_para_gemini, tipo_cache="busca", sessao_chat=sessao_chat,
+                                 propagar_erros=propagar_erros, consulta_referencias=termo_de_busca)
+
+def montar_consulta_busca(termo_de_busca, sites_especificos=None):
+    """
+    Constrói uma query mais elaborada para o Gemini, indicando o foco da busca.
+
+    Args:
+        termo_de_busca (str): O termo ou pergunta para a busca.
+        sites_especificos (list, optional): Lista de URLs para focar a busca (informativo para o prompt).
+
+    Returns:
+        str: A consulta a ser enviada ao Gemini.
+    """
+    query_para_gemini = f"Preciso de informações sobre: '{termo_de_busca}'."
+    if sites_especificos:
+        # As listas conhecidas são citadas pelo nome, bem mais curto que a URL (o modelo não acessa os links)
+        nomes_por_url = {url: descricao for descricao, url in LISTAS_ESTADUAIS.values()}
+        sites = [nomes_por_url.get(site, site) for site in sites_especificos]
+        query_para_gemini += f" Por favor, foque sua resposta em informações que seriam encontradas ou relacionadas aos seguintes sites (contexto estadual de São Paulo): {'; '.join(sites)}."
+    else:
+        # Se não houver sites específicos, pede para focar no contexto geral do saude.sp.gov.br
+        query_para_gemini += " Por favor, foque sua resposta em informações relevantes para o sistema de saúde de São Paulo, como as encontradas no site saude.sp.gov.br."
+    return query_para_gemini
+
+
+def apresentar_boas_vindas_e_opcoes():
+    """
+    Apresenta a mensagem de boas-vindas e as opções principais do menu do chatbot.
     """
     print("\n" + "=" * 72)
     print(f"🤖 {respostas_fixas_tatui.get('Olá', 'Bem-vindo(a) ao Assistente Virtual!')}")
@@ -246,84 +2990,259 @@ def apresentar_boas_vindas_e_opcoes():
     print("Digite 'sair' a qualquer momento para encerrar.")
     print("=" * 72)
 
-def processar_escolha_usuario():
+class EstadoConversa:
+    """
+    Guarda o estado de uma conversa entre uma mensagem e outra.
+
+    Attributes:
+        aguardando (str): 'medicamento' ou 'pergunta' quando a opção 3 ou 7 do menu foi
+            escolhida e o chatbot espera o complemento; None caso contrário.
+    """
+
+    def __init__(self):
+        self.aguardando = None
+
+
+class DecisaoRota:
+    """
+    Resultado da classificação de uma entrada do usuário, sem efeitos colaterais.
+
+    Attributes:
+        rota (str): Caminho escolhido ('fixa_exata', 'fixa_aproximada', 'menu', 'catalogo', 'gemini', 'gemini_busca', etc.).
+        resposta (str): Texto pronto para exibir, quando a resposta não depende do Gemini.
+        pergunta_modelo (str): Pergunta ou termo a ser enviado ao Gemini, quando necessário.
+        encerrar (bool): True quando o usuário pediu para sair.
+        aguardando_complemento (bool): True quando `resposta` é uma pergunta de acompanhamento
+            (por exemplo, o nome do medicamento na opção 3).
+    """
+
+    def __init__(self, rota, resposta=None, pergunta_modelo=None, encerrar=False, aguardando_complemento=False):
+        self.rota = rota
+        self.resposta = resposta
+        self.pergunta_modelo = pergunta_modelo
+        self.encerrar = encerrar
+        self.aguardando_complemento = aguardando_complemento
+
+    @property
+    def precisa_modelo(self):
+        """True se a resposta ainda precisa ser obtida do Gemini."""
+        return self.resposta is None and self.pergunta_modelo is not None
+
+
+# Opções do menu que levam diretamente a uma resposta fixa
+OPCOES_MENU_RESPOSTAS_FIXAS = {
+    '1': "Nova solicitação.",
+    '2': "Renovação.",
+    '4': "Qual o horário de funcionamento e contato da Assistência Farmacêutica?",
+    '5': "O que significa ser legalmente incapaz?",
+    '6': "Como posso acompanhar meu pedido?",
+}
+
+
+def classificar_entrada(escolha_input, estado):
+    """
+    Decide como responder a uma entrada do usuário, seja uma escolha do menu ou uma pergunta direta.
+    É uma função pura: não lê do teclado, não imprime e não chama o Gemini, apenas atualiza
+    o `estado` da conversa. Por isso é compartilhada pelo modo de linha de comando e pelo servidor.
+
+    Args:
+        escolha_input (str): O texto digitado pelo usuário.
+        estado (EstadoConversa): O estado da conversa.
+
+    Returns:
+        DecisaoRota: A rota escolhida e, se já disponível, a resposta.
+    """
+    escolha_input = escolha_input.strip()
+
+    # Complemento das opções 3 (medicamento) e 7 (pergunta direta)
+    aguardando, estado.aguardando = estado.aguardando, None
+    if aguardando == 'medicamento':
+        if not escolha_input:
+            return DecisaoRota("menu", resposta="Nome do medicamento não fornecido. Por favor, tente novamente.")
+        # Primeiro consulta o catálogo local das listas estaduais
+        itens = catalogo_medicamentos.buscar(escolha_input)
+        if itens:
+            return DecisaoRota("catalogo", resposta=formatar_resposta_catalogo(escolha_input, itens))
+        # Se não encontrar, a busca é feita pelo Gemini, com foco nos sites estaduais.
+        return DecisaoRota("gemini_busca", pergunta_modelo=escolha_input)
+    if aguardando == 'pergunta':
+        if not escolha_input:
+            return DecisaoRota("menu", resposta="Nenhuma pergunta fornecida. Por favor, digite sua dúvida.")
+        # Verifica se a pergunta direta tem uma resposta fixa (exata ou aproximada) antes de ir para o Gemini
+        resposta, rota = buscar_resposta_fixa(escolha_input)
+        if resposta is None: # Se não houver resposta fixa, usa o Gemini
+            return DecisaoRota("gemini", pergunta_modelo=escolha_input)
+        return DecisaoRota(rota, resposta=resposta)
+
+    # Validação básica da entrada
+    if not escolha_input:
+        return DecisaoRota("vazia", resposta="Por favor, digite algo ou escolha uma opção.")
+
+    # Condição de saída do chatbot
+    if escolha_input.lower() == 'sair':
+        return DecisaoRota("sair", resposta=respostas_fixas_tatui.get('sair', 'Até logo!'), encerrar=True)
+
+    # Lógica para determinar a resposta:
+    # 1. Verifica se a entrada é uma chave exata no dicionário de respostas fixas.
+    # 2. Verifica se é uma opção numérica do menu.
+    # 3. Verifica se a entrada é parecida o bastante com uma pergunta de resposta fixa.
+    # 4. Se não for nenhuma das anteriores, trata como pergunta para o Gemini.
+    if escolha_input in respostas_fixas_tatui:
+        return DecisaoRota("fixa_exata", resposta=respostas_fixas_tatui[escolha_input])
+    if escolha_input in OPCOES_MENU_RESPOSTAS_FIXAS:
+        chave = OPCOES_MENU_RESPOSTAS_FIXAS[escolha_input]
+        return DecisaoRota("menu", resposta=respostas_fixas_tatui.get(chave, "Informação não encontrada."))
+    if escolha_input == '3':
+        estado.aguardando = 'medicamento'
+        return DecisaoRota("menu", resposta="💊 Qual medicamento você gostaria de verificar (nome do princípio ativo)? ",
+                           aguardando_complemento=True)
+    if escolha_input == '7':
+        estado.aguardando = 'pergunta'
+        return DecisaoRota("menu", resposta="❓ Qual sua dúvida? ", aguardando_complemento=True)
+
+    # Se não for uma opção numérica nem uma chave exata, tenta a correspondência aproximada
+    # com as respostas fixas e, só se não houver, trata como pergunta direta para o Gemini.
+    resposta, rota = buscar_resposta_fixa(escolha_input)
+    if resposta is None:
+        return DecisaoRota("gemini", pergunta_modelo=escolha_input)
+    return DecisaoRota(rota, resposta=resposta)
+
+
+def montar_pergunta_medicamento(medicamento):
+    """Monta a pergunta da opção 3 do menu para um medicamento (princípio ativo)."""
+    return f"O medicamento '{medicamento}' (princípio ativo) está na lista do Componente Especializado da Assistência Farmacêutica de São Paulo?"
+
+
+def executar_decisao(decisao, sessao_chat=None, propagar_erros=False):
+    """
+    Obtém o texto final de uma decisão, chamando o Gemini quando necessário.
+    Esta é a única etapa do roteamento que pode demorar (chamada de rede).
+
+    Args:
+        decisao (DecisaoRota): A decisão retornada por `classificar_entrada`.
+        sessao_chat (optional): Sessão de chat da conversa. Se omitida, usa a sessão global.
+        propagar_erros (bool): Repassa os erros da API ao chamador (veja `obter_resposta_gemini`).
+
+    Returns:
+        str: A resposta a ser mostrada ao usuário.
+    """
+    if not decisao.precisa_modelo:
+        return decisao.resposta
+    if decisao.rota == "gemini_busca":
+        return buscar_informacao_online_com_gemini(
+            montar_pergunta_medicamento(decisao.pergunta_modelo),
+            sites_especificos=SITES_PRIORITARIOS_ESTADUAIS,
+            sessao_chat=sessao_chat,
+            propagar_erros=propagar_erros,
+        )
+    return obter_resposta_gemini(decisao.pergunta_modelo, sessao_chat=sessao_chat, propagar_erros=propagar_erros)
+
+
+def executar_decisao_em_trechos(decisao, sessao_chat=None):
+    """
+    Versão em streaming de `executar_decisao`. Usada pelo terminal e pelo WebSocket
+    para mostrar a resposta do Gemini enquanto ela é gerada.
+
+    Args:
+        decisao (DecisaoRota): A decisão retornada por `classificar_entrada`.
+        sessao_chat (optional): Sessão de chat da conversa. Se omitida, usa a sessão global.
+
+    Yields:
+        str: Trechos da resposta. Respostas fixas são entregues em um único trecho.
+    """
+    if not decisao.precisa_modelo:
+        yield decisao.resposta
+        return
+    if decisao.rota == "gemini_busca":
+        pergunta = montar_pergunta_medicamento(decisao.pergunta_modelo)
+        consulta = montar_consulta_busca(pergunta, SITES_PRIORITARIOS_ESTADUAIS)
+        yield from obter_resposta_gemini_em_trechos(consulta, tipo_cache="busca", sessao_chat=sessao_chat,
+                                                    consulta_referencias=pergunta)
+        return
+    yield from obter_resposta_gemini_em_trechos(decisao.pergunta_modelo, sessao_chat=sessao_chat)
+
+
+def exibir_menu_resumido():
+    """
+    Apresenta um menu resumido para facilitar a próxima interação.
+    """
+    print("\n" + "-" * 72)
+    print("Posso ajudar com mais alguma coisa? Escolha uma opção ou digite 'sair'.")
+    print("1. Nova Solicitação | 2. Renovação | 3. Verificar Medicamento (Estadual)")
+    print("4. Contato AF Tatuí | 5. Incapacidade Legal | 6. Acompanhar Pedido (Tatuí)")
+    print("7. Outra Pergunta")
+    print("-" * 72)
+
+
+def classificar_no_terminal(texto, estado):
+    """
+    Classifica uma entrada digitada no terminal, abrindo o rastro do turno.
+
+    Returns:
+        tuple: (DecisaoRota, RastroTurno)
+    """
+    rastro = RastroTurno("terminal")
+    with rastro.etapa("classificacao"):
+        decisao = perfil_despacho.medir(classificar_entrada, texto, estado)
+    return decisao, rastro
+
+def exibir_resposta(decisao):
+    """Executa a decisão e mostra a resposta no terminal (em trechos, se o streaming estiver ativo)."""
+    if decisao.precisa_modelo and decisao.rota == "gemini_busca":
+        print(f"\n🔍 Usando Gemini para buscar informações sobre: '{montar_pergunta_medicamento(decisao.pergunta_modelo)}'")
+    if STREAMING_ATIVO and decisao.precisa_modelo:
+        # Mostra cada trecho assim que chega, em vez de esperar a resposta completa.
+        # A sessão é obtida antes para que avisos da inicialização do Gemini não se misturem à resposta.
+        sessao_chat = obter_sessao_chat()
+        print("\nChatbot: ", end="", flush=True)
+        for trecho in executar_decisao_em_trechos(decisao, sessao_chat):
+            print(trecho, end="", flush=True)
+        print()
+    else:
+        print(f"\nChatbot: {executar_decisao(decisao)}")
+
+def processar_escolha_usuario(estado=None):
     """
     Processa a entrada do usuário, seja uma escolha do menu ou uma pergunta direta.
     Direciona para a resposta apropriada (fixa ou via Gemini).
 
+    Args:
+        estado (EstadoConversa, optional): Estado da conversa no terminal. Criado se omitido.
+
     Returns:
         bool: False se o usuário digitar 'sair', True caso contrário, para controlar o loop principal.
     """
+    estado = estado or EstadoConversa()
     while True:
-        escolha_input = input("\n👉 Sua opção ou pergunta: ").strip()
+        decisao, rastro = classificar_no_terminal(input("\n👉 Sua opção ou pergunta: "), estado)
+        # Opções 3 e 7 pedem um complemento antes de responder
+        while decisao.aguardando_complemento:
+            decisao, rastro = classificar_no_terminal(input(decisao.resposta), estado)
 
-        # Validação básica da entrada
-        if not escolha_input:
-            print("Por favor, digite algo ou escolha uma opção.")
+        if decisao.rota == "vazia":
+            print(decisao.resposta)
             continue
 
         # Condição de saída do chatbot
-        if escolha_input.lower() == 'sair':
-            print(f"\nChatbot: {respostas_fixas_tatui.get('sair', 'Até logo!')}")
+        if decisao.encerrar:
+            print(f"\nChatbot: {decisao.resposta}")
+            if os.environ.get("CEAF_MOSTRAR_ESTATISTICAS"):
+                print(f"\n📊 Rotas utilizadas:\n{estatisticas_rotas.relatorio()}")
+                print(f"\n🗄️ Cache de respostas do Gemini:\n{cache_respostas.relatorio()}")
+                print(f"\n⏱️ Latência do Gemini:\n{estatisticas_latencia.relatorio()}")
             return False # Sinaliza para encerrar o loop principal do chatbot
 
-        resposta_chatbot = "" # Inicializa a variável de resposta
-
-        # Lógica para determinar a resposta:
-        # 1. Verifica se a entrada é uma chave exata no dicionário de respostas fixas.
-        # 2. Verifica se é uma opção numérica do menu.
-        # 3. Se não for nenhuma das anteriores, trata como pergunta para o Gemini.
-
-        if escolha_input in respostas_fixas_tatui:
-            resposta_chatbot = respostas_fixas_tatui[escolha_input]
-        elif escolha_input == '1':
-            resposta_chatbot = respostas_fixas_tatui.get("Nova solicitação.", "Informação não encontrada.")
-        elif escolha_input == '2':
-            resposta_chatbot = respostas_fixas_tatui.get("Renovação.", "Informação não encontrada.")
-        elif escolha_input == '3':
-            medicamento = input("💊 Qual medicamento você gostaria de verificar (nome do princípio ativo)? ").strip()
-            if medicamento:
-                # A busca é feita pelo Gemini, com foco nos sites estaduais.
-                resposta_chatbot = buscar_informacao_online_com_gemini(
-                    f"O medicamento '{medicamento}' (princípio ativo) está na lista do Componente Especializado da Assistência Farmacêutica de São Paulo?",
-                    sites_especificos=SITES_PRIORITARIOS_ESTADUAIS
-                )
-            else:
-                resposta_chatbot = "Nome do medicamento não fornecido. Por favor, tente novamente."
-        elif escolha_input == '4':
-            resposta_chatbot = respostas_fixas_tatui.get("Qual o horário de funcionamento e contato da Assistência Farmacêutica?", "Informação não encontrada.")
-        elif escolha_input == '5':
-            resposta_chatbot = respostas_fixas_tatui.get("O que significa ser legalmente incapaz?", "Informação não encontrada.")
-        elif escolha_input == '6':
-            resposta_chatbot = respostas_fixas_tatui.get("Como posso acompanhar meu pedido?", "Informação não encontrada.")
-        elif escolha_input == '7':
-            pergunta_direta = input("❓ Qual sua dúvida? ").strip()
-            if pergunta_direta:
-                # Verifica se a pergunta direta tem uma resposta fixa antes de ir para o Gemini
-                if pergunta_direta in respostas_fixas_tatui:
-                    resposta_chatbot = respostas_fixas_tatui[pergunta_direta]
-                else: # Se não houver resposta fixa, usa o Gemini
-                    resposta_chatbot = obter_resposta_gemini(pergunta_direta)
-            else:
-                resposta_chatbot = "Nenhuma pergunta fornecida. Por favor, digite sua dúvida."
-        else:
-            # Se não for uma opção numérica nem uma chave exata, trata como pergunta direta para o Gemini.
-            # (Re-verifica se a entrada já não é uma chave, embora o primeiro `if` já cubra isso)
-            if escolha_input in respostas_fixas_tatui:
-                 resposta_chatbot = respostas_fixas_tatui[escolha_input]
-            else:
-                resposta_chatbot = obter_resposta_gemini(escolha_input)
+        estatisticas_rotas.registrar(decisao.rota)
 
         # Exibe a resposta do chatbot
-        print(f"\nChatbot: {resposta_chatbot}")
-
-        # Apresenta um menu resumido para facilitar a próxima interação
-        print("\n" + "-" * 72)
-        print("Posso ajudar com mais alguma coisa? Escolha uma opção ou digite 'sair'.")
-        print("1. Nova Solicitação | 2. Renovação | 3. Verificar Medicamento (Estadual)")
-        print("4. Contato AF Tatuí | 5. Incapacidade Legal | 6. Acompanhar Pedido (Tatuí)")
-        print("7. Outra Pergunta")
-        print("-" * 72)
+        marcador = rastro_atual.set(rastro)
+        try:
+            with rastro.etapa("resposta"):
+                perfil_despacho.medir(exibir_resposta, decisao)
+        finally:
+            rastro_atual.reset(marcador)
+            rastro.finalizar(decisao.rota)
+        exibir_menu_resumido()
     # Este return True não é alcançado devido ao loop infinito interno,
     # a saída é controlada pelo `return False` na condição 'sair'.
     return True
@@ -337,12 +3256,823 @@ def iniciar_chatbot():
     while processar_escolha_usuario():
         pass # A lógica de continuação está dentro de processar_escolha_usuario
 
+# --- Modo Servidor (vários usuários simultâneos) ---
+# Configurações do servidor (podem ser alteradas por variáveis de ambiente).
+SERVIDOR_HOST = os.environ.get("CEAF_SERVIDOR_HOST", "127.0.0.1")
+SERVIDOR_PORTA = int(os.environ.get("CEAF_SERVIDOR_PORTA", "8080"))
+LIMITE_CHAMADAS_MODELO = int(os.environ.get("CEAF_LIMITE_CHAMADAS_MODELO", "16")) # Chamadas simultâneas ao Gemini
+MAX_CONVERSAS = int(os.environ.get("CEAF_MAX_CONVERSAS", "1000"))
+OCIOSIDADE_MAX_SEGUNDOS = float(os.environ.get("CEAF_OCIOSIDADE_MAX", "1800"))
+TAMANHO_MAX_MENSAGEM = 64 * 1024 # Limite de bytes por requisição HTTP ou mensagem WebSocket
+# O módulo asyncio é importado dentro dos métodos do servidor: ele só é necessário neste modo
+# e sua importação (que inclui ssl) custaria dezenas de milissegundos na inicialização do terminal.
+
+GUID_WEBSOCKET = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11" # Valor fixo da RFC 6455
+
+
+class Conversa:
+    """
+    Uma conversa no modo servidor: estado do menu e sessão de chat própria com o Gemini,
+    para que o histórico de um paciente não se misture com o de outro.
+    """
+
+    def __init__(self, conversa_id):
+        self.conversa_id = conversa_id
+        self.estado = EstadoConversa()
+        self.sessao_chat = None # Criada apenas na primeira pergunta que precisar do Gemini
+        self.ultimo_uso = time.monotonic()
+        self.trava = None # asyncio.Lock que garante a ordem das mensagens da conversa
+
+
+class PoolSessoesChat:
+    """
+    Conjunto limitado de conversas ativas, cada uma com sua sessão de chat do Gemini.
+
+    Conversas ociosas por mais de `ociosidade_max` segundos são descartadas, e quando
+    o limite `max_conversas` é atingido a conversa usada há mais tempo dá lugar à nova.
+    """
+
+    def __init__(self, max_conversas=MAX_CONVERSAS, ociosidade_max=OCIOSIDADE_MAX_SEGUNDOS):
+        self.max_conversas = max_conversas
+        self.ociosidade_max = ociosidade_max
+        self.conversas = OrderedDict() # conversa_id -> Conversa
+        self.trava = threading.Lock()
+
+    def obter(self, conversa_id):
+        """
+        Retorna a conversa com o id informado, criando-a se necessário.
+
+        Args:
+            conversa_id (str): Identificador da conversa (definido pelo cliente).
+
+        Returns:
+            Conversa: A conversa correspondente.
+        """
+        with self.trava:
+            conversa = self.conversas.get(conversa_id)
+            if conversa is None:
+                conversa = Conversa(conversa_id)
+                self.conversas[conversa_id] = conversa
+                while len(self.conversas) > self.max_conversas:
+                    self.conversas.popitem(last=False)
+            self.conversas.move_to_end(conversa_id)
+            conversa.ultimo_uso = time.monotonic()
+            return conversa
+
+    def obter_sessao_chat(self, conversa):
+        """
+        Retorna a sessão de chat da conversa, criando-a no primeiro uso.
+
+        Returns:
+            A sessão de chat do Gemini, ou None se o cliente não estiver disponível.
+        """
+        if conversa.sessao_chat is None:
+            conversa.sessao_chat = criar_sessao_chat()
+        return conversa.sessao_chat
+
+    def remover_ociosas(self):
+        """
+        Remove as conversas sem atividade há mais de `ociosidade_max` segundos.
+
+        Returns:
+            int: Quantidade de conversas removidas.
+        """
+        limite = time.monotonic() - self.ociosidade_max
+        with self.trava:
+            ociosas = [cid for cid, conversa in self.conversas.items() if conversa.ultimo_uso < limite]
+            for conversa_id in ociosas:
+                del self.conversas[conversa_id]
+        return len(ociosas)
+
+    def __len__(self):
+        return len(self.conversas)
+
+
+class ServidorChatbot:
+    """
+    Servidor HTTP/WebSocket baseado em asyncio que atende várias conversas ao mesmo tempo.
+
+    Rotas:
+        POST /mensagem  Corpo JSON {"conversa": "<id>", "texto": "<mensagem>"}.
+        GET  /ws        WebSocket (use ?conversa=<id>); cada mensagem de texto recebe uma resposta JSON
+                        ({"tipo": "resposta", ...}). Com ?streaming=1, os trechos da resposta do Gemini
+                        chegam antes, como {"tipo": "trecho", "texto": "..."}.
+        GET  /saude     Situação do servidor.
+
+    O roteamento usa `classificar_entrada`; só as decisões que precisam do Gemini vão para
+    um pool de threads, limitado por `limite_chamadas_modelo`, e nunca bloqueiam o loop de eventos.
+    """
+
+    def __init__(self, pool=None, limite_chamadas_modelo=LIMITE_CHAMADAS_MODELO):
+        self.pool = pool or PoolSessoesChat()
+        self.limite_chamadas_modelo = limite_chamadas_modelo
+        self.executor = ThreadPoolExecutor(max_workers=limite_chamadas_modelo, thread_name_prefix="gemini")
+        self.semaforo = None # Criado dentro do loop de eventos
+        self.chamadas_em_andamento = 0
+        metricas.registrar_medidor("ceaf_conversas_ativas", lambda: len(self.pool))
+        metricas.registrar_medidor("ceaf_chamadas_modelo_em_andamento", lambda: self.chamadas_em_andamento)
+
+    async def responder(self, conversa_id, texto, ao_receber_trecho=None):
+        """
+        Processa uma mensagem de uma conversa e retorna o resultado como dicionário.
+
+        Args:
+            conversa_id (str): Identificador da conversa.
+            texto (str): Mensagem do usuário.
+            ao_receber_trecho (callable, optional): Corrotina chamada com cada trecho da resposta
+                do Gemini assim que ele chega (streaming). Se omitida, espera a resposta completa.
+
+        Returns:
+            dict: Campos 'conversa', 'resposta', 'rota', 'aguardando' e 'encerrar'.
+        """
+        import asyncio
+        conversa = self.pool.obter(conversa_id)
+        if conversa.trava is None:
+            conversa.trava = asyncio.Lock()
+        # Mensagens da mesma conversa são atendidas em ordem; conversas diferentes, em paralelo
+        async with conversa.trava:
+            # Cada conexão roda em sua própria tarefa, então o rastro em `rastro_atual` é só desta mensagem
+            rastro = RastroTurno("servidor")
+            rastro_atual.set(rastro)
+            with rastro.etapa("classificacao"):
+                decisao = perfil_despacho.medir(classificar_entrada, texto, conversa.estado)
+            try:
+                with rastro.etapa("resposta"):
+                    if decisao.precisa_modelo and ao_receber_trecho is not None:
+                        resposta = await self._executar_em_trechos(decisao, conversa, ao_receber_trecho)
+                    elif decisao.precisa_modelo:
+                        resposta = await self.executar_no_pool(self._executar_com_sessao, decisao, conversa)
+                    else:
+                        resposta = decisao.resposta
+            finally:
+                rastro.finalizar(decisao.rota)
+            if decisao.rota != "vazia":
+                estatisticas_rotas.registrar(decisao.rota)
+        return {
+            "conversa": conversa_id,
+            "resposta": resposta,
+            "rota": decisao.rota,
+            "aguardando": conversa.estado.aguardando,
+            "encerrar": decisao.encerrar,
+        }
+
+    def _executar_com_sessao(self, decisao, conversa):
+        return perfil_despacho.medir(executar_decisao, decisao, sessao_chat=self.pool.obter_sessao_chat(conversa))
+
+    async def _executar_em_trechos(self, decisao, conversa, ao_receber_trecho):
+        import asyncio
+        # O gerador bloqueante roda no pool de threads e entrega os trechos ao loop de eventos por uma fila
+        loop = asyncio.get_running_loop()
+        fila = asyncio.Queue()
+        fim = object()
+
+        def produzir():
+            try:
+                for trecho in executar_decisao_em_trechos(decisao, self.pool.obter_sessao_chat(conversa)):
+                    loop.call_soon_threadsafe(fila.put_nowait, trecho)
+            finally:
+                loop.call_soon_threadsafe(fila.put_nowait, fim)
+
+        tarefa = asyncio.ensure_future(self.executar_no_pool(produzir))
+        trechos = []
+        while (trecho := await fila.get()) is not fim:
+            trechos.append(trecho)
+            await ao_receber_trecho(trecho)
+        await tarefa
+        return "".join(trechos)
+
+    async def executar_no_pool(self, funcao, *args):
+        """Executa uma função bloqueante (chamada ao Gemini) no pool de threads, respeitando o limite de concorrência."""
+        import asyncio
+        inicio_espera = time.perf_counter()
+        async with self.semaforo:
+            metricas.observar("ceaf_espera_pool_segundos", time.perf_counter() - inicio_espera)
+            self.chamadas_em_andamento += 1
+            try:
+                # O contexto é copiado para que a função enxergue o rastro do turno (`rastro_atual`)
+                contexto = contextvars.copy_context()
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, functools.partial(contexto.run, funcao, *args))
+            finally:
+                self.chamadas_em_andamento -= 1
+
+    async def tratar_conexao(self, leitor, escritor):
+        """Atende uma conexão TCP: uma ou mais requisições HTTP ou uma sessão WebSocket."""
+        import asyncio
+        try:
+            while True:
+                requisicao = await self._ler_requisicao(leitor)
+                if requisicao is None:
+                    break
+                metodo, caminho, cabecalhos, corpo = requisicao
+                if corpo is None:
+                    erro = {"erro": f"O corpo da requisição excede o limite de {TAMANHO_MAX_MENSAGEM} bytes."}
+                    self._escrever_json(escritor, 413, erro, manter_conexao=False)
+                    await escritor.drain()
+                    break
+                url = urlsplit(caminho)
+                if url.path == "/ws" and cabecalhos.get("upgrade", "").lower() == "websocket":
+                    consulta = parse_qs(url.query)
+                    conversa_id = consulta.get("conversa", [uuid.uuid4().hex])[0]
+                    streaming = consulta.get("streaming", ["0"])[0] == "1"
+                    await self._tratar_websocket(leitor, escritor, cabecalhos, conversa_id, streaming)
+                    break
+                status, dados = await self._tratar_http(metodo, url.path, corpo)
+                manter_conexao = cabecalhos.get("connection", "").lower() != "close"
+                self._escrever_json(escritor, status, dados, manter_conexao)
+                await escritor.drain()
+                if not manter_conexao:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            escritor.close()
+
+    @staticmethod
+    async def _ler_requisicao(leitor):
+        linha = await leitor.readline()
+        if not linha:
+            return None
+        try:
+            metodo, caminho, _ = linha.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return None
+        cabecalhos = {}
+        while True:
+            linha = await leitor.readline()
+            if linha in (b"\r\n", b"\n", b""):
+                break
+            nome, _, valor = linha.decode("latin-1").partition(":")
+            cabecalhos[nome.strip().lower()] = valor.strip()
+        try:
+            tamanho = int(cabecalhos.get("content-length") or 0)
+        except ValueError:
+            return None
+        if tamanho < 0:
+            return None
+        if tamanho > TAMANHO_MAX_MENSAGEM:
+            # O corpo não é lido: quem chama responde 413 e fecha a conexão, para que os bytes
+            # restantes não sejam interpretados como uma nova requisição
+            return metodo.upper(), caminho, cabecalhos, None
+        corpo = await leitor.readexactly(tamanho) if tamanho else b""
+        return metodo.upper(), caminho, cabecalhos, corpo
+
+    async def _tratar_http(self, metodo, caminho, corpo):
+        if metodo == "GET" and caminho == "/saude":
+            return 200, {
+                "status": "ok",
+                "conversas": len(self.pool),
+                "chamadas_modelo_em_andamento": self.chamadas_em_andamento,
+                "fila_modelo": len(agendador_modelo),
+            }
+        if metodo == "GET" and caminho == "/metricas":
+            return 200, metricas.exportar_prometheus() # Texto no formato do Prometheus
+        if metodo == "GET" and caminho == "/metricas.json":
+            return 200, metricas.instantaneo()
+        if metodo == "POST" and caminho == "/mensagem":
+            try:
+                dados = json.loads(corpo.decode("utf-8") or "{}")
+                texto = str(dados.get("texto", ""))
+            except (ValueError, AttributeError):
+                return 400, {"erro": "Corpo da requisição deve ser um JSON com o campo 'texto'."}
+            conversa_id = str(dados.get("conversa") or uuid.uuid4().hex)
+            return 200, await self.responder(conversa_id, texto)
+        return 404, {"erro": "Rota não encontrada."}
+
+    @staticmethod
+    def _escrever_json(escritor, status, dados, manter_conexao=True):
+        # Textos (como a exportação para o Prometheus) são enviados como estão, em text/plain
+        if isinstance(dados, str):
+            corpo, tipo = dados.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            corpo, tipo = json.dumps(dados, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+        motivos = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large"}
+        escritor.write(
+            f"HTTP/1.1 {status} {motivos.get(status, 'OK')}\r\n"
+            f"Content-Type: {tipo}\r\n"
+            f"Content-Length: {len(corpo)}\r\n"
+            f"Connection: {'keep-alive' if manter_conexao else 'close'}\r\n\r\n".encode("latin-1") + corpo
+        )
+
+    async def _tratar_websocket(self, leitor, escritor, cabecalhos, conversa_id, streaming=False):
+        chave = cabecalhos.get("sec-websocket-key", "")
+        aceite = base64.b64encode(hashlib.sha1((chave + GUID_WEBSOCKET).encode("ascii")).digest()).decode("ascii")
+        escritor.write(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {aceite}\r\n\r\n".encode("latin-1")
+        )
+        await escritor.drain()
+        while True:
+            quadro = await self._ler_quadro_websocket(leitor)
+            if quadro is None:
+                break
+            opcode, dados = quadro
+            if opcode == 0x8: # Fechamento
+                self._escrever_quadro_websocket(escritor, 0x8, b"")
+                await escritor.drain()
+                break
+            if opcode == 0x9: # Ping
+                self._escrever_quadro_websocket(escritor, 0xA, dados)
+            elif opcode == 0x1: # Texto
+                ao_receber_trecho = None
+                if streaming:
+                    async def ao_receber_trecho(trecho):
+                        mensagem = {"tipo": "trecho", "texto": trecho}
+                        self._escrever_quadro_websocket(escritor, 0x1, json.dumps(mensagem, ensure_ascii=False).encode("utf-8"))
+                        await escritor.drain()
+                resultado = await self.responder(conversa_id, dados.decode("utf-8", errors="replace"), ao_receber_trecho)
+                resultado["tipo"] = "resposta"
+                self._escrever_quadro_websocket(escritor, 0x1, json.dumps(resultado, ensure_ascii=False).encode("utf-8"))
+            await escritor.drain()
+
+    @staticmethod
+    async def _ler_quadro_websocket(leitor):
+        # Lê uma mensagem completa, juntando quadros fragmentados (FIN = 0)
+        mensagem = b""
+        opcode_mensagem = None
+        while True:
+            cabecalho = await leitor.readexactly(2)
+            fim, opcode = cabecalho[0] & 0x80, cabecalho[0] & 0x0F
+            mascarado, tamanho = cabecalho[1] & 0x80, cabecalho[1] & 0x7F
+            if tamanho == 126:
+                tamanho = struct.unpack("!H", await leitor.readexactly(2))[0]
+            elif tamanho == 127:
+                tamanho = struct.unpack("!Q", await leitor.readexactly(8))[0]
+            if len(mensagem) + tamanho > TAMANHO_MAX_MENSAGEM:
+                return None
+            mascara = await leitor.readexactly(4) if mascarado else b"\x00\x00\x00\x00"
+            dados = bytes(b ^ mascara[i % 4] for i, b in enumerate(await leitor.readexactly(tamanho)))
+            if opcode >= 0x8: # Quadros de controle não são fragmentados
+                return opcode, dados
+            if opcode_mensagem is None:
+                opcode_mensagem = opcode
+            mensagem += dados
+            if fim:
+                return opcode_mensagem, mensagem
+
+    @staticmethod
+    def _escrever_quadro_websocket(escritor, opcode, dados):
+        if len(dados) < 126:
+            cabecalho = struct.pack("!BB", 0x80 | opcode, len(dados))
+        elif len(dados) < 65536:
+            cabecalho = struct.pack("!BBH", 0x80 | opcode, 126, len(dados))
+        else:
+            cabecalho = struct.pack("!BBQ", 0x80 | opcode, 127, len(dados))
+        escritor.write(cabecalho + dados)
+
+    async def _limpar_ociosas_periodicamente(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(max(self.pool.ociosidade_max / 10, 1))
+            self.pool.remover_ociosas()
+
+    async def executar(self, host=SERVIDOR_HOST, porta=SERVIDOR_PORTA):
+        """Inicia o servidor e atende conexões até ser interrompido."""
+        import asyncio
+        self.semaforo = asyncio.Semaphore(self.limite_chamadas_modelo)
+        # Carrega as listas antes de abrir a porta; depois elas são relidas fora do loop de eventos
+        catalogo_medicamentos.iniciar()
+        base_conhecimento.carregar()
+        servidor = await asyncio.start_server(self.tratar_conexao, host, porta)
+        limpeza = asyncio.create_task(self._limpar_ociosas_periodicamente())
+        print(f"🌐 Servidor do chatbot ouvindo em http://{host}:{porta} (POST /mensagem, WebSocket /ws)")
+        try:
+            async with servidor:
+                await servidor.serve_forever()
+        finally:
+            limpeza.cancel()
+            self.executor.shutdown(wait=False)
+
+
+def iniciar_servidor(host=SERVIDOR_HOST, porta=SERVIDOR_PORTA):
+    """
+    Inicia o chatbot no modo servidor, atendendo várias conversas simultâneas.
+    """
+    import asyncio
+    try:
+        asyncio.run(ServidorChatbot().executar(host, porta))
+    except KeyboardInterrupt:
+        print("\nServidor encerrado.")
+
+# --- Modo Lote (perguntas em um arquivo JSONL) ---
+LOTE_TRABALHADORES = int(os.environ.get("CEAF_LOTE_TRABALHADORES", "8")) # Chamadas simultâneas ao Gemini
+LOTE_LIMITE_POR_MINUTO = float(os.environ.get("CEAF_LOTE_LIMITE_POR_MINUTO", "60")) # Chamadas ao Gemini por minuto
+LOTE_TENTATIVAS = int(os.environ.get("CEAF_LOTE_TENTATIVAS", "3"))
+
+
+def ler_itens_lote(caminho):
+    """
+    Lê as perguntas de um arquivo JSONL, uma por linha, sem carregar o arquivo inteiro na memória.
+    Cada linha deve ter "pergunta" (ou "texto") e, opcionalmente, "id" e "complemento"
+    (resposta ao pedido das opções 3 e 7 do menu, como o nome do medicamento).
+
+    Yields:
+        dict: Item com 'id', 'pergunta' e 'complemento'.
+    """
+    with open(caminho, encoding="utf-8") as arquivo:
+        for numero, linha in enumerate(arquivo, start=1):
+            linha = linha.strip()
+            if not linha:
+                continue
+            try:
+                dados = json.loads(linha)
+            except ValueError:
+                print(f"⚠️ Linha {numero} ignorada: JSON inválido.")
+                continue
+            if isinstance(dados, str):
+                dados = {"pergunta": dados}
+            yield {
+                "id": str(dados.get("id", numero)),
+                "pergunta": str(dados.get("pergunta", dados.get("texto", ""))),
+                "complemento": str(dados.get("complemento", "")),
+            }
+
+
+def ler_ids_concluidos(caminho_saida):
+    """
+    Retorna os ids já respondidos com sucesso em um arquivo de saída anterior (ponto de retomada).
+    Itens que terminaram com erro não entram, para serem tentados de novo.
+    """
+    concluidos = set()
+    if not os.path.exists(caminho_saida):
+        return concluidos
+    with open(caminho_saida, encoding="utf-8") as arquivo:
+        for linha in arquivo:
+            try:
+                resultado = json.loads(linha)
+            except ValueError:
+                continue # Última linha pode ter ficado incompleta se a execução foi interrompida
+            if not resultado.get("erro"):
+                concluidos.add(str(resultado.get("id")))
+    return concluidos
+
+
+def responder_item_lote(item, decisao, limitador, tentativas=LOTE_TENTATIVAS):
+    """
+    Obtém do Gemini a resposta de um item do lote, respeitando o limite de taxa e repetindo
+    a chamada com espera exponencial em caso de erro. Executada nas threads do pool.
+
+    Returns:
+        dict: Resultado com resposta, latência, tokens e número de tentativas.
+    """
+    # Cada item é uma pergunta independente: usa uma sessão nova, sem histórico de outros itens
+    sessao_chat = criar_sessao_chat()
+    inicio = time.perf_counter()
+    erro = None
+    resposta = None
+    rastro = RastroTurno("lote")
+    marcador = rastro_atual.set(rastro)
+    # As perguntas do lote cedem a vez às conversas interativas no agendador
+    marcador_prioridade = prioridade_modelo.set(PRIORIDADE_LOTE)
+    try:
+        for tentativa in range(1, tentativas + 1):
+            with rastro.etapa("espera_limite"):
+                limitador.consumir()
+            try:
+                with rastro.etapa("resposta"):
+                    resposta = executar_decisao(decisao, sessao_chat, propagar_erros=True)
+                erro = None
+                break
+            except Exception as e:
+                erro = f"{e.__class__.__name__}: {e}"
+                # Erros do próprio pedido se repetiriam; só falhas passageiras (ou o disjuntor aberto) valem nova tentativa
+                if tentativa >= tentativas or not (erro_recuperavel(e) or isinstance(e, ErroCircuitoAberto)):
+                    break
+                time.sleep(min(30.0, 2 ** (tentativa - 1)) * random.uniform(0.5, 1.5))
+    finally:
+        prioridade_modelo.reset(marcador_prioridade)
+        rastro_atual.reset(marcador)
+        rastro.finalizar(decisao.rota)
+    tokens = sessao_chat.tokens_por_turno[-1] if sessao_chat is not None and sessao_chat.tokens_por_turno else {}
+    return {
+        "id": item["id"],
+        "pergunta": item["pergunta"],
+        "complemento": item["complemento"],
+        "rota": decisao.rota,
+        "resposta": resposta,
+        "em_cache": sessao_chat is not None and not sessao_chat.tokens_por_turno and erro is None,
+        "latencia_ms": round((time.perf_counter() - inicio) * 1000, 1),
+        "tokens_prompt": tokens.get("prompt"),
+        "tokens_resposta": tokens.get("resposta"),
+        "tentativas": tentativa,
+        "erro": erro,
+    }
+
+
+def processar_lote(caminho_entrada, caminho_saida, trabalhadores=LOTE_TRABALHADORES,
+                   limite_por_minuto=LOTE_LIMITE_POR_MINUTO):
+    """
+    Responde às perguntas de um arquivo JSONL usando o mesmo roteamento do chatbot
+    (resposta fixa, opção do menu, catálogo ou Gemini) e grava os resultados, um por linha,
+    em `caminho_saida` à medida que ficam prontos.
+
+    As perguntas que precisam do Gemini vão para um pool de `trabalhadores` threads, limitado a
+    `limite_por_minuto` chamadas. A execução pode ser retomada: itens já respondidos com sucesso
+    no arquivo de saída são pulados (em caso de repetição de um id, vale a última linha).
+
+    Returns:
+        Counter: Quantidade de itens por rota, mais 'pulados' e 'erros'.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    concluidos = ler_ids_concluidos(caminho_saida)
+    limitador = BaldeTokens(limite_por_minuto / 60.0, capacidade=max(1.0, trabalhadores))
+    contagem = Counter()
+    inicio = time.perf_counter()
+    pendentes = set()
+
+    with open(caminho_saida, "a", encoding="utf-8") as saida, \
+            ThreadPoolExecutor(max_workers=trabalhadores, thread_name_prefix="lote") as executor:
+
+        def gravar(resultado):
+            saida.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+            saida.flush() # Cada linha gravada é um ponto de retomada
+            contagem["erros" if resultado["erro"] else resultado["rota"]] += 1
+            total = sum(contagem.values()) - contagem["pulados"]
+            if total % 100 == 0:
+                print(f"📦 {total} itens processados ({total / (time.perf_counter() - inicio):.1f}/s)")
+
+        def concluir_prontos(bloquear):
+            prontos, _ = wait(pendentes, return_when=FIRST_COMPLETED) if bloquear else (
+                {f for f in pendentes if f.done()}, None)
+            for futuro in prontos:
+                pendentes.discard(futuro)
+                gravar(futuro.result())
+
+        for item in ler_itens_lote(caminho_entrada):
+            if item["id"] in concluidos:
+                contagem["pulados"] += 1
+                continue
+            estado = EstadoConversa()
+            decisao = classificar_entrada(item["pergunta"], estado)
+            if decisao.aguardando_complemento:
+                decisao = classificar_entrada(item["complemento"], estado)
+            if not decisao.precisa_modelo:
+                gravar({"id": item["id"], "pergunta": item["pergunta"], "complemento": item["complemento"], "rota": decisao.rota,
+                        "resposta": decisao.resposta, "em_cache": False, "latencia_ms": 0.0,
+                        "tokens_prompt": None, "tokens_resposta": None, "tentativas": 0, "erro": None})
+                continue
+            # Limita os itens em andamento para não carregar arquivos grandes inteiros na memória
+            while len(pendentes) >= trabalhadores * 2:
+                concluir_prontos(bloquear=True)
+            pendentes.add(executor.submit(responder_item_lote, item, decisao, limitador))
+            concluir_prontos(bloquear=False)
+        while pendentes:
+            concluir_prontos(bloquear=True)
+
+    duracao = time.perf_counter() - inicio
+    print(f"✅ Lote concluído em {duracao:.1f} s: " + ", ".join(f"{rota}={n}" for rota, n in contagem.most_common()))
+    return contagem
+
+
+# --- Medição do Tempo de Inicialização ---
+PERGUNTA_MEDICAO_FIXA = "Renovação."
+
+
+def medir_inicializacao_processo_filho(inicio_pai):
+    """
+    Executada no processo filho de `medir_inicializacao`: responde a uma pergunta fixa e a uma
+    pergunta que precisa do Gemini, imprimindo (em JSON) o instante em que cada uma ficou pronta.
+
+    Args:
+        inicio_pai (float): Instante (time.time()) em que o processo pai iniciou este processo.
+    """
+    estado = EstadoConversa()
+    executar_decisao(classificar_entrada(PERGUNTA_MEDICAO_FIXA, estado))
+    resposta_fixa = time.time()
+    # Pergunta única para não ser respondida pelo cache
+    executar_decisao(classificar_entrada(f"Responda apenas 'ok' ({uuid.uuid4().hex})", estado))
+    resposta_modelo = time.time()
+    print(json.dumps({
+        "resposta_fixa": resposta_fixa - inicio_pai,
+        "resposta_modelo": resposta_modelo - inicio_pai,
+        "gemini_disponivel": chat_session is not None,
+    }))
+
+
+def medir_inicializacao(repeticoes=3):
+    """
+    Mede o tempo de inicialização "a frio": inicia o script em um processo novo e registra
+    quanto tempo leva até a primeira resposta fixa e até a primeira resposta do Gemini.
+
+    Args:
+        repeticoes (int): Quantas vezes repetir a medição.
+    """
+    ambiente = dict(os.environ, CEAF_CACHE_ARQUIVO="") # Sem cache em disco, para medir a chamada real
+    medicoes = []
+    for _ in range(repeticoes):
+        inicio = time.time()
+        processo = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--medir-inicializacao-filho", repr(inicio)],
+            capture_output=True, text=True, env=ambiente,
+        )
+        linhas = [linha for linha in processo.stdout.splitlines() if linha.startswith("{")]
+        if processo.returncode != 0 or not linhas:
+            print(f"⚠️ Falha na medição: {processo.stderr.strip() or processo.stdout.strip()}")
+            return
+        medicoes.append(json.loads(linhas[-1]))
+    print(f"⏱️ Tempo de inicialização ({repeticoes} execuções, processo novo a cada vez):")
+    for campo, descricao in (("resposta_fixa", "Até a primeira resposta fixa"), ("resposta_modelo", "Até a primeira resposta do Gemini")):
+        tempos = sorted(m[campo] * 1000 for m in medicoes)
+        print(f"  {descricao}: mín={tempos[0]:.0f} ms mediana={tempos[len(tempos) // 2]:.0f} ms máx={tempos[-1]:.0f} ms")
+    if not medicoes[-1]["gemini_disponivel"]:
+        print("  (Gemini indisponível: o tempo da resposta do modelo corresponde à mensagem de funcionalidade limitada.)")
+
+# --- Benchmark e Teste de Carga (offline, com o backend simulado) ---
+# Perguntas livres usadas na carga simulada; parte delas se repete, como acontece no atendimento real
+PERGUNTAS_LIVRES_BENCHMARK = [
+    "Posso pegar o remédio da minha mãe no lugar dela?",
+    "O laudo vale por quanto tempo?",
+    "Preciso levar exames na renovação?",
+    "Meu médico é particular, a receita serve?",
+    "Quanto tempo demora para o pedido ser aprovado?",
+    "Posso enviar os documentos por e-mail?",
+    "O que é o LME?",
+    "Perdi meu protocolo, e agora?",
+]
+PARAFRASES_BENCHMARK = [
+    "renovacao", "quais documentos pra renovar", "bom dia", "que horas abre",
+    "receita valida?", "acompanhar pedido", "nova solicitacao", "horario de atendimento",
+]
+
+
+def gerar_carga_benchmark(quantidade, aleatorio):
+    """
+    Gera uma carga mista de mensagens: opções do menu, chaves exatas das respostas fixas,
+    paráfrases e perguntas livres (metade repetidas, metade inéditas).
+
+    Args:
+        quantidade (int): Quantidade de mensagens.
+        aleatorio (random.Random): Gerador de números aleatórios (para resultados reproduzíveis).
+
+    Returns:
+        list: Lista de listas de mensagens; cada item é uma "interação" (a opção 3 ocupa duas mensagens).
+    """
+    chaves_exatas = [chave for chave in respostas_fixas_tatui if chave != "sair"]
+    medicamentos = [item.principio_ativo for _, itens in catalogo_medicamentos.arquivos.values() for item in itens]
+    carga = []
+    for i in range(quantidade):
+        sorteio = aleatorio.random()
+        if sorteio < 0.2:
+            opcao = aleatorio.choice(["1", "2", "3", "4", "5", "6"])
+            if opcao == "3":
+                nome = aleatorio.choice(medicamentos) if medicamentos and aleatorio.random() < 0.5 else f"medicamento{i}"
+                carga.append(["3", nome])
+            else:
+                carga.append([opcao])
+        elif sorteio < 0.35:
+            carga.append([aleatorio.choice(chaves_exatas)])
+        elif sorteio < 0.6:
+            carga.append([aleatorio.choice(PARAFRASES_BENCHMARK)])
+        elif sorteio < 0.8:
+            carga.append([aleatorio.choice(PERGUNTAS_LIVRES_BENCHMARK)])
+        else:
+            carga.append([f"{aleatorio.choice(PERGUNTAS_LIVRES_BENCHMARK)} (caso {i})"])
+    return carga
+
+
+def percentil(valores_ordenados, fracao):
+    """Retorna o percentil (fração entre 0 e 1) de uma lista já ordenada."""
+    if not valores_ordenados:
+        return 0.0
+    return valores_ordenados[min(len(valores_ordenados) - 1, int(len(valores_ordenados) * fracao))]
+
+
+def executar_benchmark(conversas=50, mensagens_por_conversa=20, semente=42, arquivo_json=None):
+    """
+    Mede latência e vazão do chatbot sem acessar a API: usa o `BackendSimulado` e o mesmo
+    caminho do modo servidor (`ServidorChatbot.responder`), com várias conversas simultâneas.
+
+    Relata p50/p95/p99 por rota e no total, requisições por segundo, memória por conversa
+    e a distribuição das rotas, para detectar regressões no roteamento e no cache.
+
+    Args:
+        conversas (int): Conversas simultâneas.
+        mensagens_por_conversa (int): Interações enviadas por cada conversa, em sequência.
+        semente (int): Semente da carga aleatória.
+        arquivo_json (str, optional): Se informado, grava o resultado também em JSON.
+
+    Returns:
+        dict: Os resultados medidos.
+    """
+    import asyncio
+    import tracemalloc
+    global BACKEND_MODELO, _backend_simulado, cache_respostas
+
+    # Sempre offline: backend simulado e cache só em memória, vazio no início
+    BACKEND_MODELO = "simulado"
+    _backend_simulado = BackendSimulado.do_ambiente()
+    cache_respostas = CacheRespostasGemini(arquivo="")
+    catalogo_medicamentos.iniciar()
+
+    aleatorio = random.Random(semente)
+    cargas = [gerar_carga_benchmark(mensagens_por_conversa, aleatorio) for _ in range(conversas)]
+    latencias = defaultdict(list)
+
+    async def simular_conversa(servidor, conversa_id, interacoes):
+        for interacao in interacoes:
+            for mensagem in interacao:
+                inicio = time.perf_counter()
+                resultado = await servidor.responder(conversa_id, mensagem)
+                if not resultado["aguardando"]:
+                    latencias[resultado["rota"]].append(time.perf_counter() - inicio)
+
+    async def executar_carga():
+        servidor = ServidorChatbot(limite_chamadas_modelo=LIMITE_CHAMADAS_MODELO)
+        servidor.semaforo = asyncio.Semaphore(servidor.limite_chamadas_modelo)
+        memoria_inicial = tracemalloc.get_traced_memory()[0]
+        inicio = time.perf_counter()
+        await asyncio.gather(*(simular_conversa(servidor, f"bench-{i}", carga) for i, carga in enumerate(cargas)))
+        duracao = time.perf_counter() - inicio
+        memoria_por_conversa = (tracemalloc.get_traced_memory()[0] - memoria_inicial) / max(1, len(servidor.pool))
+        servidor.executor.shutdown(wait=True)
+        return duracao, memoria_por_conversa
+
+    tracemalloc.start()
+    try:
+        duracao, memoria_por_conversa = asyncio.run(executar_carga())
+    finally:
+        tracemalloc.stop()
+
+    todas = sorted(l for valores in latencias.values() for l in valores)
+    total = len(todas)
+    resultado = {
+        "backend": {"latencia_mediana_ms": _backend_simulado.latencia_mediana_ms, "dispersao": _backend_simulado.dispersao,
+                    "taxa_erro": _backend_simulado.taxa_erro, "taxa_429": _backend_simulado.taxa_429},
+        "conversas": conversas,
+        "respostas": total,
+        "duracao_s": round(duracao, 3),
+        "requisicoes_por_segundo": round(total / duracao, 1) if duracao else 0.0,
+        "memoria_por_conversa_kb": round(memoria_por_conversa / 1024, 1),
+        "chamadas_modelo": _backend_simulado.contadores["chamadas"],
+        "rotas": {},
+    }
+    for rota, valores in sorted(latencias.items(), key=lambda item: -len(item[1])):
+        valores.sort()
+        resultado["rotas"][rota] = {
+            "quantidade": len(valores),
+            "fracao": round(len(valores) / total, 3),
+            "p50_ms": round(percentil(valores, 0.5) * 1000, 3),
+            "p95_ms": round(percentil(valores, 0.95) * 1000, 3),
+            "p99_ms": round(percentil(valores, 0.99) * 1000, 3),
+        }
+    resultado["total"] = {
+        "p50_ms": round(percentil(todas, 0.5) * 1000, 3),
+        "p95_ms": round(percentil(todas, 0.95) * 1000, 3),
+        "p99_ms": round(percentil(todas, 0.99) * 1000, 3),
+    }
+
+    print(f"📈 Benchmark: {conversas} conversas simultâneas, {total} respostas em {duracao:.2f} s "
+          f"({resultado['requisicoes_por_segundo']} req/s), {resultado['chamadas_modelo']} chamadas ao modelo simulado")
+    print(f"   Memória por conversa: {resultado['memoria_por_conversa_kb']} KB")
+    print(f"   {'rota':<18}{'qtd':>7}{'%':>8}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}")
+    for rota, dados in list(resultado["rotas"].items()) + [("TOTAL", dict(resultado["total"], quantidade=total, fracao=1.0))]:
+        print(f"   {rota:<18}{dados['quantidade']:>7}{dados['fracao']:>8.1%}"
+              f"{dados['p50_ms']:>11.2f}{dados['p95_ms']:>11.2f}{dados['p99_ms']:>11.2f}")
+    if arquivo_json:
+        with open(arquivo_json, "w", encoding="utf-8") as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+    return resultado
+
+
 # --- Ponto de Entrada do Script ---
 if __name__ == "__main__":
-    # Verificações iniciais (API Key e inicialização do modelo)
-    # A API Key já é configurada no início do script.
-    # A inicialização do chat_session também já ocorre no início.
-    # Uma mensagem de aviso já é impressa se houver falha na inicialização do Gemini.
+    # A API Key e o cliente Gemini são carregados na primeira pergunta que precisar do modelo.
+    # Uma mensagem de aviso é impressa se houver falha na inicialização do Gemini.
 
-    # Inicia o chatbot
-    iniciar_chatbot()
+    parser = argparse.ArgumentParser(description="Chatbot da Assistência Farmacêutica de Tatuí")
+    parser.add_argument("--servidor", action="store_true", help="Atende várias conversas via HTTP/WebSocket em vez do terminal")
+    parser.add_argument("--host", default=SERVIDOR_HOST, help="Endereço do servidor (modo --servidor)")
+    parser.add_argument("--porta", type=int, default=SERVIDOR_PORTA, help="Porta do servidor (modo --servidor)")
+    parser.add_argument("--lote", metavar="ENTRADA.jsonl", help="Responde às perguntas de um arquivo JSONL (uma por linha)")
+    parser.add_argument("--saida", metavar="SAIDA.jsonl", help="Arquivo de resultados do modo --lote (padrão: <entrada>.respostas.jsonl)")
+    parser.add_argument("--trabalhadores", type=int, default=LOTE_TRABALHADORES, help="Chamadas simultâneas ao Gemini no modo --lote")
+    parser.add_argument("--limite-por-minuto", type=float, default=LOTE_LIMITE_POR_MINUTO, help="Chamadas ao Gemini por minuto no modo --lote")
+    parser.add_argument("--benchmark", action="store_true", help="Mede latência e vazão offline, com o backend simulado (CEAF_SIMULADO_*)")
+    parser.add_argument("--conversas", type=int, default=50, help="Conversas simultâneas no modo --benchmark")
+    parser.add_argument("--mensagens", type=int, default=20, help="Mensagens por conversa no modo --benchmark")
+    parser.add_argument("--benchmark-json", metavar="ARQUIVO", help="Grava o resultado do --benchmark em JSON")
+    parser.add_argument("--medir-inicializacao", type=int, nargs="?", const=3, metavar="REPETICOES",
+                        help="Mede o tempo até a primeira resposta fixa e até a primeira resposta do Gemini")
+    parser.add_argument("--medir-inicializacao-filho", type=float, help=argparse.SUPPRESS)
+    # parse_known_args ignora argumentos extras passados pelo Colab/Jupyter
+    argumentos, _ = parser.parse_known_args()
+
+    medicao = argumentos.medir_inicializacao_filho is not None or argumentos.medir_inicializacao
+    if ARQUIVO_METRICAS_JSON and not medicao:
+        iniciar_exportacao_metricas_json()
+
+    if argumentos.medir_inicializacao_filho is not None:
+        medir_inicializacao_processo_filho(argumentos.medir_inicializacao_filho)
+    elif argumentos.medir_inicializacao:
+        medir_inicializacao(argumentos.medir_inicializacao)
+    elif argumentos.benchmark:
+        executar_benchmark(argumentos.conversas, argumentos.mensagens, arquivo_json=argumentos.benchmark_json)
+    elif argumentos.lote:
+        saida = argumentos.saida or os.path.splitext(argumentos.lote)[0] + ".respostas.jsonl"
+        processar_lote(argumentos.lote, saida, argumentos.trabalhadores, argumentos.limite_por_minuto)
+    elif argumentos.servidor:
+        iniciar_servidor(argumentos.host, argumentos.porta)
+    else:
+        # Inicia o chatbot
+        iniciar_chatbot()
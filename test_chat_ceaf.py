@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Testes automatizados do chatbot (python -m unittest -v).
+
+Rodam offline, com o backend simulado, sem cache em disco e sem cota compartilhada, para
+que nenhum arquivo seja criado e nenhuma chamada à API do Gemini seja feita.
+"""
+
+import asyncio
+import base64
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+os.environ["CEAF_BACKEND"] = "simulado"
+os.environ["CEAF_CACHE_ARQUIVO"] = ""
+os.environ["CEAF_ARQUIVO_COTAS"] = ""
+os.environ["CEAF_ARQUIVO_RASTROS"] = ""
+
+
+def carregar_chatbot():
+    # O nome do script tem um ponto (v0.5), então ele é carregado pelo caminho do arquivo
+    caminho = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Chat_CEAF_v0.5.py")
+    especificacao = importlib.util.spec_from_file_location("chat_ceaf", caminho)
+    modulo = importlib.util.module_from_spec(especificacao)
+    especificacao.loader.exec_module(modulo)
+    return modulo
+
+
+chat = carregar_chatbot()
+
+
+class ErroHTTP(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def falhar_com(erro):
+    def funcao(*args):
+        raise erro
+    return funcao
+
+
+class TesteDisjuntor(unittest.TestCase):
+    """Estados do disjuntor (fechado, aberto, meio aberto) e classificação dos erros do modelo."""
+
+    def setUp(self):
+        self.saida = contextlib.redirect_stdout(io.StringIO()) # Os avisos do disjuntor não poluem o teste
+        self.saida.__enter__()
+        self.disjuntor = chat.Disjuntor(limite_falhas=2, espera=60)
+        self.chamador = chat.ChamadorResiliente(prazo=5, prazo_total=5, tentativas=1, disjuntor=self.disjuntor,
+                                                max_threads=2)
+
+    def tearDown(self):
+        self.chamador.executor.shutdown(wait=False)
+        self.saida.__exit__(None, None, None)
+
+    def test_abre_apos_falhas_seguidas_e_recusa_sem_chamar_o_backend(self):
+        backend = chat.BackendSimulado(latencia_mediana_ms=0, dispersao=0, taxa_erro=1.0, semente=1)
+        for _ in range(2):
+            with self.assertRaises(chat.ErroBackendSimulado):
+                self.chamador.executar(backend.gerar, [("user", "oi")])
+        self.assertEqual(self.disjuntor.estado, "aberto")
+        with self.assertRaises(chat.ErroCircuitoAberto):
+            self.chamador.executar(backend.gerar, [("user", "oi")])
+        self.assertEqual(backend.contadores["chamadas"], 2)
+
+    def test_erro_sem_codigo_http_conta_como_falha(self):
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.chamador.executar(falhar_com(RuntimeError("falha de rede")))
+        self.assertEqual(self.disjuntor.estado, "aberto")
+
+    def test_erro_do_pedido_nao_abre_nem_zera_as_falhas(self):
+        with self.assertRaises(ErroHTTP):
+            self.chamador.executar(falhar_com(ErroHTTP(503)))
+        for _ in range(3):
+            with self.assertRaises(ErroHTTP):
+                self.chamador.executar(falhar_com(ErroHTTP(400)))
+        self.assertEqual(self.disjuntor.estado, "fechado")
+        self.assertEqual(self.disjuntor.falhas_seguidas, 1)
+
+    def test_meio_aberto_deixa_passar_um_teste_e_fecha_com_sucesso(self):
+        self.disjuntor.espera = 0.05
+        self.disjuntor.registrar_falha()
+        self.disjuntor.registrar_falha()
+        self.assertFalse(self.disjuntor.permitir())
+        time.sleep(0.06)
+        self.assertEqual(self.disjuntor.estado, "meio_aberto")
+        self.assertTrue(self.disjuntor.permitir())
+        self.assertFalse(self.disjuntor.permitir()) # Só uma chamada de teste por vez
+        self.disjuntor.registrar_sucesso()
+        self.assertEqual(self.disjuntor.estado, "fechado")
+        self.assertTrue(self.disjuntor.permitir())
+
+    def test_meio_aberto_abre_de_novo_se_o_teste_falhar(self):
+        self.disjuntor.espera = 0.05
+        self.disjuntor.registrar_falha()
+        self.disjuntor.registrar_falha()
+        time.sleep(0.06)
+        self.assertTrue(self.disjuntor.permitir())
+        self.disjuntor.registrar_falha()
+        self.assertEqual(self.disjuntor.estado, "aberto")
+
+    def test_classificacao_dos_erros(self):
+        for erro in (ErroHTTP(429), ErroHTTP(408), ErroHTTP(503), TimeoutError(), ConnectionResetError()):
+            self.assertTrue(chat.erro_recuperavel(erro), erro)
+        for erro in (ErroHTTP(400), ErroHTTP(403), RuntimeError()):
+            self.assertFalse(chat.erro_recuperavel(erro), erro)
+        self.assertTrue(chat.erro_do_pedido(ErroHTTP(400)))
+        self.assertFalse(chat.erro_do_pedido(ErroHTTP(429)))
+        self.assertFalse(chat.erro_do_pedido(RuntimeError()))
+
+
+class TesteAgendador(unittest.TestCase):
+    """Fila de prioridades e cotas por minuto do `AgendadorModelo`."""
+
+    def reservar_em_thread(self, agendador, prioridade, nome, ordem, limite=None):
+        def reservar():
+            chat.prioridade_modelo.set(prioridade)
+            agendador.reservar(1, limite)
+            ordem.append(nome)
+        thread = threading.Thread(target=reservar)
+        thread.start()
+        return thread
+
+    def esperar_fila(self, agendador, tamanho):
+        limite = time.monotonic() + 2
+        while len(agendador) < tamanho and time.monotonic() < limite:
+            time.sleep(0.005)
+        self.assertEqual(len(agendador), tamanho)
+
+    def test_conversas_passam_a_frente_do_lote(self):
+        agendador = chat.AgendadorModelo(limite_rpm=600, arquivo="", reserva_interativa=0) # 10 por segundo
+        agendador.balde_requisicoes.pausar(0.2)
+        ordem = []
+        threads = []
+        for i in range(3):
+            threads.append(self.reservar_em_thread(agendador, chat.PRIORIDADE_LOTE, f"lote{i}", ordem))
+            self.esperar_fila(agendador, i + 1) # Garante a ordem de chegada
+        threads.append(self.reservar_em_thread(agendador, chat.PRIORIDADE_INTERATIVA, "interativa", ordem))
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(ordem, ["interativa", "lote0", "lote1", "lote2"])
+
+    def test_chamada_interativa_desiste_no_prazo(self):
+        agendador = chat.AgendadorModelo(limite_rpm=60, arquivo="")
+        agendador.balde_requisicoes.pausar(5)
+        inicio = time.monotonic()
+        with self.assertRaises(chat.ErroPrazoModelo):
+            agendador.reservar(1, limite=time.monotonic() + 0.05)
+        self.assertLess(time.monotonic() - inicio, 1)
+        self.assertEqual(len(agendador), 0)
+
+    def test_lote_deixa_reserva_para_as_conversas(self):
+        agendador = chat.AgendadorModelo(limite_rpm=600, arquivo="", reserva_interativa=0.2)
+        agendador.balde_requisicoes.ajustar(-90) # Sobram 10 das 100 fichas
+        self.assertEqual(agendador._espera_necessaria(1, chat.PRIORIDADE_INTERATIVA), 0)
+        self.assertGreater(agendador._espera_necessaria(1, chat.PRIORIDADE_LOTE), 0)
+
+    def test_processos_compartilham_a_cota_pelo_arquivo(self):
+        with tempfile.TemporaryDirectory() as diretorio:
+            arquivo = os.path.join(diretorio, "cotas.sqlite3")
+            servidor = chat.AgendadorModelo(limite_rpm=60, arquivo=arquivo)
+            lote = chat.AgendadorModelo(limite_rpm=60, arquivo=arquivo)
+            for _ in range(10): # Toda a rajada (10 s de cota)
+                servidor.reservar(1)
+            self.assertGreater(lote._espera_necessaria(1), 0.5)
+            for agendador in (servidor, lote):
+                agendador.balde_requisicoes.conexao.close()
+
+
+class TesteServidor(unittest.IsolatedAsyncioTestCase):
+    """Leitura das requisições HTTP e dos quadros WebSocket do `ServidorChatbot`."""
+
+    async def asyncSetUp(self):
+        self.chatbot = chat.ServidorChatbot()
+        self.servidor = await asyncio.start_server(self.chatbot.tratar_conexao, "127.0.0.1", 0)
+        self.porta = self.servidor.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.servidor.close()
+        await self.servidor.wait_closed()
+        self.chatbot.executor.shutdown(wait=False)
+
+    async def enviar(self, dados):
+        leitor, escritor = await asyncio.open_connection("127.0.0.1", self.porta)
+        escritor.write(dados)
+        await escritor.drain()
+        return leitor, escritor
+
+    async def test_post_mensagem_com_resposta_fixa(self):
+        corpo = json.dumps({"conversa": "c1", "texto": "4"}).encode("utf-8")
+        leitor, escritor = await self.enviar(
+            b"POST /mensagem HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n%s" % (len(corpo), corpo))
+        resposta = await asyncio.wait_for(leitor.read(), 5)
+        escritor.close()
+        cabecalhos, _, corpo_resposta = resposta.partition(b"\r\n\r\n")
+        self.assertTrue(cabecalhos.startswith(b"HTTP/1.1 200 OK"))
+        dados = json.loads(corpo_resposta)
+        self.assertEqual(dados["resposta"], chat.respostas_fixas_tatui[chat.CHAVE_CONTATO])
+
+    async def test_json_invalido_responde_400(self):
+        leitor, escritor = await self.enviar(b"POST /mensagem HTTP/1.1\r\nConnection: close\r\nContent-Length: 3\r\n\r\n{x}")
+        resposta = await asyncio.wait_for(leitor.read(), 5)
+        escritor.close()
+        self.assertTrue(resposta.startswith(b"HTTP/1.1 400 Bad Request"))
+
+    async def test_corpo_grande_demais_responde_413_e_fecha(self):
+        tamanho = chat.TAMANHO_MAX_MENSAGEM + 1
+        seguinte = b"GET /saude HTTP/1.1\r\n\r\n"
+        leitor, escritor = await self.enviar(
+            b"POST /mensagem HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % tamanho + b"a" * tamanho + seguinte)
+        resposta = await asyncio.wait_for(leitor.read(), 5) # read() só termina quando o servidor fecha
+        escritor.close()
+        self.assertTrue(resposta.startswith(b"HTTP/1.1 413 Payload Too Large"))
+        self.assertEqual(resposta.count(b"HTTP/1.1 "), 1) # Os bytes restantes não viram outra requisição
+
+    @staticmethod
+    def quadro_cliente(opcode, dados, fim=True):
+        # Quadros enviados pelo cliente são sempre mascarados (RFC 6455)
+        mascara = b"\x01\x02\x03\x04"
+        mascarados = bytes(b ^ mascara[i % 4] for i, b in enumerate(dados))
+        return struct.pack("!BB", (0x80 if fim else 0) | opcode, 0x80 | len(dados)) + mascara + mascarados
+
+    @staticmethod
+    async def ler_quadro(leitor):
+        cabecalho = await asyncio.wait_for(leitor.readexactly(2), 5)
+        tamanho = cabecalho[1] & 0x7F
+        if tamanho == 126:
+            tamanho = struct.unpack("!H", await leitor.readexactly(2))[0]
+        elif tamanho == 127:
+            tamanho = struct.unpack("!Q", await leitor.readexactly(8))[0]
+        return cabecalho[0] & 0x0F, await leitor.readexactly(tamanho)
+
+    async def test_websocket_aperto_de_mao_fragmentos_ping_e_fechamento(self):
+        chave = base64.b64encode(b"0123456789abcdef").decode("ascii")
+        leitor, escritor = await self.enviar(
+            f"GET /ws?conversa=c2 HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {chave}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode("latin-1"))
+        resposta = await asyncio.wait_for(leitor.readuntil(b"\r\n\r\n"), 5)
+        aceite = base64.b64encode(hashlib.sha1((chave + chat.GUID_WEBSOCKET).encode("ascii")).digest())
+        self.assertTrue(resposta.startswith(b"HTTP/1.1 101"))
+        self.assertIn(b"Sec-WebSocket-Accept: " + aceite, resposta)
+
+        # Mensagem de texto em dois fragmentos: "sa" + "ir"
+        escritor.write(self.quadro_cliente(0x1, b"sa", fim=False) + self.quadro_cliente(0x0, b"ir"))
+        opcode, dados = await self.ler_quadro(leitor)
+        self.assertEqual(opcode, 0x1)
+        resultado = json.loads(dados)
+        self.assertEqual(resultado["tipo"], "resposta")
+        self.assertTrue(resultado["encerrar"])
+
+        escritor.write(self.quadro_cliente(0x9, b"ping"))
+        self.assertEqual(await self.ler_quadro(leitor), (0xA, b"ping"))
+
+        escritor.write(self.quadro_cliente(0x8, b""))
+        self.assertEqual((await self.ler_quadro(leitor))[0], 0x8)
+        self.assertEqual(await asyncio.wait_for(leitor.read(), 5), b"")
+        escritor.close()
+
+
+class TesteCatalogo(unittest.TestCase):
+    """Leitura das listas estaduais (`extrair_medicamentos`) e busca no catálogo."""
+
+    def test_colunas_identificadas_pelo_cabecalho(self):
+        linhas = [["PCDT", "Apresentação", "Princípio Ativo"], ["Artrite reumatoide", "40 mg", "Adalimumabe"]]
+        itens = chat.extrair_medicamentos(linhas, "relacao_estadual")
+        self.assertEqual(len(itens), 1)
+        item = itens[0]
+        self.assertEqual((item.principio_ativo, item.apresentacao, item.protocolo, item.lista),
+                         ("Adalimumabe", "40 mg", "Artrite reumatoide", "relacao_estadual"))
+
+    def test_sem_cabecalho_usa_a_ordem_padrao(self):
+        itens = chat.extrair_medicamentos([["Losartana", "50 mg", "Hipertensão"], ["", "x", "y"]], "glaucoma")
+        self.assertEqual([(i.principio_ativo, i.apresentacao, i.protocolo) for i in itens],
+                         [("Losartana", "50 mg", "Hipertensão")])
+
+    def test_csv_e_html(self):
+        with tempfile.TemporaryDirectory() as diretorio:
+            csv_caminho = os.path.join(diretorio, "relacao_estadual.csv")
+            with open(csv_caminho, "w", encoding="latin-1") as arquivo:
+                arquivo.write("Medicamento;Concentração;Doença\nÁcido Zoledrônico;5 mg;Osteoporose\n")
+            html_caminho = os.path.join(diretorio, "glaucoma.html")
+            with open(html_caminho, "w", encoding="utf-8") as arquivo:
+                arquivo.write("<table><tr><th>Fármaco</th><th>Apresentação</th></tr>"
+                              "<tr><td>Timolol</td><td>0,5%</td></tr></table>")
+            itens_csv = chat.extrair_medicamentos(chat.ler_linhas_lista(csv_caminho), "relacao_estadual")
+            itens_html = chat.extrair_medicamentos(chat.ler_linhas_lista(html_caminho), "glaucoma")
+            self.assertEqual([(i.principio_ativo, i.protocolo) for i in itens_csv], [("Ácido Zoledrônico", "Osteoporose")])
+            self.assertEqual([(i.principio_ativo, i.apresentacao) for i in itens_html], [("Timolol", "0,5%")])
+
+            catalogo = chat.CatalogoMedicamentos(diretorio=diretorio, intervalo_verificacao=3600)
+            nomes = lambda termo: [i.principio_ativo for i in catalogo.buscar(termo)]
+            self.assertEqual(nomes("timolol"), ["Timolol"])
+            self.assertEqual(nomes("acido zoled"), ["Ácido Zoledrônico"]) # Prefixo
+            self.assertEqual(nomes("zoledronico"), ["Ácido Zoledrônico"]) # Só a segunda palavra
+            self.assertEqual(nomes("timolol 0,5%"), ["Timolol"]) # Nome e palavras extras
+            self.assertEqual(nomes("a"), []) # Curto demais para prefixo
+
+
+if __name__ == "__main__":
+    unittest.main()